@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+Benchmark the page cache: storing fetched pages (compression ratio, pages
+stored per second) and replaying them, i.e. parsing the cached pages again
+and writing the prices found to the product store, with no network access
+(traker --replay), against a temporary data directory.
+
+usage: bench_cache.py [--products <n>] [--days <n>] [--parsers <n>]
+"""
+
+from argparse import ArgumentParser
+from datetime import date, timedelta
+from json import loads as json_loads
+from os import environ, makedirs
+from os.path import dirname, join, realpath
+from sys import path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+ROOT = join(dirname(realpath(__file__)), "..")
+path.insert(0, join(ROOT, "src"))
+
+from pages import synthetic_page  # noqa: E402
+
+SITE = "amazon"
+
+
+def main() -> None:
+    argparser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    argparser.add_argument("--products", type=int, default=100)
+    argparser.add_argument("--days", type=int, default=10)
+    argparser.add_argument("--parsers", type=int, default=4)
+    args = argparser.parse_args()
+    with open(join(ROOT, "sites.json"), "r") as sites_file:
+        selectors = json_loads(sites_file.read())[SITE]
+    with TemporaryDirectory() as home:
+        # main reads the data directory from HOME when imported
+        environ["HOME"] = home
+        makedirs(join(home, ".local", "share", "price-traker"))
+        import main
+
+        store = main.get_store()
+        cache = main.get_cache()
+        urls = [
+            f"https://www.amazon.it/dp/B{index:09d}"
+            for index in range(args.products)
+        ]
+        with store.batch():
+            for index, url in enumerate(urls):
+                store.add_product(
+                    {
+                        "url": url,
+                        "title": f"Product {index}",
+                        "followers": ["user@example.com"],
+                        "prices": [],
+                    }
+                )
+        first = date.today() - timedelta(days=args.days)
+        raw = 0
+        begin = perf_counter()
+        for day in range(args.days):
+            for index, url in enumerate(urls):
+                page = synthetic_page(
+                    selectors,
+                    title=f"Product {index}",
+                    price=f"{index + day},99€",
+                    blocks=1000,
+                )
+                raw += len(page)
+                cache.put(url, str(first + timedelta(days=day)), page)
+        elapsed = perf_counter() - begin
+        pages = args.products * args.days
+        print(
+            f"stored {pages} pages ({raw / 2**20:.1f} MiB) in {elapsed:.2f}s "
+            f"({pages / elapsed:.0f} pages/s, page generation included), "
+            f"compressed to {cache.size / 2**20:.2f} MiB "
+            f"({raw / cache.size:.0f}x)"
+        )
+        main.replay_prices(parsers=args.parsers)
+        cache.close()
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
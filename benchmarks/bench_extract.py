@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+Compare parse time and peak memory per page of the targeted extraction
+(extract.Extractor) with the full BeautifulSoup tree previously built by
+get_page.
+
+usage: bench_extract.py [<site> <page.html> ...]
+
+without arguments a synthetic amazon-like page is used
+"""
+
+from argparse import ArgumentParser
+from json import loads as json_loads
+from multiprocessing import get_context
+from os.path import dirname, join, realpath
+from resource import RUSAGE_SELF, getrusage
+from sys import path
+from time import perf_counter
+from tracemalloc import get_traced_memory, start, stop
+
+ROOT = join(dirname(realpath(__file__)), "..")
+path.insert(0, join(ROOT, "src"))
+
+from extract import Extractor  # noqa: E402
+from pages import synthetic_page  # noqa: E402
+
+RUNS = 20
+
+
+def parse_soup(page: str, selectors: dict) -> dict:
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(page, "lxml")
+    infos = {}
+    for field, selector in selectors.items():
+        element = soup.find(id=selector) or soup.find(class_=selector)
+        infos[field] = element.text if element is not None else None
+    return infos
+
+
+def parse_targeted(page: str, selectors: dict) -> dict:
+    return Extractor(selectors).extract(page)
+
+
+PARSERS = {"beautifulsoup": parse_soup, "targeted": parse_targeted}
+
+
+def measure(parser: str, page: str, selectors: dict) -> dict:
+    """
+    Run in a fresh process, so that peak RSS belongs to a single parser
+    """
+    parse = PARSERS[parser]
+    parse(page[:1024], selectors)  # warm up imports
+    rss_before = getrusage(RUSAGE_SELF).ru_maxrss
+    start()
+    infos = parse(page, selectors)
+    _, peak = get_traced_memory()
+    stop()
+    rss_after = getrusage(RUSAGE_SELF).ru_maxrss
+    timings = []
+    for _ in range(RUNS):
+        begin = perf_counter()
+        parse(page, selectors)
+        timings.append(perf_counter() - begin)
+    return {
+        "infos": infos,
+        "time": min(timings),
+        "traced_peak": peak,
+        "rss_delta": (rss_after - rss_before) * 1024,
+    }
+
+
+def main() -> None:
+    argparser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    argparser.add_argument("pages", nargs="*", metavar="<site> <page.html>")
+    args = argparser.parse_args()
+    with open(join(ROOT, "sites.json"), "r") as sites_file:
+        sites = json_loads(sites_file.read())
+    if len(args.pages) % 2 != 0:
+        argparser.error("pages must be given as <site> <page.html> pairs")
+    pages = [
+        (
+            "amazon (synthetic)",
+            "amazon",
+            synthetic_page(sites["amazon"], price="1.299,00€"),
+        )
+    ]
+    if len(args.pages) > 0:
+        pages = []
+        for site, page_file in zip(args.pages[::2], args.pages[1::2]):
+            with open(page_file, "r", encoding="utf-8") as page:
+                pages.append((page_file, site, page.read()))
+    context = get_context("spawn")
+    for name, site, page in pages:
+        selectors = {
+            "title": sites[site]["title"],
+            "price": sites[site]["price"],
+        }
+        print(f"{name}: {len(page) / 1024:.0f} KiB")
+        for parser in PARSERS:
+            with context.Pool(1) as pool:
+                result = pool.apply(measure, (parser, page, selectors))
+            print(
+                f"  {parser:>14}: {result['time'] * 1000:8.2f} ms, "
+                f"traced peak {result['traced_peak'] / 2**20:7.2f} MiB, "
+                f"rss +{result['rss_delta'] / 2**20:7.2f} MiB, "
+                f"price {result['infos']['price']!r}"
+            )
+
+
+if __name__ == "__main__":
+    main()
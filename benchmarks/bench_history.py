@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+Benchmark the price history retention: points kept, database size and time
+of the price figures query (analytics.price_stats, behind --stats and the
+notification rules) before and after rolling up the prices older than a
+year to weekly ones.
+
+usage: bench_history.py [--products <n>] [--days <n>] [--rollup-after <n>]
+"""
+
+from argparse import ArgumentParser
+from datetime import date, timedelta
+from os.path import dirname, getsize, join, realpath
+from sys import path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+ROOT = join(dirname(realpath(__file__)), "..")
+path.insert(0, join(ROOT, "src"))
+
+from analytics import price_stats  # noqa: E402
+from store import HISTORY, Store  # noqa: E402
+
+
+def fill(store: Store, products: int, days: int) -> None:
+    first = date.today() - timedelta(days=days)
+    dates = [str(first + timedelta(days=day)) for day in range(days)]
+    with store.db:
+        for index in range(products):
+            product_id = store.db.execute(
+                "INSERT INTO products (url, title) VALUES (?, ?)",
+                (f"https://www.amazon.it/dp/B{index:09d}", f"Product {index}"),
+            ).lastrowid
+            store.db.executemany(
+                "INSERT INTO prices (product_id, date, price) "
+                "VALUES (?, ?, ?)",
+                [
+                    (product_id, day, 100 + (index + offset) % 17 * 0.5)
+                    for offset, day in enumerate(dates)
+                ],
+            )
+
+
+def measure(store: Store, path: str) -> tuple:
+    """
+    Return (points, database bytes, seconds of the price figures query)
+    """
+    (points,) = store.db.execute(
+        f"SELECT count(*) FROM ({HISTORY.format(where='')})"
+    ).fetchone()
+    store.db.execute("VACUUM")
+    store.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    begin = perf_counter()
+    price_stats(store)
+    return points, getsize(path), perf_counter() - begin
+
+
+def main() -> None:
+    argparser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    argparser.add_argument("--products", type=int, default=200)
+    argparser.add_argument("--days", type=int, default=3 * 365)
+    argparser.add_argument("--rollup-after", type=int, default=365)
+    args = argparser.parse_args()
+    with TemporaryDirectory() as tmp_dir:
+        path = join(tmp_dir, "products.db")
+        store = Store(path)
+        fill(store, args.products, args.days)
+        print(
+            f"{'history':>10} | {'points':>8} | {'database':>9} | "
+            f"{'stats':>9}"
+        )
+        for name in ("daily", "rolled up"):
+            if name == "rolled up":
+                before = date.today() - timedelta(days=args.rollup_after)
+                store.rollup(str(before))
+            points, size, elapsed = measure(store, path)
+            print(
+                f"{name:>10} | {points:>8} | {size / 2**20:>5.1f} MiB | "
+                f"{elapsed * 1000:>6.0f} ms"
+            )
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+Benchmark notification throughput against the local SMTP sink: one
+connection and login per message (as send_notification used to do) versus
+the Dispatcher sending the whole queue over one or more connections.
+
+usage: bench_notify.py [--recipients <n>] [--login-delay <s>]
+                       [--drop-rate <r>]
+"""
+
+from argparse import ArgumentParser
+from os.path import dirname, join, realpath
+from sys import path
+from time import perf_counter
+
+ROOT = join(dirname(realpath(__file__)), "..")
+path.insert(0, join(ROOT, "src"))
+
+from notify import Dispatcher, close  # noqa: E402
+from smtp_sink import SMTPSink  # noqa: E402
+
+
+def mail_opts(port: int) -> dict:
+    return {
+        "smtp_server": "127.0.0.1",
+        "port": port,
+        "notifier_addr": "notifier@example.com",
+        "notifier_psw": "password",
+        "ssl": False,
+    }
+
+
+def per_message(opts: dict, queue: dict) -> Dispatcher:
+    dispatcher = Dispatcher(opts, retries=0)
+    for mail_addr, mail_body in queue.items():
+        try:
+            server = dispatcher.connect()
+            server.send_message(dispatcher.message(mail_addr, mail_body))
+            close(server)
+            dispatcher.sent += 1
+        except Exception:
+            dispatcher.failed.append(mail_addr)
+    return dispatcher
+
+
+def dispatch(opts: dict, queue: dict, connections: int) -> Dispatcher:
+    dispatcher = Dispatcher(opts, connections=connections, retry_delay=0)
+    dispatcher.dispatch(queue)
+    return dispatcher
+
+
+def main() -> None:
+    argparser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    argparser.add_argument("--recipients", type=int, default=200)
+    argparser.add_argument(
+        "--login-delay",
+        type=float,
+        default=0.05,
+        help="simulated TLS handshake + login time (default: 0.05s)",
+    )
+    argparser.add_argument("--drop-rate", type=float, default=0)
+    args = argparser.parse_args()
+    queue = {
+        f"user{index}@example.com": "├─ product\n│   └── delta: -1€\n" * 5
+        for index in range(args.recipients)
+    }
+    runs = [("connection per message", lambda opts: per_message(opts, queue))]
+    for connections in (1, 4):
+        runs.append(
+            (
+                f"dispatcher, {connections} connection(s)",
+                lambda opts, connections=connections: dispatch(
+                    opts, queue, connections
+                ),
+            )
+        )
+    for name, run in runs:
+        sink = SMTPSink(
+            login_delay=args.login_delay, drop_rate=args.drop_rate
+        ).start()
+        begin = perf_counter()
+        dispatcher = run(mail_opts(sink.port))
+        elapsed = perf_counter() - begin
+        sink.stop()
+        print(
+            f"{name:>28}: {len(sink.messages) / elapsed:8.1f} mails/s "
+            f"({dispatcher.stats()})"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+Benchmark the extractor and the price parser of every site in sites.json
+over the page saved in benchmarks/pages/<site>.html (a synthetic page is
+used for sites without a saved one).
+
+usage: bench_sites.py
+"""
+
+from json import loads as json_loads
+from os.path import dirname, join, realpath
+from sys import path
+from time import perf_counter
+
+ROOT = join(dirname(realpath(__file__)), "..")
+path.insert(0, join(ROOT, "src"))
+
+from pages import saved_page, synthetic_page  # noqa: E402
+from sites import SiteRegistry  # noqa: E402
+
+RUNS = 20
+PRICES = ["1.299,00 €", "€1,299.00", "EUR 1 299,00", "1299€", "0,99€"]
+
+
+def best_of(function, *args) -> float:
+    timings = []
+    for _ in range(RUNS):
+        begin = perf_counter()
+        function(*args)
+        timings.append(perf_counter() - begin)
+    return min(timings)
+
+
+def main() -> None:
+    registry = SiteRegistry.load(join(ROOT, "sites.json"))
+    with open(join(ROOT, "sites.json"), "r") as sites_file:
+        sites = json_loads(sites_file.read())
+    for site in registry:
+        page = saved_page(site.name)
+        source = "saved"
+        if page is None:
+            page = synthetic_page(sites[site.name])
+            source = "synthetic"
+        try:
+            infos = site.extract(page)
+        except ValueError as e:
+            print(f"{site.name:>12} ({source}): extraction failed ({e})")
+            continue
+        elapsed = best_of(site.extract, page)
+        print(
+            f"{site.name:>12} ({source}, {len(page) / 1024:.0f} KiB): "
+            f"{elapsed * 1000:7.2f} ms/page, price {infos['price']}, "
+            f"title '{infos['title'][:30]}'"
+        )
+    parse_price = next(iter(registry)).parse_price
+    elapsed = best_of(lambda: [parse_price(price) for price in PRICES])
+    print(f"price parser: {elapsed / len(PRICES) * 1e6:.2f} µs/price")
+
+
+if __name__ == "__main__":
+    main()
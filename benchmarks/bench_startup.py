@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+Benchmark CLI startup: run traker subcommands under `python -X importtime`
+(against an empty, temporary data directory) and check the time spent
+importing modules against a budget, so that -l and -r keep loading only
+the product store and not the network, parsing and mail modules needed by
+-i and -u. Exits with status 1 if any subcommand goes over budget.
+
+usage: bench_startup.py [--runs <n>] [--scale <x>]
+"""
+
+from argparse import ArgumentParser
+from os import environ, makedirs
+from os.path import dirname, join, realpath
+from subprocess import run
+from sys import executable
+from sys import exit as sys_exit
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+ROOT = join(dirname(realpath(__file__)), "..")
+MAIN = join(ROOT, "src", "main.py")
+RUNS = 5
+# modules that only -i and -u are supposed to load
+HEAVY = (
+    "requests",
+    "lxml",
+    "fake_useragent",
+    "smtplib",
+    "ssl",
+    "bs4",
+    "multiprocessing",
+)
+# (name, arguments, import time budget in ms)
+SUBCOMMANDS = [
+    ("help", ["-h"], 60),
+    ("list", ["-l"], 60),
+    ("list site", ["-l", "--site", "amazon"], 60),
+    ("remove", ["-r", "no such product", "user@example.com"], 60),
+]
+# importing what -i and -u need, for comparison (no budget: they are
+# dominated by the network anyway)
+UPDATE_IMPORTS = "import engine, fetch, notify, proxies, sites, useragents"
+
+
+def import_times(stderr: str) -> tuple:
+    """
+    Parse `-X importtime` output: return (milliseconds spent importing
+    modules after interpreter startup, names of the modules imported)
+    """
+    total = 0
+    modules = set()
+    started = False
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not started:
+            # interpreter startup ends with the import of site
+            started = name.strip() == "site"
+            continue
+        if cumulative.strip().isdigit():
+            modules.add(name.strip().split(".")[0])
+            if not name.startswith("  "):  # top level import
+                total += int(cumulative)
+    return total / 1000, modules
+
+
+def measure(arguments: list, home: str, runs: int) -> tuple:
+    """
+    Return (best import time, best wall time, heavy modules loaded) over
+    <runs> runs of <arguments>
+    """
+    imports = wall = float("inf")
+    heavy = set()
+    for _ in range(runs):
+        begin = perf_counter()
+        process = run(
+            [executable, "-X", "importtime", *arguments],
+            env={**environ, "HOME": home},
+            input="n\n",
+            capture_output=True,
+            text=True,
+            cwd=join(ROOT, "src"),
+        )
+        wall = min(wall, perf_counter() - begin)
+        import_ms, modules = import_times(process.stderr)
+        imports = min(imports, import_ms)
+        heavy |= modules.intersection(HEAVY)
+    return imports, wall * 1000, heavy
+
+
+def main() -> None:
+    argparser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    argparser.add_argument("--runs", type=int, default=RUNS)
+    argparser.add_argument(
+        "--scale",
+        type=float,
+        default=1,
+        help="multiply every budget (e.g. on slow machines)",
+    )
+    args = argparser.parse_args()
+    over_budget = []
+    print(
+        f"{'subcommand':>10} | {'imports':>10} | {'budget':>8} | "
+        f"{'wall':>10} | heavy modules"
+    )
+    with TemporaryDirectory() as home:
+        # the data directory is created under an existing ~/.local/share
+        makedirs(join(home, ".local", "share"))
+        for name, arguments, budget in SUBCOMMANDS:
+            budget *= args.scale
+            imports, wall, heavy = measure([MAIN, *arguments], home, args.runs)
+            if imports > budget or len(heavy) > 0:
+                over_budget.append(name)
+            print(
+                f"{name:>10} | {imports:>7.1f} ms | {budget:>5.0f} ms | "
+                f"{wall:>7.1f} ms | {', '.join(sorted(heavy)) or '-'}"
+            )
+        imports, wall, heavy = measure(
+            ["-c", UPDATE_IMPORTS], home, args.runs
+        )
+        print(
+            f"{'-i / -u':>10} | {imports:>7.1f} ms | {'-':>8} | "
+            f"{wall:>7.1f} ms | {', '.join(sorted(heavy)) or '-'}"
+        )
+    if len(over_budget) > 0:
+        sys_exit(f"over budget: {', '.join(over_budget)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+Benchmark write latency against product count: rewriting the whole
+product_list.json (as every insert, remove and update used to do, here
+through an atomic temp file + rename) versus the incremental writes of the
+SQLite product store; and lookup latency of title search (trigram index
+versus table scan) and of the products followed by a mail address.
+
+usage: bench_store.py [--sizes <n> ...] [--days <n>]
+"""
+
+from argparse import ArgumentParser
+from json import dumps as json_dumps
+from os.path import dirname, join, realpath
+from sys import path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+ROOT = join(dirname(realpath(__file__)), "..")
+path.insert(0, join(ROOT, "src"))
+
+from store import Store  # noqa: E402
+from utils.files import write_atomic  # noqa: E402
+
+RUNS = 5
+
+
+def synthetic_products(count: int, days: int) -> list:
+    return [
+        {
+            "url": f"https://www.amazon.it/dp/B{index:09d}",
+            "title": f"Synthetic product {index}",
+            "followers": [f"user{index % 50}@example.com"],
+            "prices": [
+                {
+                    "date": f"2021-{1 + day // 28:02d}-{1 + day % 28:02d}",
+                    "price": 100.0 + day % 7,
+                }
+                for day in range(days)
+            ],
+        }
+        for index in range(count)
+    ]
+
+
+def best_of(function) -> float:
+    timings = []
+    for _ in range(RUNS):
+        begin = perf_counter()
+        function()
+        timings.append(perf_counter() - begin)
+    return min(timings)
+
+
+def main() -> None:
+    argparser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    argparser.add_argument(
+        "--sizes", type=int, nargs="+", default=[100, 1000, 10000]
+    )
+    argparser.add_argument("--days", type=int, default=30)
+    args = argparser.parse_args()
+    lookups = []
+    print(
+        f"{'products':>9} | {'json rewrite':>12} | {'store price':>11} | "
+        f"{'store insert':>12} | {'store remove':>12} | {'store load':>10}"
+    )
+    for size in args.sizes:
+        products = synthetic_products(size, args.days)
+        with TemporaryDirectory() as tmp_dir:
+            list_file = join(tmp_dir, "product_list.json")
+            json_write = best_of(
+                lambda: write_atomic(list_file, json_dumps(products, indent=2))
+            )
+            store = Store(join(tmp_dir, "products.db"))
+            with store.db:
+                for product in products:
+                    store.add_product(product)
+            counter = iter(range(10**9))
+            price_write = best_of(
+                lambda: store.add_price(
+                    size // 2, f"2022-01-{1 + next(counter) % 28:02d}", 99.0
+                )
+            )
+            new_products = iter(synthetic_products(size + RUNS, 1)[size:])
+            insert = best_of(lambda: store.add_product(next(new_products)))
+            ids = iter(range(1, size + 1))
+            remove = best_of(lambda: store.remove_product(next(ids)))
+            load = best_of(store.products)
+            substr = f"product {size // 3}"
+            search = best_of(lambda: store.search(substr))
+            store.indexed_titles = False
+            search_scan = best_of(lambda: store.search(substr))
+            followed = best_of(lambda: store.followed("user7@example.com"))
+            lookups.append((size, search_scan, search, followed))
+            store.close()
+        print(
+            f"{size:>9} | {json_write * 1000:>9.2f} ms | "
+            f"{price_write * 1000:>8.2f} ms | {insert * 1000:>9.2f} ms | "
+            f"{remove * 1000:>9.2f} ms | {load * 1000:>7.2f} ms"
+        )
+    print(
+        f"\n{'products':>9} | {'search scan':>11} | {'search index':>12} | "
+        f"{'followed':>9}"
+    )
+    for size, search_scan, search, followed in lookups:
+        print(
+            f"{size:>9} | {search_scan * 1000:>8.2f} ms | "
+            f"{search * 1000:>9.2f} ms | {followed * 1000:>6.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
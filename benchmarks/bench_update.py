@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+Benchmark the daily update end to end (traker -u, i.e. main.update_prices)
+over synthetic product lists of growing size, against local stand-ins of
+every third-party service (see standins.py): product pages of every site in
+sites.json, the proxy list API, httpbin.org/ip, good, slow, flaky, blocked
+and dead proxies, and the SMTP server (smtp_sink.py).
+Every size runs in a fresh process with its own temporary data directory;
+throughput, fetch latency percentiles and peak RSS of every run are written
+to a json file (benchmarks/results/update-<commit>.json by default), which
+can be compared with the one of another commit (--compare).
+
+usage: bench_update.py [--sizes <n> ...] [--workers <n>] [--parsers <n>]
+                       [--site-limit <n>] [--latency <s>]
+                       [--fail-rate <r>] [--block-rate <r>]
+                       [--output <file>] [--compare <file>]
+"""
+
+from argparse import ArgumentParser
+from datetime import date, datetime, timedelta
+from itertools import chain
+from json import dumps as json_dumps
+from json import loads as json_loads
+from os import cpu_count, environ, makedirs
+from os.path import dirname, isfile, join, realpath
+from platform import python_version
+from socket import socket
+from subprocess import DEVNULL, PIPE, run
+from sys import executable, exit, path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+ROOT = join(dirname(realpath(__file__)), "..")
+path.insert(0, join(ROOT, "src"))
+
+from engine import (  # noqa: E402
+    DEFAULT_PARSERS,
+    DEFAULT_SITE_LIMIT,
+    DEFAULT_WORKERS,
+)
+from smtp_sink import SMTPSink  # noqa: E402
+from standins import (  # noqa: E402
+    HTTPBin,
+    ProxyAPI,
+    ProxyServer,
+    SiteServer,
+)
+
+SIZES = (10, 100, 1000, 10000)
+FOLLOWERS = 50  # distinct followers, i.e. notification mails at most
+RESULTS_DIR = join(ROOT, "benchmarks", "results")
+# compared between runs (higher is better for throughput only)
+FIGURES = ("throughput", "p50", "p90", "p99", "peak_rss", "children_rss")
+
+
+def percentile(values: list, percent: float) -> float:
+    """
+    Nearest rank percentile of <values>, 0 if empty
+    """
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    rank = max(round(percent / 100 * len(values)) - 1, 0)
+    return values[rank]
+
+
+def dead_address() -> str:
+    """
+    Return a local address nobody listens to
+    """
+    with socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return "127.0.0.1:{}".format(sock.getsockname()[1])
+
+
+def product_url(sites: list, index: int) -> str:
+    # urls of the real sites' shape, served by the SiteServer whatever the
+    # host (plain http: the proxy stand-ins don't tunnel https)
+    return f"http://www.{sites[index % len(sites)]}.it/dp/{index}"
+
+
+def child(args) -> None:
+    """
+    Fill the store of the data directory in <args.home> and time one
+    update_prices run, writing the figures to <args.result>
+    """
+    from resource import RUSAGE_CHILDREN, RUSAGE_SELF, getrusage
+
+    # main reads the data directory from HOME when imported
+    environ["HOME"] = args.home
+    import main
+    import proxies
+
+    proxies.PROXY_LIST_API_URL = args.api
+    proxies.PROXY_CHECK_URL = args.httpbin
+    store = main.get_store()
+    today = main.get_date()
+    yesterday = str(date.fromisoformat(today) - timedelta(days=1))
+    with store.batch():
+        for index in range(args.size):
+            url = product_url(args.sites, index)
+            # yesterday's price as served on day 0 (today is day 1)
+            price = main.get_sites().get(url).parse_price(
+                SiteServer.price(index, day=0)
+            )
+            store.add_product(
+                {
+                    "url": url,
+                    "title": f"Product {index}",
+                    "followers": [f"user{index % FOLLOWERS}@example.com"],
+                    "prices": [{"date": yesterday, "price": price}],
+                }
+            )
+    latencies = []
+    failures = 0
+    fetch_page = main.fetch_page
+
+    def timed_fetch_page(proxies, product: dict, spent=None) -> tuple:
+        nonlocal failures
+        begin = perf_counter()
+        try:
+            result = fetch_page(proxies=proxies, product=product, spent=spent)
+        except Exception:
+            failures += 1
+            raise
+        latencies.append(perf_counter() - begin)
+        return result
+
+    main.fetch_page = timed_fetch_page
+    begin = perf_counter()
+    try:
+        main.update_prices(
+            workers=args.workers,
+            parsers=args.parsers,
+            site_limit=args.site_limit,
+        )
+    except SystemExit:
+        pass  # update_prices exits when there's nothing to notify
+    elapsed = perf_counter() - begin
+    updated = sum(
+        product["prices"][-1]["date"] == today
+        for product in store.products()
+    )
+    result = {
+        "size": args.size,
+        "seconds": round(elapsed, 3),
+        "updated": updated,
+        "fetches": len(latencies),
+        "failed_fetches": failures,
+        "throughput": round(args.size / elapsed, 2),
+        # seconds per fetch, proxy attempts included
+        "p50": round(percentile(latencies, 50), 4),
+        "p90": round(percentile(latencies, 90), 4),
+        "p99": round(percentile(latencies, 99), 4),
+        "max": round(max(latencies, default=0), 4),
+        # bytes (ru_maxrss is in KiB on Linux)
+        "peak_rss": getrusage(RUSAGE_SELF).ru_maxrss * 1024,
+        "children_rss": getrusage(RUSAGE_CHILDREN).ru_maxrss * 1024,
+    }
+    with open(args.result, "w") as result_file:
+        result_file.write(json_dumps(result))
+
+
+def proxy_requests(services: dict) -> dict:
+    """
+    Return the requests served so far by the site and by each kind of proxy
+    """
+    requests = {"site": services["site"].requests}
+    for kind, proxies in services["proxies"].items():
+        requests[kind] = sum(proxy.requests for proxy in proxies)
+    return requests
+
+
+def run_size(args, size: int, services: dict, sink: SMTPSink) -> dict:
+    """
+    Run the update of <size> products in a fresh process and data
+    directory, returning its figures
+    """
+    with TemporaryDirectory() as home:
+        makedirs(join(home, ".local", "share", "price-traker"))
+        makedirs(join(home, ".config", "price-traker"))
+        with open(join(home, ".config", "price-traker", "config"), "w") as f:
+            f.write(
+                "[mail]\n"
+                "smtp_server = 127.0.0.1\n"
+                f"port = {sink.port}\n"
+                "notifier_addr = notifier@example.com\n"
+                "notifier_psw = password\n"
+                "ssl = no\n"
+                "connections = 2\n"
+            )
+        result_file = join(home, "result.json")
+        messages = len(sink.messages)
+        requests = proxy_requests(services)
+        command = [
+            executable,
+            realpath(__file__),
+            "--child",
+            "--home",
+            home,
+            "--result",
+            result_file,
+            "--size",
+            str(size),
+            "--api",
+            services["api"].url,
+            "--httpbin",
+            f"http://{services['httpbin'].address}/ip",
+            "--workers",
+            str(args.workers),
+            "--parsers",
+            str(args.parsers),
+            "--site-limit",
+            str(args.site_limit),
+            "--sites",
+            *args.sites,
+        ]
+        # the tool's own output is discarded, errors are shown
+        process = run(command, stdout=DEVNULL, stderr=PIPE, text=True)
+        if not isfile(result_file):
+            exit(f"ERROR: run of {size} products failed\n{process.stderr}")
+        with open(result_file, "r") as f:
+            result = json_loads(f.read())
+    # requests served during the run (proxy validation included)
+    result["requests"] = {
+        name: count - requests[name]
+        for name, count in proxy_requests(services).items()
+    }
+    result["notifications"] = len(sink.messages) - messages
+    return result
+
+
+def git_commit() -> str:
+    process = run(
+        ["git", "rev-parse", "--short", "HEAD"],
+        cwd=ROOT,
+        stdout=PIPE,
+        stderr=DEVNULL,
+        text=True,
+    )
+    commit = process.stdout.strip() or "unknown"
+    dirty = run(
+        ["git", "status", "--porcelain", "--untracked-files=no"],
+        cwd=ROOT,
+        stdout=PIPE,
+        stderr=DEVNULL,
+        text=True,
+    ).stdout.strip()
+    return f"{commit}-dirty" if dirty else commit
+
+
+def compare(results: dict, previous_file: str) -> None:
+    with open(previous_file, "r") as f:
+        previous = json_loads(f.read())
+    before = {entry["size"]: entry for entry in previous["runs"]}
+    print(f"\ncompared with {previous['commit']} ({previous_file}):")
+    for entry in results["runs"]:
+        old = before.get(entry["size"])
+        if old is None:
+            continue
+        changes = []
+        for figure in FIGURES:
+            if old[figure]:
+                change = (entry[figure] - old[figure]) / old[figure] * 100
+                changes.append(f"{figure} {change:+.0f}%")
+        print(f"{entry['size']:>6} products: {', '.join(changes)}")
+
+
+def main() -> None:
+    argparser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    argparser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    argparser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    argparser.add_argument("--parsers", type=int, default=DEFAULT_PARSERS)
+    argparser.add_argument(
+        "--site-limit", type=int, default=DEFAULT_SITE_LIMIT
+    )
+    argparser.add_argument(
+        "--latency",
+        type=float,
+        default=0.2,
+        help="seconds added by the slow proxies (default: 0.2)",
+    )
+    argparser.add_argument(
+        "--fail-rate",
+        type=float,
+        default=0.3,
+        help="connections dropped by the flaky proxies (default: 0.3)",
+    )
+    argparser.add_argument(
+        "--block-rate",
+        type=float,
+        default=0.3,
+        help="captcha pages served by the blocked proxies (default: 0.3)",
+    )
+    argparser.add_argument("--output", help="results file")
+    argparser.add_argument("--compare", help="results file to compare with")
+    # run of a single size (in a fresh process)
+    argparser.add_argument("--child", action="store_true")
+    argparser.add_argument("--home")
+    argparser.add_argument("--result")
+    argparser.add_argument("--size", type=int)
+    argparser.add_argument("--api")
+    argparser.add_argument("--httpbin")
+    argparser.add_argument("--sites", nargs="+")
+    args = argparser.parse_args()
+    if args.child:
+        child(args)
+        return
+    with open(join(ROOT, "sites.json"), "r") as sites_file:
+        sites = json_loads(sites_file.read())
+    args.sites = [
+        opts.get("domains", [name])[0] for name, opts in sites.items()
+    ]
+    site = SiteServer(sites, blocks=1000, day=1).start()
+    upstream = site.address
+    # proxies by kind
+    proxies = {
+        "good": [ProxyServer(upstream, seed=seed) for seed in range(6)],
+        "slow": [
+            ProxyServer(upstream, latency=args.latency) for _ in range(2)
+        ],
+        "flaky": [
+            ProxyServer(upstream, fail_rate=args.fail_rate, seed=seed)
+            for seed in range(2)
+        ],
+        "blocked": [
+            ProxyServer(upstream, block_rate=args.block_rate, seed=seed)
+            for seed in range(2)
+        ],
+    }
+    addresses = [dead_address() for _ in range(2)]
+    for proxy in chain(*proxies.values()):
+        addresses.append(proxy.start().address)
+    services = {
+        "site": site,
+        "httpbin": HTTPBin().start(),
+        "api": ProxyAPI(addresses).start(),
+        "proxies": proxies,
+    }
+    sink = SMTPSink().start()
+    commit = git_commit()
+    results = {
+        "commit": commit,
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": python_version(),
+        "cpus": cpu_count(),
+        "settings": {
+            "workers": args.workers,
+            "parsers": args.parsers,
+            "site_limit": args.site_limit,
+            "latency": args.latency,
+            "fail_rate": args.fail_rate,
+            "block_rate": args.block_rate,
+            "proxies": len(addresses),
+        },
+        "runs": [],
+    }
+    try:
+        for size in args.sizes:
+            result = run_size(args, size, services, sink)
+            results["runs"].append(result)
+            print(
+                f"{size:>6} products: {result['seconds']:8.2f}s "
+                f"({result['throughput']:7.2f} products/s), "
+                f"{result['updated']} updated, "
+                f"{result['notifications']} notifications, fetch "
+                f"p50/p90/p99 {result['p50'] * 1000:.0f}/"
+                f"{result['p90'] * 1000:.0f}/{result['p99'] * 1000:.0f} ms, "
+                f"peak rss {result['peak_rss'] / 2**20:.0f} MiB "
+                f"(parsers {result['children_rss'] / 2**20:.0f} MiB)"
+            )
+    finally:
+        for service in ("site", "httpbin", "api"):
+            services[service].stop()
+        for proxy in chain(*proxies.values()):
+            proxy.stop()
+        sink.stop()
+    output = args.output or join(RESULTS_DIR, f"update-{commit}.json")
+    makedirs(dirname(realpath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        f.write(json_dumps(results, indent=2))
+    print(f"results written to {output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+# coding=utf-8
+"""
+Pages used by the benchmarks: pages saved from the real sites are looked up
+in benchmarks/pages/<site>.html, synthetic ones are generated otherwise
+"""
+
+from os.path import dirname, isfile, join, realpath
+
+PAGES_DIR = join(dirname(realpath(__file__)), "pages")
+FILLER = (
+    '<div class="a-section a-spacing-small"><span class="a-text">'
+    "lorem ipsum dolor sit amet</span><a href='/x'>link</a>"
+    "<script>var x = {'a': 1, 'b': [1, 2, 3]};</script></div>\n"
+)
+
+
+def synthetic_page(
+    selectors: dict,
+    title: str = "Synthetic product title",
+    price: str = "1.299,00€",
+    blocks: int = 4000,
+) -> str:
+    """
+    Return a product page of several hundred KiB for a site with the given
+    title/price <selectors>, with title and price in the first part of the
+    page as on the real ones
+    """
+    head = FILLER * (blocks // 5)
+    tail = FILLER * (blocks - blocks // 5)
+    title_selector = selectors["title"]
+    price_selector = selectors["price"]
+    return (
+        "<html><head><title>Product</title></head><body>"
+        f"{head}"
+        f'<h1 id="{title_selector}" class="{title_selector}">  {title}  </h1>'
+        f'<div class="price-box"><span id="{price_selector}" '
+        f'class="{price_selector}">{price}</span></div>'
+        f"{tail}</body></html>"
+    )
+
+
+def saved_page(site: str):
+    """
+    Return the page saved for <site>, None if there isn't any
+    """
+    page_file = join(PAGES_DIR, f"{site}.html")
+    if not isfile(page_file):
+        return None
+    with open(page_file, "r", encoding="utf-8") as page:
+        return page.read()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+Local SMTP stand-in: accepts (and counts) every message, without delivering
+it. Logins are always accepted; <login_delay> simulates the cost of the TLS
+handshake and authentication of a real server, <drop_rate> the chance of
+dropping the connection instead of accepting a message.
+
+usage: smtp_sink.py [--port <n>] [--login-delay <s>] [--drop-rate <r>]
+"""
+
+from argparse import ArgumentParser
+from random import random
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+from threading import Lock, Thread
+from time import sleep
+
+
+class SMTPSink(ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(
+        self,
+        port: int = 0,
+        login_delay: float = 0,
+        drop_rate: float = 0,
+        refused: set = frozenset(),
+    ):
+        super().__init__(("127.0.0.1", port), SMTPHandler)
+        self.login_delay = login_delay
+        self.drop_rate = drop_rate
+        self.refused = refused
+        self.lock = Lock()
+        self.connections = 0
+        self.logins = 0
+        self.messages = []  # (recipients, data) of every accepted message
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def start(self) -> "SMTPSink":
+        Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class SMTPHandler(StreamRequestHandler):
+    def reply(self, line: str) -> None:
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self) -> None:
+        sink = self.server
+        with sink.lock:
+            sink.connections += 1
+        recipients = []
+        self.reply("220 localhost smtp sink ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors="replace").strip()
+            verb = command.split(" ")[0].upper()
+            if verb in ("EHLO", "HELO"):
+                self.reply("250-localhost")
+                self.reply("250-AUTH PLAIN LOGIN")
+                self.reply("250 8BITMIME")
+            elif verb == "AUTH":
+                sleep(sink.login_delay)
+                with sink.lock:
+                    sink.logins += 1
+                self.reply("235 authentication successful")
+            elif verb == "MAIL":
+                recipients = []
+                self.reply("250 ok")
+            elif verb == "RCPT":
+                recipient = command.split(":", 1)[1].strip(" <>")
+                if recipient in sink.refused:
+                    self.reply("550 no such user")
+                    continue
+                recipients.append(recipient)
+                self.reply("250 ok")
+            elif verb == "DATA":
+                self.reply("354 end data with <CR><LF>.<CR><LF>")
+                data = []
+                for data_line in self.rfile:
+                    if data_line in (b".\r\n", b".\n"):
+                        break
+                    data.append(data_line)
+                if random() < sink.drop_rate:
+                    return  # drop the connection without accepting
+                with sink.lock:
+                    sink.messages.append((recipients, b"".join(data)))
+                self.reply("250 ok: queued")
+            elif verb in ("RSET", "NOOP"):
+                self.reply("250 ok")
+            elif verb == "QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("502 command not implemented")
+
+
+def main() -> None:
+    argparser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    argparser.add_argument("--port", type=int, default=2525)
+    argparser.add_argument("--login-delay", type=float, default=0)
+    argparser.add_argument("--drop-rate", type=float, default=0)
+    args = argparser.parse_args()
+    sink = SMTPSink(
+        port=args.port, login_delay=args.login_delay, drop_rate=args.drop_rate
+    )
+    print(f"SMTP sink listening on 127.0.0.1:{sink.port}")
+    try:
+        sink.serve_forever()
+    except KeyboardInterrupt:
+        print(f"{len(sink.messages)} messages received")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+# coding=utf-8
+"""
+Local stand-ins for the third-party services the tool talks to, so that the
+benchmarks run end to end without any network access:
+- SiteServer: product pages of every site in sites.json;
+- ProxyServer: forward proxies (plain http only), optionally slow, flaky
+  (dropped connections) or blocked (answering with a captcha page);
+- HTTPBin: httpbin.org/ip, used to validate proxies;
+- ProxyAPI: the geonode proxy list API, listing the local proxies;
+- SMTPSink (see smtp_sink.py): the mail server.
+Product urls look like the real ones (e.g. http://www.amazon.it/dp/42):
+requests go through the local proxies, which forward every url not on
+127.0.0.1 to the SiteServer, whatever its host.
+"""
+
+from gzip import compress
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps as json_dumps
+from random import Random
+from re import search
+from threading import Lock, Thread
+from time import sleep
+from urllib.parse import parse_qs, urlparse
+
+from pages import synthetic_page
+
+TITLE = "@@TITLE@@"
+PRICE = "@@PRICE@@"
+CAPTCHA = (
+    "<html><head><title>Robot Check</title></head><body>"
+    "<p>Type the characters you see in this image</p></body></html>"
+)
+
+
+class StandIn(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, handler: type):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.lock = Lock()
+        self.requests = 0
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    @property
+    def address(self) -> str:
+        return f"127.0.0.1:{self.port}"
+
+    def count(self) -> None:
+        with self.lock:
+            self.requests += 1
+
+    def start(self) -> "StandIn":
+        Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, as the real servers
+
+    def log_message(self, *args) -> None:
+        pass  # quiet
+
+    def send(self, status: int, body: bytes, headers: dict = None) -> None:
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class SiteServer(StandIn):
+    """
+    Product pages of every site in <sites> (as in sites.json), picked by
+    the labels of the url's host: the page of product <n> (the number the
+    url path ends with, e.g. /dp/42 or /dp/B000000042) has
+    title 'Product <n>' and a price changing with <day> (so that some
+    prices drop from one day to the next). Pages are ~<blocks> * 200 bytes,
+    gzipped when the client accepts it.
+    """
+
+    def __init__(self, sites: dict, blocks: int = 1000, day: int = 0):
+        super().__init__(SiteHandler)
+        self.templates = {}  # domain label: page template
+        for name, opts in sites.items():
+            template = synthetic_page(
+                opts, title=TITLE, price=PRICE, blocks=blocks
+            )
+            for label in opts.get("domains", [name]):
+                self.templates[label] = template
+        self.day = day
+
+    @staticmethod
+    def price(product: int, day: int) -> str:
+        cents = 10000 + (product * 7919 + day * 104729) % 9000
+        return f"{cents // 100}.{cents % 100:02d}".replace(".", ",") + "€"
+
+    def page(self, host: str, product: int) -> str:
+        label = next(
+            (label for label in host.split(".") if label in self.templates),
+            None,
+        )
+        if label is None:
+            return None
+        return (
+            self.templates[label]
+            .replace(TITLE, f"Product {product}")
+            .replace(PRICE, self.price(product, self.day))
+        )
+
+
+class SiteHandler(Handler):
+    def do_GET(self) -> None:
+        self.server.count()
+        number = search(r"(\d+)/?$", urlparse(self.path).path)
+        page = None
+        if number is not None:
+            page = self.server.page(
+                self.headers.get("Host", ""), int(number.group(1))
+            )
+        if page is None:
+            self.send(404, b"not found")
+            return
+        body = page.encode()
+        headers = {"Content-Type": "text/html; charset=utf-8"}
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = compress(body, compresslevel=1)
+            headers["Content-Encoding"] = "gzip"
+        self.send(200, body, headers)
+
+
+class ProxyServer(StandIn):
+    """
+    Forward proxy to <upstream> ('<host>:<port>', for every url not on
+    127.0.0.1), adding <latency> seconds to every request; <fail_rate> of
+    the requests get their connection dropped, <block_rate> a captcha page
+    """
+
+    def __init__(
+        self,
+        upstream: str,
+        latency: float = 0,
+        fail_rate: float = 0,
+        block_rate: float = 0,
+        seed: int = 0,
+    ):
+        super().__init__(ProxyHandler)
+        self.upstream = upstream
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.block_rate = block_rate
+        self.random = Random(seed)
+
+    def roll(self) -> float:
+        with self.lock:
+            return self.random.random()
+
+
+class ProxyHandler(Handler):
+    def do_GET(self) -> None:
+        proxy = self.server
+        proxy.count()
+        sleep(proxy.latency)
+        roll = proxy.roll()
+        if roll < proxy.fail_rate:
+            self.close_connection = True
+            self.connection.close()
+            return
+        if roll < proxy.fail_rate + proxy.block_rate:
+            self.send(200, CAPTCHA.encode(), {"Content-Type": "text/html"})
+            return
+        url = urlparse(self.path)
+        upstream = url.netloc if url.hostname == "127.0.0.1" else None
+        connection = HTTPConnection(upstream or proxy.upstream, timeout=30)
+        headers = {
+            name: value
+            for name, value in self.headers.items()
+            if name.lower() not in ("proxy-connection", "connection")
+        }
+        try:
+            path = url.path + (f"?{url.query}" if url.query else "")
+            connection.request("GET", path, headers=headers)
+            response = connection.getresponse()
+            body = response.read()
+        except OSError:
+            self.send(502, b"bad gateway")
+            return
+        finally:
+            connection.close()
+        passed = ("content-type", "content-encoding", "etag", "last-modified")
+        self.send(
+            response.status,
+            body,
+            {
+                name: value
+                for name, value in response.getheaders()
+                if name.lower() in passed
+            },
+        )
+
+
+class HTTPBin(StandIn):
+    """
+    httpbin.org/ip: {'origin': <ip of the client>}
+    """
+
+    def __init__(self):
+        super().__init__(HTTPBinHandler)
+
+
+class HTTPBinHandler(Handler):
+    def do_GET(self) -> None:
+        self.server.count()
+        body = json_dumps({"origin": self.client_address[0]}).encode()
+        self.send(200, body, {"Content-Type": "application/json"})
+
+
+class ProxyAPI(StandIn):
+    """
+    The geonode proxy list API, paging through <proxies> ('<ip>:<port>')
+    """
+
+    URL = (
+        "http://127.0.0.1:{port}/api/proxy-list?"
+        "limit={{limit}}&page={{page}}&sort_by=lastChecked&sort_type=desc"
+    )
+
+    def __init__(self, proxies: list):
+        super().__init__(ProxyAPIHandler)
+        self.proxies = proxies
+
+    @property
+    def url(self) -> str:
+        """
+        Stand-in for proxies.PROXY_LIST_API_URL
+        """
+        return self.URL.format(port=self.port)
+
+
+class ProxyAPIHandler(Handler):
+    def do_GET(self) -> None:
+        self.server.count()
+        query = parse_qs(urlparse(self.path).query)
+        limit = int(query.get("limit", ["50"])[0])
+        page = int(query.get("page", ["1"])[0])
+        proxies = self.server.proxies[(page - 1) * limit : page * limit]
+        body = json_dumps(
+            {
+                "data": [
+                    {"ip": ip, "port": port}
+                    for ip, _, port in (p.partition(":") for p in proxies)
+                ],
+                "total": len(self.server.proxies),
+            }
+        ).encode()
+        self.send(200, body, {"Content-Type": "application/json"})
+
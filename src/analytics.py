@@ -0,0 +1,216 @@
+# coding=utf-8
+
+from datetime import date, timedelta
+from typing import NamedTuple, Optional
+
+from store import HISTORY, Store
+
+
+WINDOW = 30  # days of the rolling figures
+PERCENTILE = 20  # rolling percentile, a "good price" for the product
+RULES = (
+    "'drop' (any price drop, default), 'drop:<percent>' (drop of at least "
+    "<percent>%), 'low' (all-time low), 'low:<days>' (lowest price in "
+    "<days> days)"
+)
+# every figure is computed for every product at once, by window functions
+# over the whole price history (daily and rolled up prices)
+STATS = """
+WITH history AS (
+    SELECT product_id, julianday(date) AS day, price, low
+    FROM ({history}) WHERE date < :before
+), rolling AS (
+    SELECT
+        product_id,
+        day,
+        price,
+        lag(price) OVER (PARTITION BY product_id ORDER BY day) AS previous,
+        min(low) OVER (PARTITION BY product_id) AS low,
+        min(low) OVER recent AS window_low,
+        avg(price) OVER recent AS window_mean,
+        row_number() OVER (
+            PARTITION BY product_id ORDER BY day DESC
+        ) AS age
+    FROM history
+    WINDOW recent AS (
+        PARTITION BY product_id ORDER BY day
+        RANGE BETWEEN {window} PRECEDING AND CURRENT ROW
+    )
+), latest AS (
+    SELECT * FROM rolling WHERE age = 1
+), ranked AS (
+    SELECT
+        history.product_id,
+        history.price,
+        row_number() OVER (
+            PARTITION BY history.product_id ORDER BY history.price
+        ) AS rank,
+        count(*) OVER (PARTITION BY history.product_id) AS points
+    FROM history JOIN latest USING (product_id)
+    WHERE history.day >= latest.day - {window}
+), percentile AS (
+    -- nearest rank
+    SELECT product_id, min(price) AS price FROM ranked
+    WHERE rank >= :percentile / 100.0 * points GROUP BY product_id
+)
+SELECT
+    latest.product_id,
+    latest.price,
+    latest.previous,
+    latest.low,
+    latest.window_low,
+    latest.window_mean,
+    percentile.price
+FROM latest JOIN percentile USING (product_id)
+"""
+# standard deviation of the daily prices relative to their mean, one pass
+# in primary key order (no window function, no sorting)
+VOLATILITY = """
+SELECT
+    product_id,
+    sqrt(max(avg(price * price) - avg(price) * avg(price), 0)) / avg(price)
+FROM prices WHERE date >= :since AND date < :before
+GROUP BY product_id HAVING avg(price) > 0
+"""
+
+
+class PriceStats(NamedTuple):
+    price: float  # last price
+    previous: Optional[float]  # price before the last one
+    low: float  # all-time low
+    window_low: float  # lowest price in the rolling window
+    window_mean: float
+    window_percentile: float
+
+    @property
+    def change(self) -> Optional[float]:
+        """
+        Percentage change of the last price from the previous one
+        """
+        if not self.previous or self.price is None:
+            return None
+        return (self.price - self.previous) / self.previous * 100
+
+
+def price_stats(
+    store: Store,
+    before: str = "9999-12-31",
+    window: int = WINDOW,
+    percentile: float = PERCENTILE,
+    product_ids: list = None,
+) -> dict:
+    """
+    Return {product_id: PriceStats} of the prices before <before>
+    ('YYYY-MM-DD'), rolling figures covering the <window> days up to the
+    last price, for <product_ids> (every product if None) in one query
+    """
+    where = ""
+    if product_ids is not None:
+        if len(product_ids) == 0:
+            return {}
+        where = f"WHERE product_id IN ({','.join(map(str, product_ids))})"
+    query = STATS.format(history=HISTORY.format(where=where), window=window)
+    return {
+        row[0]: PriceStats(*row[1:])
+        for row in store.db.execute(
+            query, {"before": before, "percentile": percentile}
+        )
+    }
+
+
+def price_volatility(
+    store: Store, before: str = "9999-12-31", window: int = WINDOW
+) -> dict:
+    """
+    Return {product_id: volatility} of every product with daily prices in
+    the <window> days before <before> ('YYYY-MM-DD'): the standard deviation
+    of those prices relative to their mean (0 for a steady price)
+    """
+    since = str(date.fromisoformat(before) - timedelta(days=window))
+    return dict(
+        store.db.execute(VOLATILITY, {"since": since, "before": before})
+    )
+
+
+def parse_rule(rule: str) -> str:
+    """
+    Check the notification <rule> (see RULES), returning it normalized;
+    raise ValueError if invalid
+    """
+    kind, _, value = rule.strip().lower().partition(":")
+    if kind not in ("drop", "low"):
+        raise ValueError(f"'{rule}' is not a valid rule: use {RULES}")
+    if value == "":
+        return kind
+    try:
+        number = float(value.rstrip("%d"))
+    except ValueError:
+        raise ValueError(f"'{rule}' is not a valid rule: use {RULES}")
+    if kind == "low":
+        number = int(number)  # whole days
+    if number <= 0:
+        raise ValueError(f"'{rule}' is not a valid rule: use {RULES}")
+    return f"{kind}:{number:g}"
+
+
+class Thresholds:
+    """
+    Followers' notification rules (see RULES) of a batch of <products>,
+    checked against the figures of their price history before <before>:
+    the figures are computed for the whole batch at once, by one query per
+    rolling window in use. A price already stored on <before> (by an
+    earlier update of the same day, e.g. by the daemon) counts as part of
+    the history, so that a new low is notified once
+    """
+
+    def __init__(self, store: Store, products: list, before: str):
+        product_ids = [product["id"] for product in products]
+        windows = {WINDOW}
+        for product in products:
+            for rule in product.get("rules", {}).values():
+                kind, _, value = rule.partition(":")
+                if kind == "low" and value != "":
+                    windows.add(int(value))
+        self.stats = {
+            window: price_stats(
+                store, before=before, window=window, product_ids=product_ids
+            )
+            for window in windows
+        }
+        self.stored = dict(
+            store.db.execute(
+                "SELECT product_id, price FROM prices "
+                "WHERE date = ? AND price IS NOT NULL AND product_id IN "
+                f"({','.join(map(str, product_ids))})",
+                (before,),
+            )
+        )
+
+    def get(self, product_id: int, window: int = WINDOW) -> PriceStats:
+        return self.stats[window].get(product_id)
+
+    def notify(
+        self, product: dict, follower: str, price: float, previous: float
+    ) -> bool:
+        """
+        Tell whether <follower> of <product> is to be notified of the new
+        <price>, following the <previous> one
+        """
+        rule = product.get("rules", {}).get(follower) or "drop"
+        kind, _, value = rule.partition(":")
+        if kind == "drop":
+            if value == "":
+                return price < previous
+            return previous - price >= previous * float(value) / 100
+        stats = self.get(product["id"], int(value) if value else WINDOW)
+        if stats is None:
+            return False  # no history to compare with
+        lows = [
+            low
+            for low in (
+                stats.low if value == "" else stats.window_low,
+                self.stored.get(product["id"]),
+            )
+            if low is not None  # null prices imported by --migrate
+        ]
+        return len(lows) > 0 and price < min(lows)
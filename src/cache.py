@@ -0,0 +1,166 @@
+# coding=utf-8
+
+import sqlite3
+from hashlib import sha256
+from threading import Lock
+from time import time
+from typing import Iterator, Optional
+from zlib import compress, decompress
+
+BUSY_TIMEOUT = 30
+COMPRESSION_LEVEL = 6
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT PRIMARY KEY,
+    data BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blobs_used ON blobs (used);
+CREATE TABLE IF NOT EXISTS pages (
+    url TEXT NOT NULL,
+    date TEXT NOT NULL,
+    hash TEXT NOT NULL REFERENCES blobs (hash) ON DELETE CASCADE,
+    PRIMARY KEY (url, date)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS pages_hash ON pages (hash);
+"""
+
+
+class PageCache:
+    """
+    Raw pages fetched from the sites, kept in an SQLite file apart from the
+    product store (so that it can be deleted at any time) to parse them
+    again without any network access (see main.replay_prices).
+    Pages are content addressed: each one is compressed and stored once,
+    under the hash of its text, however many (url, date) pairs it was
+    fetched for; the last page fetched for a url on a given date replaces
+    the previous ones. When the compressed pages take more than <max_bytes>
+    the least recently used ones are evicted.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.db = sqlite3.connect(
+            path, timeout=BUSY_TIMEOUT, check_same_thread=False
+        )
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.executescript(SCHEMA)
+        (self.size,) = self.db.execute(
+            "SELECT coalesce(sum(size), 0) FROM blobs"
+        ).fetchone()
+        self.stored = 0  # pages stored by this run
+        self.evicted = 0  # pages evicted by this run
+
+    def close(self) -> None:
+        self.db.close()
+
+    def put(self, url: str, date: str, page: str) -> None:
+        """
+        Store the <page> fetched for <url> on <date> ('YYYY-MM-DD')
+        """
+        text = page.encode()
+        digest = sha256(text).hexdigest()
+        # compressed outside the lock (zlib releases the GIL)
+        data = compress(text, COMPRESSION_LEVEL)
+        with self.lock, self.db:
+            stored = self.db.execute(
+                "UPDATE blobs SET used = ? WHERE hash = ?", (time(), digest)
+            ).rowcount
+            if stored == 0:
+                self.db.execute(
+                    "INSERT INTO blobs (hash, data, size, used) "
+                    "VALUES (?, ?, ?, ?)",
+                    (digest, data, len(data), time()),
+                )
+                self.size += len(data)
+            self.db.execute(
+                "INSERT OR REPLACE INTO pages (url, date, hash) "
+                "VALUES (?, ?, ?)",
+                (url, date, digest),
+            )
+            self.stored += 1
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self) -> None:
+        # least recently used first, down to 90% of the maximum size so
+        # that eviction doesn't run again at the next put
+        target = self.max_bytes * 0.9
+        evicted = []
+        freed = 0
+        for digest, size in self.db.execute(
+            "SELECT hash, size FROM blobs ORDER BY used"
+        ).fetchall():
+            if self.size - freed <= target:
+                break
+            evicted.append(digest)
+            freed += size
+        hashes = ",".join("?" * len(evicted))
+        (pages,) = self.db.execute(
+            f"SELECT count(*) FROM pages WHERE hash IN ({hashes})", evicted
+        ).fetchone()
+        # pages go along with their blobs (ON DELETE CASCADE)
+        self.db.execute(f"DELETE FROM blobs WHERE hash IN ({hashes})", evicted)
+        self.evicted += pages
+        self.size -= freed
+
+    def get(self, url: str, date: str = "9999-12-31") -> Optional[str]:
+        """
+        Return the last page of <url> fetched on or before <date>, None if
+        not cached
+        """
+        with self.lock, self.db:
+            row = self.db.execute(
+                "SELECT blobs.hash, data FROM pages JOIN blobs USING (hash) "
+                "WHERE url = ? AND date <= ? ORDER BY date DESC LIMIT 1",
+                (url, date),
+            ).fetchone()
+            if row is None:
+                return None
+            self.db.execute(
+                "UPDATE blobs SET used = ? WHERE hash = ?", (time(), row[0])
+            )
+        return decompress(row[1]).decode()
+
+    def pages(
+        self, urls: list = None, since: str = "0000-00-00"
+    ) -> Iterator[tuple]:
+        """
+        Iterate over the (url, date, page) cached since <since> for <urls>
+        (every url if None), by url and date, without marking them as used
+        """
+        where = ""
+        params = [since]
+        if urls is not None:
+            where = f"AND url IN ({','.join('?' * len(urls))})"
+            params += urls
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT url, date, hash FROM pages WHERE date >= ? {where} "
+                "ORDER BY url, date",
+                params,
+            ).fetchall()
+        for url, date, digest in rows:
+            with self.lock:
+                row = self.db.execute(
+                    "SELECT data FROM blobs WHERE hash = ?", (digest,)
+                ).fetchone()
+            if row is not None:  # evicted meanwhile
+                yield url, date, decompress(row[0]).decode()
+
+    def __len__(self) -> int:
+        return self.db.execute("SELECT count(*) FROM pages").fetchone()[0]
+
+    def stats(self) -> str:
+        (blobs,) = self.db.execute("SELECT count(*) FROM blobs").fetchone()
+        return (
+            f"page cache: {len(self)} pages ({blobs} distinct), "
+            f"{self.size / 2**20:.1f}/{self.max_bytes / 2**20:.0f} MiB, "
+            f"{self.stored} stored and {self.evicted} evicted by this run"
+        )
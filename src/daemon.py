@@ -0,0 +1,289 @@
+# coding=utf-8
+
+import logging
+from heapq import heappop, heappush
+from json import dumps as json_dumps
+from json import loads as json_loads
+from os import unlink
+from os.path import exists
+from queue import Empty, Queue
+from socket import AF_UNIX, SOCK_STREAM, socket
+from socket import timeout as socket_timeout
+from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
+from threading import Thread
+from time import time
+from typing import Callable, Optional
+
+
+DEFAULT_INTERVAL = 24 * 3600  # seconds between two updates of a product
+# golden ratio conjugate: the phases of consecutive product ids are spread
+# evenly over the interval, whatever the number of products
+PHASE = 0.6180339887
+BATCH_WINDOW = 60  # products due within this many seconds are batched
+MAX_SLEEP = 600  # seconds between checks of the schedule when idle
+PING_TIMEOUT = 5
+# seconds a command is waited for, including the update in progress
+COMMAND_TIMEOUT = 600
+
+
+class NoReply(Exception):
+    """
+    The daemon didn't reply to a command in time (e.g. still updating): the
+    command is left queued, run once the daemon gets to it
+    """
+
+
+class Daemon:
+    """
+    Long-running update loop: the product index (and whatever <update>
+    keeps between calls, e.g. proxy pool and HTTP sessions) stays warm, and
+    every product is updated on its own 'interval' (<interval> seconds if
+    not set), at its own phase within the interval (see slot), so that the
+    updates are spread evenly over time instead of coming in bursts (e.g.
+    every product last updated by the same cron run), and products due
+    within <batch_window> seconds are updated together through
+    update(products).
+    Commands ({'command': name, ...}) sent to the unix socket at
+    <socket_file> (see send_command) are run by the update loop, one at a
+    time between updates, through handlers[name](command) -> message; the
+    product index is reloaded from load() afterwards.
+    update(products) is expected to check <stopped> and leave the rest of
+    the batch once it's set (see stop), commands still queued then are
+    answered with an error.
+    """
+
+    def __init__(
+        self,
+        socket_file: str,
+        load: Callable[[], list],
+        update: Callable[[list], None],
+        handlers: dict,
+        interval: float = DEFAULT_INTERVAL,
+        batch_window: float = BATCH_WINDOW,
+    ):
+        self.socket_file = socket_file
+        self.load = load
+        self.update = update
+        self.handlers = handlers
+        self.interval = interval
+        self.batch_window = batch_window
+        self.products = {}  # product id: product
+        self.due = {}  # product id: next update time
+        self.schedule = []  # heap of (due, product id), stale entries skipped
+        self.commands = Queue()  # (command, reply queue), None to stop
+        self.stopped = False
+        self.finished = False  # no more commands are run
+        self.server = None
+
+    def interval_of(self, product: dict) -> float:
+        return product.get("interval") or self.interval
+
+    def slot(self, product: dict, after: float) -> float:
+        """
+        Return the first update time of <product> from <after> on: the
+        update times of a product are its interval apart, at a phase given
+        by its id
+        """
+        interval = self.interval_of(product)
+        phase = product["id"] * PHASE % 1 * interval
+        return after + (phase - after) % interval
+
+    def next_update(self, product: dict, checked: Optional[float]) -> float:
+        """
+        Return the update time of <product> following the one at <checked>
+        (None if never updated): its first slot from half an interval after
+        <checked> on, so that updates stay between half and one and a half
+        intervals apart while moving to their phase; overdue products get
+        their next slot
+        """
+        after = time()
+        if checked is not None:
+            after = max(after, checked + self.interval_of(product) / 2)
+        return self.slot(product, after)
+
+    def plan(self, product_id: int, due: float) -> None:
+        self.due[product_id] = due
+        heappush(self.schedule, (due, product_id))
+
+    def sync(self) -> None:
+        """
+        (Re)load the product index, scheduling new products and products
+        whose interval changed; removed products are dropped
+        """
+        products = {product["id"]: product for product in self.load()}
+        now = time()
+        overdue = 0
+        for product_id, product in products.items():
+            known = self.products.get(product_id)
+            if known is not None and product_id in self.due and (
+                self.interval_of(known) == self.interval_of(product)
+            ):
+                # keep the prices merged in memory since the last load
+                product["prices"] = known["prices"] or product["prices"]
+                continue
+            checked = product["checked"]
+            if (checked or 0) + self.interval_of(product) <= now:
+                overdue += 1
+            self.plan(product_id, self.next_update(product, checked))
+        for product_id in set(self.due) - set(products):
+            del self.due[product_id]
+        self.products = products
+        logging.info(f"daemon: {len(products)} products, {overdue} overdue")
+
+    def next_due(self) -> Optional[float]:
+        while len(self.schedule) > 0:
+            due, product_id = self.schedule[0]
+            if self.due.get(product_id) == due:
+                return due
+            heappop(self.schedule)  # stale: rescheduled or removed
+        return None
+
+    def due_products(self) -> list:
+        """
+        Pop the products due within the batch window
+        """
+        batch = []
+        horizon = time() + self.batch_window
+        while (due := self.next_due()) is not None and due <= horizon:
+            _, product_id = heappop(self.schedule)
+            del self.due[product_id]
+            batch.append(self.products[product_id])
+        return batch
+
+    # commands
+    def serve(self) -> None:
+        if exists(self.socket_file):
+            unlink(self.socket_file)  # left by a daemon that didn't stop
+        self.server = ThreadingUnixStreamServer(
+            self.socket_file, CommandHandler
+        )
+        # server_close() waits for the commands in progress to be answered
+        self.server.daemon_threads = False
+        self.server.loop = self
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def ping(self) -> dict:
+        """
+        Answered right away by the server thread, even during an update
+        """
+        return {"ok": True, "message": f"{len(self.products)} products"}
+
+    def handle(self, command: dict) -> dict:
+        name = command.get("command")
+        if name not in self.handlers:
+            return {"ok": False, "message": f"unknown command '{name}'"}
+        try:
+            message = self.handlers[name](command)
+        except (Exception, SystemExit) as e:
+            logging.error(f"daemon: {name} failed ({e})")
+            return {"ok": False, "message": str(e)}
+        self.sync()
+        return {"ok": True, "message": message}
+
+    def stop(self) -> None:
+        self.stopped = True
+        self.commands.put(None)
+
+    def run(self) -> None:
+        self.serve()
+        self.sync()
+        logging.info(f"daemon: listening on {self.socket_file}")
+        try:
+            while not self.stopped:
+                due = self.next_due()
+                timeout = MAX_SLEEP if due is None else due - time()
+                if timeout > 0:
+                    try:
+                        item = self.commands.get(
+                            timeout=min(timeout, MAX_SLEEP)
+                        )
+                    except Empty:
+                        continue
+                    if item is not None:
+                        command, replies = item
+                        replies.put(self.handle(command))
+                    continue
+                batch = self.due_products()
+                self.update(batch)
+                now = time()
+                for product in batch:
+                    if product["id"] in self.products:
+                        self.plan(
+                            product["id"], self.next_update(product, now)
+                        )
+        finally:
+            self.finished = True
+            self.server.shutdown()
+            self.server.server_close()
+            unlink(self.socket_file)
+
+
+class CommandHandler(StreamRequestHandler):
+    timeout = PING_TIMEOUT  # for the command to be sent
+
+    def handle(self) -> None:
+        loop = self.server.loop
+        try:
+            command = json_loads(self.rfile.readline())
+        except (ValueError, OSError):
+            reply = {"ok": False, "message": "invalid command"}
+        else:
+            if command.get("command") == "ping":
+                reply = loop.ping()
+            else:
+                # run by the loop, after the update in progress if any
+                replies = Queue(maxsize=1)
+                loop.commands.put((command, replies))
+                reply = None
+                while reply is None:
+                    try:
+                        reply = replies.get(timeout=1)
+                    except Empty:
+                        if loop.finished:
+                            reply = self.not_run(replies)
+        try:
+            self.wfile.write(json_dumps(reply).encode() + b"\n")
+        except OSError:
+            pass  # the client gave up waiting (see send_command)
+
+    @staticmethod
+    def not_run(replies: Queue) -> dict:
+        try:
+            return replies.get_nowait()  # answered right before finishing
+        except Empty:
+            return {"ok": False, "message": "daemon stopped, command not run"}
+
+
+def send_command(
+    socket_file: str, command: dict, timeout: float = COMMAND_TIMEOUT
+) -> dict:
+    """
+    Send <command> to the daemon listening at <socket_file> and return its
+    reply ({'ok': bool, 'message': str}); raise OSError if no daemon is
+    listening, NoReply if it doesn't reply within <timeout> seconds
+    """
+    with socket(AF_UNIX, SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(socket_file)
+        client.sendall(json_dumps(command).encode() + b"\n")
+        try:
+            with client.makefile("rb") as replies:
+                line = replies.readline()
+        except socket_timeout:
+            raise NoReply(f"no reply from the daemon in {timeout:.0f}s")
+    if not line:
+        raise ConnectionError("daemon closed the connection")
+    return json_loads(line)
+
+
+def listening(socket_file: str) -> bool:
+    """
+    Tell whether a daemon is listening at <socket_file>
+    """
+    if not exists(socket_file):
+        return False
+    try:
+        send_command(socket_file, {"command": "ping"}, timeout=PING_TIMEOUT)
+    except (OSError, NoReply):
+        return False
+    return True
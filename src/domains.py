@@ -0,0 +1,39 @@
+# coding=utf-8
+
+from json import loads as json_loads
+from urllib.parse import urlparse
+
+
+class SiteNames:
+    """
+    Map url domains to the names of the sites listed in sites.json, without
+    compiling their extractors (see sites.SiteRegistry): enough to tell the
+    site of a product url without loading the parsing modules (e.g. to
+    filter the product listing)
+    """
+
+    def __init__(self, sites: dict):
+        self.names = {}  # domain label: site name
+        for name, opts in sites.items():
+            for domain in opts.get("domains", [name]):
+                self.names[domain] = name
+
+    @classmethod
+    def load(cls, sites_file: str):
+        with open(sites_file, "r") as sites_file:
+            return cls(json_loads(sites_file.read()))
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.names.values()
+
+    def site_name(self, url: str) -> str:
+        """
+        Return the name of the site serving <url> (e.g.
+        'https://www.amazon.it/dp/...' -> 'amazon'); unknown domains fall
+        back to the bare hostname
+        """
+        hostname = (urlparse(url).hostname or "").lower()
+        for label in hostname.split("."):
+            if label in self.names:
+                return self.names[label]
+        return hostname
@@ -0,0 +1,594 @@
+# coding=utf-8
+
+import logging
+from contextlib import nullcontext
+from heapq import heappop, heappush
+from itertools import count
+from os import cpu_count
+from queue import Empty, Queue
+from random import uniform
+from threading import BoundedSemaphore, Condition, Lock, Thread
+from time import monotonic
+from typing import TYPE_CHECKING, Callable, Iterator, Optional, Tuple
+
+from metrics import Metrics
+
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+
+
+DEFAULT_WORKERS = 8
+DEFAULT_SITE_LIMIT = 2
+DEFAULT_PARSERS = cpu_count() or 1
+DEFAULT_QUEUE_SIZE = 16  # raw pages waiting to be parsed
+DEFAULT_MAX_ATTEMPTS = 10
+STATS_INTERVAL = 10  # seconds between pipeline stats log lines
+DEFAULT_RETRY_ROUNDS = 3  # delayed retries of a product before giving up
+RETRY_DELAY = 30  # seconds before the first delayed retry, then doubled
+MAX_RETRY_DELAY = 600
+SUMMARY_PRODUCTS = 10  # slowest products listed in the run summary
+BLOCK_THRESHOLD = 3  # blocked requests in a row opening a site's circuit
+BLOCK_DELAY = 60  # seconds a site is paused at its first trip, then doubled
+MAX_BLOCK_DELAY = 900
+BLOCK_TRIPS = 4  # trips in a row before a site is given up
+BUDGET_POLL = 1  # seconds between fetch budget checks of delayed products
+
+
+class Spent(Exception):
+    """
+    Raised by the fetch function of the update pipeline when the fetch
+    budget gets spent (or the update is stopped) while fetching a product,
+    e.g. between proxies: the product is deferred to the next update
+    """
+
+
+def backoff(
+    retry: int, delay: float = RETRY_DELAY, max_delay: float = MAX_RETRY_DELAY
+) -> float:
+    """
+    Seconds to wait before the <retry>-th retry (starting from 1): <delay>
+    doubled at every retry up to <max_delay>, half of which is random
+    jitter, so that retries of products failed together are spread out
+    """
+    ceiling = min(max_delay, delay * 2 ** (retry - 1))
+    return ceiling / 2 + uniform(0, ceiling / 2)
+
+
+class SiteLimiter:
+    """
+    Per-site concurrency cap: every site gets a bounded semaphore, created
+    lazily, sized from <limits> or <default> if the site is not listed
+    """
+
+    def __init__(self, limits: dict, default: int = DEFAULT_SITE_LIMIT):
+        self.limits = limits
+        self.default = default
+        self.semaphores = {}
+        self.lock = Lock()
+
+    def get(self, site: str) -> BoundedSemaphore:
+        with self.lock:
+            if site not in self.semaphores:
+                self.semaphores[site] = BoundedSemaphore(
+                    max(1, self.limits.get(site, self.default))
+                )
+            return self.semaphores[site]
+
+
+class CircuitBreaker:
+    """
+    Per-site circuit breakers, so that a site refusing requests (answering
+    with block or captcha pages, see fetch.Blocked) is paused while the
+    other sites keep going: <threshold> blocked requests in a row open the
+    site's circuit for a backoff delay (see backoff(), doubled at every
+    trip in a row), then requests go through again, a single blocked one
+    opening the circuit again; after <max_trips> trips in a row the site is
+    given up. Trips are counted in <metrics>.
+    """
+
+    def __init__(
+        self,
+        threshold: int = BLOCK_THRESHOLD,
+        delay: float = BLOCK_DELAY,
+        max_delay: float = MAX_BLOCK_DELAY,
+        max_trips: int = BLOCK_TRIPS,
+        metrics: Metrics = None,
+    ):
+        self.threshold = threshold
+        self.delay = delay
+        self.max_delay = max_delay
+        self.max_trips = max_trips
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.states = {}  # site: [blocked in a row, trips in a row, until]
+        self.lock = Lock()
+
+    def wait(self, site: str) -> Optional[float]:
+        """
+        Return the seconds before requests to <site> can go again (0 if its
+        circuit is closed), None if the site was given up
+        """
+        with self.lock:
+            _, trips, until = self.states.get(site, (0, 0, 0))
+            if trips >= self.max_trips:
+                return None
+            return max(0, until - monotonic())
+
+    def blocked(self, site: str) -> None:
+        """
+        Record a blocked request to <site>
+        """
+        with self.lock:
+            state = self.states.setdefault(site, [0, 0, 0])
+            if state[2] > monotonic():
+                return  # sent before the circuit opened
+            state[0] += 1
+            if state[0] < self.threshold:
+                return
+            state[0] = self.threshold - 1  # one more block opens it again
+            state[1] += 1
+            pause = backoff(state[1], self.delay, self.max_delay)
+            state[2] = monotonic() + pause
+            trips = state[1]
+        self.metrics.count("site_pauses")
+        if trips >= self.max_trips:
+            logging.error(f"{site} keeps blocking requests, giving up on it")
+        else:
+            logging.warning(
+                f"{site} is blocking requests, paused for {pause:.0f}s"
+            )
+
+    def passed(self, site: str) -> None:
+        """
+        Record a request to <site> that wasn't blocked, closing its circuit
+        """
+        with self.lock:
+            state = self.states.pop(site, None)
+        if state is not None and state[1] > 0:
+            logging.info(f"{site} is no longer blocking requests")
+
+
+class Stage:
+    """
+    Throughput counter of a pipeline stage
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.done = 0
+        self.lock = Lock()
+
+    def add(self) -> None:
+        with self.lock:
+            self.done += 1
+
+    def rate(self, elapsed: float) -> str:
+        return f"{self.name} {self.done} ({self.done / elapsed:.2f}/s)"
+
+
+class RunSummary:
+    """
+    Per-product time spent fetching pages versus waiting for delayed
+    retries, products that could not be updated and products deferred to
+    the next update (the fetch budget being spent)
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.fetching = {}
+        self.waiting = {}
+        self.failed = {}  # url: reason
+        self.deferred = set()
+
+    def add_fetch(self, url: str, seconds: float) -> None:
+        with self.lock:
+            self.fetching[url] = self.fetching.get(url, 0) + seconds
+
+    def add_wait(self, url: str, seconds: float) -> None:
+        with self.lock:
+            self.waiting[url] = self.waiting.get(url, 0) + seconds
+
+    def fail(self, url: str, reason: str) -> None:
+        with self.lock:
+            self.failed[url] = reason
+
+    def defer(self, url: str) -> None:
+        with self.lock:
+            self.deferred.add(url)
+
+    def report(self) -> str:
+        products = max(1, len(self.fetching))
+        fetching = sum(self.fetching.values())
+        waiting = sum(self.waiting.values())
+        lines = [
+            f"fetching {fetching:.1f}s ({fetching / products:.2f}s/product), "
+            f"waiting for retries {waiting:.1f}s "
+            f"({len(self.waiting)} products retried), "
+            f"{len(self.failed)} failed, {len(self.deferred)} deferred"
+        ]
+        # products that waited the longest
+        waits = sorted(self.waiting, key=self.waiting.get, reverse=True)
+        for url in waits[:SUMMARY_PRODUCTS]:
+            lines.append(
+                f"├─ {url[:60]}: "
+                f"fetching {self.fetching.get(url, 0):.1f}s, "
+                f"waiting {self.waiting[url]:.1f}s"
+            )
+        for url, reason in self.failed.items():
+            lines.append(f"├─ {url[:60]}: failed ({reason})")
+        return "\n".join(lines)
+
+
+class RetryScheduler:
+    """
+    Delayed queue of products to fetch again: scheduled products are put
+    back on <queue> by a background thread once their backoff delay (see
+    backoff()) expires, while the other products keep going. Every product
+    gets at most <rounds> delayed retries; deferred products (e.g. of a
+    paused site) don't count as retries. Once spent() tells that nothing
+    is fetched anymore (e.g. the fetch budget is spent), every delayed
+    product is put back on the queue at once, for the fetchers to defer it
+    instead of waiting for it.
+    """
+
+    def __init__(
+        self,
+        queue: Queue,
+        summary: RunSummary,
+        rounds: int = DEFAULT_RETRY_ROUNDS,
+        delay: float = RETRY_DELAY,
+        max_delay: float = MAX_RETRY_DELAY,
+        spent: Callable[[], bool] = None,
+    ):
+        self.queue = queue
+        self.summary = summary
+        self.rounds = rounds
+        self.delay = delay
+        self.max_delay = max_delay
+        self.spent = spent
+        self.retries = {}  # url: delayed retries so far
+        self.delayed = []  # heap of (due, sequence, scheduled, product)
+        self.sequence = count()
+        self.condition = Condition()
+        self.stopped = False
+
+    def __len__(self) -> int:
+        with self.condition:
+            return len(self.delayed)
+
+    def schedule(self, product: dict) -> Optional[float]:
+        """
+        Put <product> back on the queue after its backoff delay; return the
+        delay, None if the product is out of retries
+        """
+        url = product["url"]
+        with self.condition:
+            retry = self.retries.get(url, 0) + 1
+            if retry > self.rounds:
+                return None
+            self.retries[url] = retry
+            delay = backoff(retry, self.delay, self.max_delay)
+            self.defer(product, delay)
+        return delay
+
+    def defer(self, product: dict, delay: float) -> None:
+        """
+        Put <product> back on the queue after <delay> seconds
+        """
+        with self.condition:
+            now = monotonic()
+            heappush(
+                self.delayed, (now + delay, next(self.sequence), now, product)
+            )
+            self.condition.notify()
+
+    def start(self) -> "RetryScheduler":
+        Thread(target=self.run, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def run(self) -> None:
+        with self.condition:
+            while not self.stopped:
+                if len(self.delayed) == 0:
+                    self.condition.wait()
+                    continue
+                if self.spent is not None and self.spent():
+                    self.release(len(self.delayed))
+                    continue
+                remaining = self.delayed[0][0] - monotonic()
+                if remaining > 0:
+                    if self.spent is not None:
+                        remaining = min(remaining, BUDGET_POLL)
+                    self.condition.wait(remaining)
+                    continue
+                self.release(1)
+
+    def release(self, products: int) -> None:
+        """
+        Put the first <products> delayed products back on the queue (the
+        condition being held)
+        """
+        for _ in range(products):
+            _, _, scheduled, product = heappop(self.delayed)
+            self.summary.add_wait(product["url"], monotonic() - scheduled)
+            self.queue.put(product)
+
+
+def update_pipeline(
+    products: list,
+    fetch: Callable[[dict], tuple],
+    parse: Callable[[str, str], dict],
+    unchanged: Callable[[dict], dict],
+    report: Callable[..., None],
+    site_of: Callable[[str], str],
+    workers: int = DEFAULT_WORKERS,
+    parsers: int = DEFAULT_PARSERS,
+    queue_size: int = DEFAULT_QUEUE_SIZE,
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    site_limits: dict = None,
+    default_site_limit: int = DEFAULT_SITE_LIMIT,
+    retry_rounds: int = DEFAULT_RETRY_ROUNDS,
+    retry_delay: float = RETRY_DELAY,
+    summary: RunSummary = None,
+    executor: "ProcessPoolExecutor" = None,
+    metrics: Metrics = None,
+    breaker: CircuitBreaker = None,
+    spent: Callable[[], bool] = None,
+) -> Iterator[Tuple[dict, dict]]:
+    """
+    Three stages update pipeline:
+    - <workers> fetcher threads run fetch(product) -> (proxy, page,
+      latency), never running more than the site limit for the same domain
+      at once, and put raw pages in a bounded queue (fetchers block when it
+      is full); a page of None means the page didn't change since the last
+      fetch, and unchanged(product) gives the infos without parsing;
+    - a process pool of <parsers> (or the given, already running,
+      <executor>) runs parse(url, page.text) -> infos, with at most
+      2 * <parsers> pages in flight, then the page validators are added to
+      the infos;
+    - the caller, as single writer, consumes the (product, infos) pairs
+      yielded by this generator.
+    The outcome of the parsing is given back through report(proxy, ok,
+    latency): pages that can't be parsed (e.g. error pages of the proxy)
+    are fetched again up to <max_attempts> times. Block pages (fetch raising
+    fetch.Blocked) are fetched again as well but, being the site's doing,
+    they aren't reported against the proxy: they go to the per-site
+    <breaker> (see CircuitBreaker), whose paused sites' products are
+    deferred until the pause is over. Products that still can't be fetched
+    or parsed, or whose page has no price (sites.MissingPrice), are put on a
+    delayed queue (see RetryScheduler) for up to <retry_rounds> retries,
+    then they are recorded as failed in <summary> and yielded with empty
+    infos: the run never stops over a single product.
+    Products are fetched in the given order: once spent() tells that the
+    fetch budget is spent (or that the update is to be stopped, e.g. the
+    daemon stopping), the products left (delayed retries and paused
+    sites' products included, without waiting for them) are recorded as
+    deferred in <summary> and yielded with empty infos, as the product
+    being fetched if fetch() raises Spent.
+    If the process pool breaks (e.g. a parser process is killed), the
+    products left are recorded as failed instead: the run still ends.
+    Parse times (from the submission of the page, so including the wait for
+    a free parser), failures and retries are recorded in <metrics>.
+    """
+    # multiprocessing is only loaded when updating, not at CLI startup
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+    from multiprocessing import get_context
+
+    from fetch import Blocked
+    from sites import MissingPrice
+
+    limiter = SiteLimiter(limits=site_limits or {}, default=default_site_limit)
+    todo = Queue()
+    pages = Queue(maxsize=max(1, queue_size))
+    results = Queue()
+    in_flight = BoundedSemaphore(2 * max(1, parsers))
+    # shared by the fetchers and the parse callbacks
+    lock = Lock()
+    attempts = {}
+    broken = []  # why the process pool can't parse anymore, if it broke
+    fetched = Stage("fetched")
+    parsed = Stage("parsed")
+    written = Stage("written")
+    if summary is None:
+        summary = RunSummary()
+    if metrics is None:
+        metrics = Metrics()
+    if breaker is None:
+        breaker = CircuitBreaker(metrics=metrics)
+
+    def stopped() -> bool:
+        # delayed products are not waited for once nothing is fetched
+        return len(broken) > 0 or (spent is not None and spent())
+
+    retries = RetryScheduler(
+        todo, summary, rounds=retry_rounds, delay=retry_delay, spent=stopped
+    ).start()
+    for product in products:
+        todo.put(product)
+
+    def give_up(product: dict, reason: str) -> None:
+        metrics.count("given_up")
+        logging.error(f"giving up on {product['url']} ({reason})")
+        summary.fail(product["url"], reason)
+        results.put((product, None))
+
+    def pool_broken(product: dict, error: Exception) -> None:
+        with lock:
+            first = len(broken) == 0
+            if first:
+                broken.append(f"parsers unavailable: {error!r}")
+        if first:
+            logging.error(
+                f"parser processes broken ({error!r}), giving up on the "
+                "products left"
+            )
+        give_up(product, broken[0])
+
+    def retry(product: dict, reason: str) -> None:
+        delay = retries.schedule(product)
+        if delay is None:
+            give_up(product, reason)
+            return
+        metrics.count("retries")
+        logging.warning(
+            f"retrying {product['url']} in {delay:.0f}s ({reason})"
+        )
+
+    def refetch(product: dict, reason: str) -> None:
+        url = product["url"]
+        with lock:
+            attempts[url] = attempts.get(url, 1) + 1
+            again = attempts[url] <= max_attempts
+            if not again:
+                attempts[url] = 1
+        if again:
+            todo.put(product)  # fetch again through another proxy
+        else:
+            retry(product, reason)
+
+    def deferred(product: dict) -> None:
+        summary.defer(product["url"])
+        results.put((product, None))
+
+    def fetcher() -> None:
+        while True:
+            product = todo.get()
+            if product is None:
+                return
+            if len(broken) > 0:
+                give_up(product, broken[0])
+                continue
+            if spent is not None and spent():
+                deferred(product)
+                continue
+            site = site_of(product["url"])
+            pause = breaker.wait(site)
+            if pause is None:
+                metrics.count("given_up")
+                summary.fail(product["url"], f"{site} blocking requests")
+                results.put((product, None))
+                continue
+            if pause > 0:
+                retries.defer(product, pause)
+                continue
+            begin = monotonic()
+            try:
+                with limiter.get(site):
+                    proxy, page, latency = fetch(product)
+            except Spent:
+                summary.add_fetch(product["url"], monotonic() - begin)
+                deferred(product)
+                continue
+            except Blocked as e:
+                summary.add_fetch(product["url"], monotonic() - begin)
+                logging.warning(f"{product['url']} blocked ({e})")
+                breaker.blocked(site)
+                refetch(product, f"blocked: {e}")
+                continue
+            except (Exception, SystemExit) as e:
+                summary.add_fetch(product["url"], monotonic() - begin)
+                metrics.count("fetch_failures")
+                logging.error(f"unable to fetch {product['url']} ({e})")
+                retry(product, f"unable to fetch: {e}")
+                continue
+            summary.add_fetch(product["url"], monotonic() - begin)
+            breaker.passed(site)
+            fetched.add()
+            if page is None:
+                report(proxy, ok=True, latency=latency)
+                results.put((product, unchanged(product)))
+                continue
+            pages.put((product, proxy, page, latency))
+
+    def dispatcher(executor: ProcessPoolExecutor) -> None:
+        while True:
+            item = pages.get()
+            if item is None:
+                return
+            product, proxy, page, latency = item
+            in_flight.acquire()
+            try:
+                future = executor.submit(parse, product["url"], page.text)
+            except BrokenProcessPool as e:
+                in_flight.release()
+                pool_broken(product, e)
+                continue
+            future.add_done_callback(
+                lambda future, item=item, submitted=monotonic(): parsed_page(
+                    future, submitted, *item
+                )
+            )
+
+    def parsed_page(future, submitted, product, proxy, page, latency) -> None:
+        in_flight.release()
+        parsed.add()
+        metrics.observe("parse_page", monotonic() - submitted)
+        try:
+            infos = future.result()
+        except BrokenProcessPool as e:
+            pool_broken(product, e)  # not the page's fault
+            return
+        except MissingPrice as e:
+            # the product page itself has no price: the proxy did its job
+            metrics.count("missing_prices")
+            report(proxy, ok=True, latency=latency)
+            retry(product, str(e))
+            return
+        except Exception as e:
+            metrics.count("parse_failures")
+            logging.error(f"proxy {proxy} failed ({e})")
+            report(proxy, ok=False)
+            refetch(product, f"unable to parse: {e}")
+            return
+        report(proxy, ok=True, latency=latency)
+        infos["validators"] = page.validators
+        results.put((product, infos))
+
+    start = monotonic()
+
+    def log_stats() -> None:
+        elapsed = max(monotonic() - start, 1e-9)
+        logging.info(
+            f"pipeline: queued {todo.qsize()}, delayed {len(retries)}, "
+            f"raw pages {pages.qsize()}, results {results.qsize()} | "
+            f"{fetched.rate(elapsed)}, "
+            f"{parsed.rate(elapsed)}, {written.rate(elapsed)}"
+        )
+
+    threads = [
+        Thread(target=fetcher, daemon=True) for _ in range(max(1, workers))
+    ]
+    if executor is None:
+        pool = ProcessPoolExecutor(
+            max_workers=max(1, parsers), mp_context=get_context("spawn")
+        )
+    else:
+        pool = nullcontext(executor)  # kept running for the next call
+    with pool as executor:
+        dispatch = Thread(target=dispatcher, args=(executor,), daemon=True)
+        dispatch.start()
+        for thread in threads:
+            thread.start()
+        last_log = monotonic()
+        while written.done < len(products):
+            try:
+                product, infos = results.get(timeout=STATS_INTERVAL)
+            except Empty:
+                product = None
+            if product is not None:
+                written.add()
+                yield product, infos or {"title": None, "price": None}
+            if monotonic() - last_log >= STATS_INTERVAL:
+                log_stats()
+                last_log = monotonic()
+        retries.stop()
+        for thread in threads:
+            todo.put(None)
+        pages.put(None)
+        dispatch.join()
+    log_stats()
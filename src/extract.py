@@ -0,0 +1,80 @@
+# coding=utf-8
+
+from lxml.etree import HTMLPullParser, XMLSyntaxError
+
+
+CHUNK_SIZE = 16 * 1024
+
+
+def parse_events(page: str):
+    """
+    Yield (event, element) pairs feeding <page> to lxml's pull parser one
+    chunk at a time
+    """
+    parser = HTMLPullParser(events=("start", "end"))
+    for offset in range(0, len(page), CHUNK_SIZE):
+        parser.feed(page[offset : offset + CHUNK_SIZE])
+        yield from parser.read_events()
+    try:
+        parser.close()
+    except XMLSyntaxError:
+        return  # empty or unparsable page
+    yield from parser.read_events()
+
+
+class Extractor:
+    """
+    Extract the text of a few fields from an html page without building the
+    whole document tree: the page is fed in chunks to lxml's pull parser,
+    already processed elements are dropped as soon as they are closed, and
+    parsing stops as soon as every field has been found.
+    Fields are given as {<field>: <selector>}, as found in sites.json, where
+    <selector> is either an element id or a (space separated) class list;
+    the first element in document order matching the selector is used.
+    """
+
+    def __init__(self, fields: dict):
+        self.fields = {
+            field: (selector, frozenset(selector.split()))
+            for field, selector in fields.items()
+        }
+
+    def match(self, element) -> list:
+        element_id = element.get("id")
+        element_classes = element.get("class")
+        if element_id is None and element_classes is None:
+            return []
+        element_classes = frozenset((element_classes or "").split())
+        return [
+            field
+            for field, (selector, classes) in self.fields.items()
+            if element_id == selector or classes <= element_classes
+        ]
+
+    def extract(self, page: str) -> dict:
+        """
+        Return {<field>: <text>} for the fields found in <page>; fields not
+        found in the page are None
+        """
+        infos = dict.fromkeys(self.fields)
+        pending = set(self.fields)
+        targets = {}  # element -> fields waiting for the element to close
+        for event, element in parse_events(page):
+            if event == "start":
+                fields = [f for f in self.match(element) if f in pending]
+                if len(fields) > 0:
+                    pending.difference_update(fields)
+                    targets[element] = fields
+                continue
+            if element in targets:
+                text = "".join(element.itertext())
+                for field in targets.pop(element):
+                    infos[field] = text
+                if len(pending) == 0 and len(targets) == 0:
+                    break
+            if len(targets) == 0:
+                # nothing is being captured: free processed elements
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+        return infos
@@ -0,0 +1,172 @@
+# coding=utf-8
+
+from queue import Empty, LifoQueue
+from threading import Lock
+from typing import Callable, NamedTuple, Optional
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+
+TIMEOUT = 60
+POOL_MAXSIZE = 4  # connections kept alive per target host and session
+BLOCK_STATUSES = (429,)  # answered by the site itself when rate limiting
+
+
+class Blocked(Exception):
+    """
+    The site answered with a block or captcha page instead of the requested
+    page: the site is refusing requests, the proxy isn't failing
+    """
+
+
+class Page(NamedTuple):
+    text: str
+    # conditional request validators of the page, e.g.
+    # {'etag': '"abc"', 'last_modified': 'Wed, 21 Oct 2015 07:28:00 GMT'}
+    validators: dict
+
+
+class Fetcher:
+    """
+    Fetch pages through proxies reusing keep-alive connections: idle
+    requests Sessions are pooled per proxy and handed out to one thread at a
+    time. Pages are requested compressed (unless <compress> is False) and,
+    given the validators of the previous response, conditionally: None is
+    returned when the server answers 304 Not Modified.
+    Responses are checked for block and captcha pages before being handed
+    out, raising Blocked: <block_marker>(url, text) returns the marker of a
+    block page found in the text of the page at url, None if there's none
+    (see sites.Site.block_marker).
+    Bytes transferred, blocked requests and connection reuse are counted
+    for each run.
+    """
+
+    def __init__(
+        self,
+        useragent: Callable[[], str],
+        compress: bool = True,
+        block_marker: Callable[[str, str], Optional[str]] = None,
+    ):
+        self.useragent = useragent
+        self.compress = compress
+        self.block_marker = block_marker
+        self.sessions = {}  # proxy -> LifoQueue of idle sessions
+        self.lock = Lock()
+        self.requests = 0
+        self.not_modified = 0
+        self.blocked = 0
+        self.wire_bytes = 0
+        self.content_bytes = 0
+        self.connections = 0  # connections opened by closed sessions
+        self.pool_requests = 0  # requests made by closed sessions
+
+    def new_session(self) -> Session:
+        session = Session()
+        adapter = HTTPAdapter(pool_maxsize=POOL_MAXSIZE)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        if not self.compress:
+            session.headers["Accept-Encoding"] = "identity"
+        return session
+
+    def borrow(self, proxy: str) -> Session:
+        with self.lock:
+            idle = self.sessions.setdefault(proxy, LifoQueue())
+        try:
+            return idle.get_nowait()
+        except Empty:
+            return self.new_session()
+
+    def give_back(self, proxy: str, session: Session) -> None:
+        with self.lock:
+            idle = self.sessions.setdefault(proxy, LifoQueue())
+        idle.put(session)
+
+    def get(
+        self, url: str, proxy: str, validators: Optional[dict] = None
+    ) -> Optional[Page]:
+        headers = {"User-Agent": self.useragent()}
+        if validators:
+            if validators.get("etag"):
+                headers["If-None-Match"] = validators["etag"]
+            if validators.get("last_modified"):
+                headers["If-Modified-Since"] = validators["last_modified"]
+        session = self.borrow(proxy)
+        try:
+            response = session.get(
+                url=url,
+                headers=headers,
+                proxies={
+                    "http": f"http://{proxy}",
+                    "https": f"http://{proxy}",
+                },
+                timeout=TIMEOUT,
+            )
+        except Exception:
+            # connection state is unknown, don't reuse this session
+            self.close(session)
+            raise
+        self.give_back(proxy, session)
+        with self.lock:
+            self.requests += 1
+            self.wire_bytes += response.raw.tell()
+            self.content_bytes += len(response.content)
+            if response.status_code == 304:
+                self.not_modified += 1
+                return None
+        text = response.text
+        blocked = None
+        if response.status_code in BLOCK_STATUSES:
+            blocked = f"HTTP {response.status_code}"
+        elif self.block_marker is not None:
+            blocked = self.block_marker(url, text)
+        if blocked is not None:
+            with self.lock:
+                self.blocked += 1
+            raise Blocked(f"block page: {blocked}")
+        return Page(
+            text=text,
+            validators={
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            },
+        )
+
+    def close(self, session: Session) -> None:
+        """
+        Close <session>, collecting its connection pools stats
+        """
+        pools = []
+        for adapter in set(session.adapters.values()):
+            managers = [adapter.poolmanager, *adapter.proxy_manager.values()]
+            for manager in managers:
+                pools.extend(manager.pools._container.values())
+        with self.lock:
+            for pool in pools:
+                self.connections += pool.num_connections
+                self.pool_requests += pool.num_requests
+        session.close()
+
+    def close_all(self) -> None:
+        with self.lock:
+            idle = list(self.sessions.values())
+            self.sessions = {}
+        for sessions in idle:
+            while not sessions.empty():
+                self.close(sessions.get_nowait())
+
+    def stats(self) -> str:
+        reused = self.pool_requests - self.connections
+        reuse_rate = reused / self.pool_requests if self.pool_requests else 0
+        saved = 0
+        if self.content_bytes > 0:
+            saved = 1 - self.wire_bytes / self.content_bytes
+        return (
+            f"http: {self.requests} requests, {self.not_modified} not "
+            f"modified, {self.blocked} blocked, "
+            f"{self.wire_bytes / 2**20:.2f} MiB transferred "
+            f"({saved:.0%} saved by compression), {self.connections} "
+            f"connections opened, {reuse_rate:.0%} requests on reused "
+            "connections"
+        )
@@ -3,58 +3,102 @@
 
 import logging
 from argparse import ArgumentParser
-from bs4 import BeautifulSoup
 from configparser import ConfigParser
-from datetime import date
-from email.message import EmailMessage
-from fake_useragent import UserAgent
-from json import dumps as json_dumps
-from json import loads as json_loads
-from os import listdir, mkdir, rename
-from os.path import expanduser, isdir, isfile, join
-from random import choice
+from contextlib import ExitStack
+from datetime import date, timedelta
+from functools import lru_cache
+from itertools import islice
+from os import mkdir
+from os.path import dirname, expanduser, isdir, isfile, join, realpath
 from re import compile, match, IGNORECASE
-from requests import get
-from smtplib import SMTP_SSL
-from ssl import create_default_context
-from sys import argv
+from sys import argv, stdin, stdout
 from sys import exit as sys_exit
-from time import sleep
+from time import monotonic, sleep, time
+from typing import TYPE_CHECKING, Callable, Iterator, Optional
+
+from engine import DEFAULT_PARSERS, DEFAULT_SITE_LIMIT, DEFAULT_WORKERS
+from store import Store
+from utils.files import locked
+
+# network, parsing and mail modules are slow to import and only needed by
+# -i and -u: they are imported where used, so that -l and -r start quickly
+# (see benchmarks/bench_startup.py)
+if TYPE_CHECKING:
+    from cache import PageCache
+    from domains import SiteNames
+    from engine import RunSummary
+    from fetch import Fetcher, Page
+    from metrics import Metrics
+    from priority import Budget
+    from proxies import ProxyPool
+    from sites import SiteRegistry
+    from useragents import UserAgentProvider
 
 
 XDG_CONFIG = expanduser("~/.config/price-traker")
 XDG_DATA = expanduser("~/.local/share/price-traker")
 CONFIG_FILE = join(XDG_CONFIG, "config")
 PRODUCT_LIST_FILE = join(XDG_DATA, "product_list.json")
+STORE_FILE = join(XDG_DATA, "products.db")
 LOG_FILE = join(XDG_DATA, "traker.log")
+LOCK_FILE = join(XDG_DATA, "traker.lock")
+SOCKET_FILE = join(XDG_DATA, "traker.sock")
+PROXY_SCORES_FILE = join(XDG_DATA, "proxies.json")
+CACHE_FILE = join(XDG_DATA, "pages.db")
+METRICS_FILE = join(XDG_DATA, "metrics.json")
+PROFILE_FILE = join(XDG_DATA, "traker.prof")
+SITES_FILE = join(dirname(realpath(__file__)), "..", "sites.json")
 LOG_FORMAT = "%(asctime)s %(levelname)s: %(message)s"
-USERAGENT_FALLBACK = (
-    "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/535.11"
-    "(KHTML, like Gecko) Chrome/17.0.963.56 Safari/535.11"
-)
-PROXY_LIST_API_URL = (
-    "https://proxylist.geonode.com/api/proxy-list?"
-    "limit=50&page=1&sort_by=lastChecked&sort_type="
-    "desc&anonymityLevel=elite&anonymityLevel=anonymous"
-)
-TIMEOUT = 5
 MAX_RETRIES = 3
+# days after which daily prices are rolled up to weekly ones (0: never)
+ROLLUP_AFTER = 365
+# attempts (through different proxies) to retrieve a single page
+MAX_PROXY_ATTEMPTS = 10
+CACHE_SIZE = 256  # MiB of compressed pages kept in the page cache (0: off)
+REPLAY_BATCH = 256  # cached pages parsed (and prices written) at once
 
 
 # UTILS
+def valid_mail_addr(mail: str) -> bool:
+    return bool(
+        match(r"^[A-Za-z0-9\.\+_-]+@[A-Za-z0-9\._-]+\.[a-zA-Z]*$", mail)
+    )
+
+
 def check_mail_addr(mail: str) -> None:
-    if not match(r"^[A-Za-z0-9\.\+_-]+@[A-Za-z0-9\._-]+\.[a-zA-Z]*$", mail):
+    if not valid_mail_addr(mail):
         logging.error(f"'{mail}' is not a valid mail address")
         sys_exit(f"ERROR: '{mail}' is not a valid mail address")
 
 
 def check_smtp_server(server_url: str) -> None:
-    if not match(r"^[A-Za-z0-9\.\+_-]+\.[a-zA-Z]*$", server_url):
+    # host name or ip address, e.g. 'smtp.example.com', '127.0.0.1'
+    if not match(r"^[A-Za-z0-9_-]+(?:\.[A-Za-z0-9_-]+)*$", server_url):
         logging.error(f"{server_url} is not a valid SMTP server URL")
         sys_exit(f"ERROR: '{server_url}' is not a valid SMTP server URL")
 
 
-def check_url(url: str) -> None:
+def check_rule(rule: str) -> str:
+    from analytics import parse_rule
+
+    try:
+        return parse_rule(rule)
+    except ValueError as e:
+        logging.error(e)
+        sys_exit(f"ERROR: {e}")
+
+
+def check_budget(budget: str) -> "Budget":
+    from priority import Budget
+
+    try:
+        return Budget.parse(budget)
+    except ValueError as e:
+        logging.error(e)
+        sys_exit(f"ERROR: {e}")
+
+
+def valid_url(url: str) -> bool:
     url_regex = compile(
         r"^(?:http|ftp)s?://"  # http:// or https://
         r"(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)"
@@ -65,49 +109,199 @@ def check_url(url: str) -> None:
         r"(?:/?|[/?]\S+)$",
         IGNORECASE,
     )
-    if not match(url_regex, url):
+    return bool(match(url_regex, url))
+
+
+def check_url(url: str) -> None:
+    if not valid_url(url):
         logging.error(f"'{url}' is not a valid URL")
         sys_exit(f"ERROR: '{url}' is not a valid URL")
 
 
-def get_brute(proxies: list, url: str, retries: int = 0) -> dict:
+def get_brute(proxies: "ProxyPool", url: str) -> dict:
     """
     random user agent and rotating proxies to prevent request blocking
     try to get page while proxies are available
     (this loop prevents breaking in case a proxy is actually working but
-    gets blocked by the service)
-    """
-    if retries >= MAX_RETRIES:
-        logging.error("max retries reached, impossible to retrieve infos")
-        sys_exit("ERROR: max retries reached, impossible to retrieve infos")
-    infos = {
-        "title": None,
-        "price": None,
-    }
-    while len(proxies) > 0:
-        proxy = get_working_proxy(proxy_list=proxies)
-        print(f"{len(proxies)} available proxies remaining")
-        try:
-            page = get_page(url=url, proxy=proxy)
-            infos["price"] = get_price(page)
-            infos["title"] = page.find(id="productTitle").text.strip(" \n")
-            proxies.remove(proxy)  # remove used proxy from proxy list
+    gets blocked by the service): every attempt is reported back to the
+    proxy pool, which retires proxies failing repeatedly; if every proxy
+    fails, retry up to MAX_RETRIES times after an increasing delay (see
+    engine.backoff), giving the pool time to be refilled.
+    Block pages aren't held against the proxy: they're counted by the
+    site's circuit breaker (see engine.CircuitBreaker), which stops the
+    attempts until the site's pause is over
+    """
+    from engine import CircuitBreaker, backoff
+    from fetch import Blocked
+    from sites import MissingPrice
+
+    site = get_sites().site_name(url)
+    breaker = CircuitBreaker(metrics=get_metrics())
+    for retry in range(MAX_RETRIES + 1):
+        if retry > 0:
+            pause = breaker.wait(site)
+            if pause is None:
+                break  # the site keeps blocking requests
+            delay = max(backoff(retry), pause)
+            if pause > 0:
+                print(
+                    f"{site} is blocking requests, waiting {delay:.0f}s for "
+                    "next retry"
+                )
+            else:
+                # every proxy was not working or got blocked
+                print(
+                    "every proxy in list was not working or got blocked, "
+                    f"waiting {delay:.0f}s for next retry"
+                )
+            logging.warning(
+                f"no working proxy for {url}, retry in {delay:.0f}s"
+            )
+            sleep(delay)
+        for _ in range(MAX_PROXY_ATTEMPTS):
+            if breaker.wait(site) != 0:
+                break  # site paused
+            proxy = proxies.acquire()
+            if proxy is None:
+                break
+            start = monotonic()
+            try:
+                page = get_page(url=url, proxy=proxy)
+                breaker.passed(site)
+                infos = parse_page(url=url, page=page.text)
+                proxies.report(proxy, ok=True, latency=monotonic() - start)
+                return infos
+            except Blocked as e:
+                logging.warning(f"{url} blocked ({e})")
+                breaker.blocked(site)
+            except MissingPrice:
+                # no other proxy would find a price in the page
+                proxies.report(proxy, ok=True, latency=monotonic() - start)
+                logging.error(f"no price found for {url}")
+                sys_exit(f"ERROR: no price found for {url} (out of stock?)")
+            except Exception as e:
+                logging.error(f"proxy {proxy} failed ({e})")
+                proxies.report(proxy, ok=False)
+    logging.error("max retries reached, impossible to retrieve infos")
+    sys_exit("ERROR: max retries reached, impossible to retrieve infos")
+
+
+def fetch_page(
+    proxies: "ProxyPool", product: dict, spent: Callable[[], bool] = None
+) -> tuple:
+    """
+    Fetch stage of the update pipeline: return (proxy, page, latency),
+    trying different proxies on network errors; page is None if it didn't
+    change since the last update. Block pages are left to the pipeline (see
+    engine.CircuitBreaker), as products whose fetch budget gets spent()
+    (or whose update is stopped) before a proxy is tried, raising
+    engine.Spent
+    """
+    from engine import Spent
+    from fetch import Blocked
+
+    url = product["url"]
+    for _ in range(MAX_PROXY_ATTEMPTS):
+        if spent is not None and spent():
+            raise Spent(f"fetching stopped before {url}")
+        proxy = proxies.acquire()
+        if proxy is None:
             break
+        start = monotonic()
+        try:
+            page = get_page(
+                url=url, proxy=proxy, validators=product.get("validators")
+            )
+            return proxy, page, monotonic() - start
+        except Blocked:
+            raise
         except Exception as e:
             logging.error(f"proxy {proxy} failed ({e})")
-            continue
-    # proxy list got empty before non-blocked ones could be found
-    if len(proxies) <= 0:
-        # if no working proxy was found or every working proxy was blocked
-        # then sleep 10 minutes until new proxy list is available
-        # then recursively run this function
-        print(
-            "every proxy in list was not working or got blocked, waiting 10"
-            "minutes for next retry"
-        )
-        sleep(600)
-        get_brute(proxies=get_proxy_list(), url=url, retries=retries + 1)
-    return infos
+            proxies.report(proxy, ok=False)
+    raise RuntimeError("no working proxy available")
+
+
+def retrieve(
+    product_list: list,
+    workers: int,
+    parsers: int,
+    site_limit: int,
+    proxies: "ProxyPool",
+    summary: "RunSummary",
+    executor=None,
+    spent=None,
+) -> Iterator[tuple]:
+    """
+    Retrieve the infos of every product in <product_list> through the
+    update pipeline (see engine.update_pipeline), yielding (product, infos)
+    as they're parsed; products given up, or deferred once spent() tells
+    to stop fetching (e.g. the fetch budget is spent), are recorded in
+    <summary>.
+    Products sharing the same canonical url are fetched once, their infos
+    yielded for each of them
+    """
+    from engine import update_pipeline
+
+    sites = get_sites()
+    same = {}  # canonical url: products
+    for product in product_list:
+        same.setdefault(sites.canonical(product["url"]), []).append(product)
+    site_limits = {
+        site.name: site.concurrency or site_limit for site in sites
+    }
+    get_cache()  # opened once, before the fetcher threads share it
+    # products are fetched concurrently and parsed in worker processes
+    # (pages are fetched again through other proxies, then retried after a
+    # delay, until every price it's retrieved or the product is given up),
+    # while results are merged by the caller one at a time
+    for product, infos in update_pipeline(
+        products=[products[0] for products in same.values()],
+        fetch=lambda product: fetch_page(
+            proxies=proxies, product=product, spent=spent
+        ),
+        parse=parse_page,
+        unchanged=unchanged_infos,
+        report=proxies.report,
+        site_of=sites.site_name,
+        workers=workers,
+        parsers=parsers,
+        max_attempts=MAX_PROXY_ATTEMPTS,
+        site_limits=site_limits,
+        default_site_limit=site_limit,
+        retry_rounds=MAX_RETRIES,
+        summary=summary,
+        executor=executor,
+        metrics=get_metrics(),
+        spent=spent,
+    ):
+        products = same[sites.canonical(product["url"])]
+        for other in products[1:]:
+            if product["url"] in summary.failed:
+                summary.fail(other["url"], summary.failed[product["url"]])
+            if product["url"] in summary.deferred:
+                summary.defer(other["url"])
+            get_metrics().count("fetches_shared")
+        for other in products:
+            yield other, infos
+
+
+def parse_page(url: str, page: str) -> dict:
+    """
+    Parse stage of the update pipeline (runs in a worker process): return
+    the product infos found in <page>, raise if they can't be found
+    """
+    return get_sites().get(url).extract(page)
+
+
+def parse_cached(url: str, page: str) -> dict:
+    """
+    Parse a page of the page cache (runs in a worker process): return the
+    product infos found in <page>, {'error': reason} if they can't be found
+    """
+    try:
+        return parse_page(url, page)
+    except Exception as e:
+        return {"error": str(e) or type(e).__name__}
 
 
 def get_config() -> dict:
@@ -130,112 +324,180 @@ def get_config() -> dict:
         check_mail_addr(notifier_addr)
         config_opts["mail"] = {}
         config_opts["mail"]["smtp_server"] = smtp_server
-        config_opts["mail"]["port"] = config.get("mail", "port")
+        config_opts["mail"]["port"] = config.getint("mail", "port")
         config_opts["mail"]["notifier_addr"] = notifier_addr
         config_opts["mail"]["notifier_psw"] = config.get(
             "mail", "notifier_psw"
         )
+        # optional: plain SMTP instead of SMTP over SSL (e.g. local relays)
+        config_opts["mail"]["ssl"] = config.getboolean(
+            "mail", "ssl", fallback=True
+        )
+        # optional: number of parallel SMTP connections
+        config_opts["mail"]["connections"] = config.getint(
+            "mail", "connections", fallback=1
+        )
+    if "store" in config.sections():
+        config_opts["store"] = {}
+        # days after which daily prices are rolled up to weekly ones
+        config_opts["store"]["rollup_after"] = config.getint(
+            "store", "rollup_after", fallback=ROLLUP_AFTER
+        )
+    if "cache" in config.sections():
+        config_opts["cache"] = {}
+        # MiB of compressed pages kept in the page cache
+        config_opts["cache"]["size"] = (
+            config.getfloat("cache", "size", fallback=CACHE_SIZE) * 2**20
+        )
+    if "metrics" in config.sections():
+        config_opts["metrics"] = {}
+        # Prometheus textfile the run metrics are exported to
+        config_opts["metrics"]["textfile"] = config.get(
+            "metrics", "textfile", fallback=None
+        )
+    if "daemon" in config.sections():
+        config_opts["daemon"] = {}
+        # hours between two updates of a product, unless set with -i
+        config_opts["daemon"]["interval"] = (
+            config.getfloat("daemon", "interval", fallback=24) * 3600
+        )
     return config_opts
 
 
-def get_proxy_list() -> list:
-    print("Retrieving proxy list...")
-    try:
-        proxies = []
-        response = get(
-            PROXY_LIST_API_URL,
-            headers={"User-Agent": get_useragent()},
-        ).json()
-        print(f"{response['total']} proxies found")
-        for proxy in response["data"]:
-            proxies.append(f"{proxy['ip']}:{proxy['port']}")
-        return proxies
-    except Exception as e:
-        logging.error(f"unable to get proxy list ({e})")
-        sys_exit("ERROR: unable to get proxy list")
+@lru_cache(maxsize=None)
+def get_sites() -> "SiteRegistry":
+    """
+    Return the registry of the supported sites listed in sites.json, loaded
+    once per process
+    """
+    from sites import SiteRegistry
+
+    return SiteRegistry.load(SITES_FILE)
+
+
+@lru_cache(maxsize=None)
+def get_site_names() -> "SiteNames":
+    """
+    Return the site names of the url domains listed in sites.json, without
+    the site extractors (and the parsing modules) of get_sites()
+    """
+    from domains import SiteNames
+
+    return SiteNames.load(SITES_FILE)
 
 
 def get_date() -> str:
     return str(date.today())
 
 
-def get_page(url: str, proxy: str) -> BeautifulSoup:
+@lru_cache(maxsize=None)
+def get_useragents() -> "UserAgentProvider":
+    from useragents import UserAgentProvider
+
+    return UserAgentProvider(data_dir=XDG_DATA)
+
+
+@lru_cache(maxsize=None)
+def get_fetcher() -> "Fetcher":
+    """
+    Return the Fetcher shared by every request of the process
+    """
+    from fetch import Fetcher
+
+    return Fetcher(
+        useragent=get_useragent, block_marker=get_sites().block_marker
+    )
+
+
+def get_page(url: str, proxy: str, validators: dict = None) -> "Page":
+    """
+    Return the page at <url> requested through <proxy>, None if it didn't
+    change since the response <validators> were given (see Fetcher)
+    """
     print("Contacting server...")
-    page = get(
-        url=url,
-        headers={"User-Agent": get_useragent()},
-        proxies={
-            "http": f"http://{proxy}",
-            "https": f"http://{proxy}",
-        },
-        timeout=60,
-    ).text
-    page = BeautifulSoup(page, "lxml")
+    with get_metrics().span("get_page"):
+        page = get_fetcher().get(url=url, proxy=proxy, validators=validators)
+    cache = get_cache()
+    if page is not None and cache is not None:
+        cache.put(url, get_date(), page.text)
     return page
 
 
-def get_price(page: BeautifulSoup) -> float:
-    price = page.find(class_="a-offscreen")  # this is for AMAZON only atm
-    price = float(price.text.strip("\n")[:-1].replace(",", "."))
-    return price
+@lru_cache(maxsize=None)
+def get_cache() -> Optional["PageCache"]:
+    """
+    Return the page cache shared by every request of the process, None if
+    disabled ([cache] size = 0)
+    """
+    from cache import PageCache
+
+    config_opts = get_config() if isfile(CONFIG_FILE) else {}
+    size = config_opts.get("cache", {}).get("size", CACHE_SIZE * 2**20)
+    if size <= 0:
+        return None
+    check_data_dir()
+    return PageCache(CACHE_FILE, max_bytes=size)
+
+
+@lru_cache(maxsize=None)
+def get_metrics() -> "Metrics":
+    """
+    Return the timing spans and counters of the process (see Metrics)
+    """
+    from metrics import Metrics
+
+    return Metrics()
 
 
-def get_working_proxy(proxy_list: list) -> str:
+def export_metrics() -> None:
     """
-    Looking for working proxy requesting httpbin.org/ip which returns a
-    json containing the ip: if ip matches, then return <proxy_ip>:<port>
-    as a string
+    Write the metrics of the process so far to METRICS_FILE (json run
+    report) and, if configured, to the Prometheus textfile
     """
-    print("Looking for working proxy...")
-    while len(proxy_list) > 0:
-        proxy = choice(proxy_list)  # select random proxy from list
-        proxy_ip = proxy.split(":")[0]
+    from utils.files import write_atomic
+
+    metrics = get_metrics()
+    fetcher = get_fetcher()
+    metrics.set("requests", fetcher.requests)
+    metrics.set("not_modified", fetcher.not_modified)
+    metrics.set("blocked", fetcher.blocked)
+    metrics.set("bytes_transferred", fetcher.wire_bytes)
+    metrics.set("bytes_fetched", fetcher.content_bytes)
+    write_atomic(METRICS_FILE, metrics.json())
+    config_opts = get_config() if isfile(CONFIG_FILE) else {}
+    textfile = config_opts.get("metrics", {}).get("textfile")
+    if textfile:
         try:
-            response = get(
-                url="https://httpbin.org/ip",
-                proxies={
-                    "http": f"http://{proxy}",
-                    "https": f"http://{proxy}",
-                },
-                timeout=TIMEOUT,
-            ).json()
-            if response["origin"] == proxy_ip:
-                logging.info(f"using proxy {proxy_ip}")
-                print(f"Using proxy: {proxy_ip}")
-                return proxy
-        except Exception:
-            # remove not working proxy from list
-            proxy_list.remove(proxy)
-    logging.error("unable to find working proxy")
-    sys_exit("ERROR: unable to find working proxy")
+            write_atomic(textfile, metrics.prometheus())
+        except OSError as e:
+            logging.error(f"unable to write metrics to {textfile} ({e})")
+
+
+def profile_run(path: str) -> None:
+    """
+    Profile the rest of the run (main process only) with cProfile, writing
+    the stats to <path> at exit (see python -m pstats <path>)
+    """
+    from atexit import register
+    from cProfile import Profile
+
+    profiler = Profile()
+
+    def dump() -> None:
+        profiler.disable()
+        profiler.dump_stats(path)
+        print(f"profile written to {path}")
+
+    register(dump)
+    profiler.enable()
 
 
 def get_useragent() -> str:
     """
-    Return random useragent string using fake_useragent library for
-    anonimity and to prevent blocked requests. Update UserAgent's cache
-    monthly: look for ~/.local/share/useragents_<month>.json: if exists and
-    <month> correspond to current month then use that cache, otherwhise
-    rename file to current month and upadte UserAgent cache.
-    """
-    xdg_data_files = listdir(XDG_DATA)
-    need_cache_update = True
-    useragents_file = join(
-        XDG_DATA, "useragents_" + str(date.today().month) + ".json"
-    )
-    for file in xdg_data_files:
-        if "useragents" in file:
-            if int(file.split(".json")[0].split("_")[1]) == date.today().month:
-                need_cache_update = False
-            else:
-                rename(join(XDG_DATA, file), useragents_file)
-            break
-    ua = UserAgent(fallback=USERAGENT_FALLBACK, path=useragents_file)
-    # update user agent cache every month
-    if need_cache_update:
-        ua.update()
-        logging.warning("updated UserAgent cache")
-    return ua.random
+    Return random useragent string (see UserAgentProvider): the useragent
+    cache is loaded once per process
+    """
+    return get_useragents().random()
 
 
 # FILE READING/WRITING
@@ -249,236 +511,1070 @@ def check_data_dir() -> None:
             sys_exit(f"ERROR: unable to create directory {XDG_DATA}")
 
 
-def write_list(products: list) -> None:
-    with open(PRODUCT_LIST_FILE, "w+") as products_file:
-        products_file.write(json_dumps(products, indent=2))
+@lru_cache(maxsize=None)
+def get_store() -> Store:
+    check_data_dir()
+    store = Store(STORE_FILE)
+    if len(store) == 0 and isfile(PRODUCT_LIST_FILE):
+        warning_msg = (
+            f"empty product store but {PRODUCT_LIST_FILE} found, "
+            "import it with --migrate"
+        )
+        logging.warning(warning_msg)
+        print(f"WARNING: {warning_msg}")
+    return store
 
 
-def get_list() -> list:
-    # check for data file
-    if not isfile(PRODUCT_LIST_FILE):
-        check_data_dir()
-        write_list(products=[])
-        return []  # if file didn't exist, no need to read it
-    with open(PRODUCT_LIST_FILE, "r") as products_file:
-        product_list = json_loads(products_file.read())
-    return product_list
+@lru_cache(maxsize=None)
+def rollup_prices(today: str) -> None:
+    """
+    Roll up the daily prices older than 'rollup_after' days ([store]
+    configuration section, ROLLUP_AFTER if not set) to weekly lowest,
+    highest and last prices: runs once a day per process
+    """
+    config_opts = get_config() if isfile(CONFIG_FILE) else {}
+    days = config_opts.get("store", {}).get("rollup_after", ROLLUP_AFTER)
+    if days <= 0:
+        return
+    before = str(date.fromisoformat(today) - timedelta(days=days))
+    rolled = get_store().rollup(before)
+    if rolled > 0:
+        logging.info(
+            f"{rolled} daily prices older than {before} rolled up to weekly "
+            "prices"
+        )
+
+
+def canonicalize_products() -> None:
+    """
+    Rewrite the urls of the store to their canonical form (see
+    Site.canonical), merging the products found to be the same one: each
+    product is then fetched once, whatever link its followers used
+    """
+    renamed, merged = get_store().canonicalize(get_sites().canonical)
+    if renamed > 0 or merged > 0:
+        info_msg = (
+            f"{renamed} product urls made canonical, {merged} duplicate "
+            "products merged"
+        )
+        logging.info(info_msg)
+        print(info_msg)
+
+
+def migrate_list(path: str) -> None:
+    """
+    Import the products of a product_list.json file into the store
+    """
+    if not isfile(path):
+        logging.error(f"'{path}' not found")
+        sys_exit(f"ERROR: '{path}' not found")
+    try:
+        imported, merged = get_store().import_json(path)
+    except Exception as e:
+        logging.error(f"unable to import '{path}' ({e})")
+        sys_exit(f"ERROR: unable to import '{path}' ({e})")
+    info_msg = (
+        f"{imported} products imported, {merged} merged with existing ones "
+        f"from '{path}'"
+    )
+    logging.info(info_msg)
+    print(info_msg)
+    canonicalize_products()
 
 
 # NOTIFICATIONS
-def send_notification(mail_addr: str, mail_body: str) -> None:
-    print(f"Sending mail notification to {mail_addr}")
-    config_opts = get_config()
-    if "mail" in config_opts:
-        mail = EmailMessage()
-        mail["Subject"] = "Price Traker: lower price detected"
-        mail["To"] = mail_addr
-        mail["From"] = config_opts["mail"]["notifier_addr"]
-        mail.set_content(mail_body)
-        try:
-            with SMTP_SSL(
-                config_opts["mail"]["smtp_server"],
-                config_opts["mail"]["port"],
-                context=create_default_context(),
-            ) as server:
-                server.login(
-                    config_opts["mail"]["notifier_addr"],
-                    config_opts["mail"]["notifier_psw"],
-                )
-                server.send_message(mail)
-                logging.info(f"mail notification sent to {mail_addr}")
-        except Exception as e:
-            logging.error(
-                "unable to send mail notification " f"to '{mail_addr}' ({e})"
-            )
-            print(f"unable to send mail notification to '{mail_addr}'")
+def send_notifications(notification_queue: dict) -> None:
+    # configuration is read once, then the whole queue is sent over as few
+    # SMTP connections as configured; each notification is removed from the
+    # store queue as soon as it's delivered (or refused for good), so that
+    # an interrupted run doesn't send it twice, the others are sent again
+    # by the next update
+    from notify import Dispatcher
+
+    config_opts = get_config() if isfile(CONFIG_FILE) else {}
+    if "mail" not in config_opts:
+        logging.warning("no [mail] configuration, notifications not sent")
+        return
+    dispatcher = Dispatcher(
+        mail_opts=config_opts["mail"],
+        connections=config_opts["mail"]["connections"],
+        metrics=get_metrics(),
+    )
+    store = get_store()
+    dispatcher.dispatch(
+        notification_queue,
+        done=lambda mail_addr: store.clear_notifications([mail_addr]),
+    )
+    logging.info(dispatcher.stats())
+    print(dispatcher.stats())
+    export_metrics()
 
 
 # FEATURES
-def insert_product(url: str, mail_addr: str) -> None:
-    # check for valid url and mail address before continuing
-    check_url(url)
-    check_mail_addr(mail_addr)
-    product_list = get_list()
-    # look for product in product_list
-    for product in product_list:
-        if product["url"] == url:
-            if mail_addr in product["followers"]:
-                warning_msg = (
-                    f"'{mail_addr}' already tracking " f"'{product['url']}...'"
-                )
-                logging.warning(warning_msg)
-                # if mail_addr already in followers array, exit
-                sys_exit(f"WARNING: {warning_msg}")
-            else:
-                # product already in product_list but mail_addr not in
-                # followers so add mail_addr to followers and exit
-                product["followers"].append(mail_addr)
-                title = product["title"]
-                write_list(products=product_list)
-                logging.info(
-                    f"'{mail_addr}' started tracking '{title}' " f"({url})"
-                )
-                sys_exit(
-                    f"'{mail_addr}' started tracking '{title}' " f"({url})"
+def track(
+    url: str,
+    mail_addr: str,
+    interval: float = None,
+    proxies=None,
+    rule: str = None,
+) -> str:
+    """
+    <mail_addr> starts tracking <url>, notified following <rule> (see
+    analytics.RULES) if given, updated every <interval> seconds by the
+    daemon if given: retrieve the product through <proxies> (a new
+    ProxyPool if None) if not in the store yet; return the outcome message,
+    raise ValueError if there's nothing to do
+    """
+    from proxies import ProxyPool
+
+    if get_sites().site_name(url) not in get_sites().sites:
+        raise ValueError(f"'{url}' is not a supported site")
+    url = get_sites().canonical(url)
+    store = get_store()
+    # look for product in the store
+    product = store.find(url)
+    if product is not None:
+        if interval is not None:
+            store.set_interval(product["id"], interval)
+        if mail_addr in product["followers"]:
+            # if mail_addr already in followers array, nothing to do but
+            # updating interval and rule
+            if interval is None and rule is None:
+                raise ValueError(
+                    f"'{mail_addr}' already tracking '{product['url']}...'"
                 )
-    # if product not found in product_list, add new entry to product_list
+            store.add_follower(product["id"], mail_addr, rule)
+            return f"'{mail_addr}' tracking '{product['title']}' ({url}) " + (
+                f"updated every {interval / 3600:g} hours"
+                if interval is not None
+                else f"notified on '{rule}'"
+            )
+        # product already in the store but mail_addr not in
+        # followers so add mail_addr to followers
+        store.add_follower(product["id"], mail_addr, rule)
+        return f"'{mail_addr}' started tracking '{product['title']}' ({url})"
+    # if product not found in the store, add new entry to the store
     # get_brute function may take a while since it retries util every price
     # it's retrieved
-    proxies = get_proxy_list()
-    infos = get_brute(proxies=proxies, url=url)
-    product_list.append(
+    if proxies is None:
+        proxies = ProxyPool(
+            scores_file=PROXY_SCORES_FILE,
+            useragent=get_useragent,
+            metrics=get_metrics(),
+        ).start()
+        infos = get_brute(proxies=proxies, url=url)
+        proxies.stop()
+    else:
+        infos = get_brute(proxies=proxies, url=url)
+    store.add_product(
         {
             "url": url,
             "title": infos["title"],
             "followers": [mail_addr],
+            "rules": {} if rule is None else {mail_addr: rule},
             "prices": [{"date": get_date(), "price": infos["price"]}],
+            "checked": time(),
+            "interval": interval,
         }
     )
-    # write updated product_list to PRODUCT_LIST_FILE
-    write_list(products=product_list)
-    logging.info(
-        f"'{mail_addr}' started tracking '{infos['title']}' " f"({url})"
+    return f"'{mail_addr}' started tracking '{infos['title']}' ({url})"
+
+
+def untrack(url: str, mail_addr: str) -> str:
+    """
+    <mail_addr> stops tracking <url>, removing the product if nobody else
+    follows it: return the outcome message, raise ValueError if
+    <mail_addr> is not tracking <url>
+    """
+    store = get_store()
+    # stored as given by older versions, until canonicalized
+    product = store.find(url) or store.find(get_sites().canonical(url))
+    if product is None or mail_addr not in product["followers"]:
+        raise ValueError(f"'{mail_addr}' is not tracking '{url}'")
+    if len(product["followers"]) > 1:
+        store.remove_follower(product["id"], mail_addr)
+        return (
+            f"'{mail_addr}' stopped tracking '{product['title']}' "
+            f"({product['url']})"
+        )
+    store.remove_product(product["id"])
+    return f"'{product['title']}' ({product['url']}) removed"
+
+
+def track_many(
+    entries: list,
+    interval: float = None,
+    rule: str = None,
+    workers: int = DEFAULT_WORKERS,
+    parsers: int = DEFAULT_PARSERS,
+    site_limit: int = DEFAULT_SITE_LIMIT,
+    proxies=None,
+    executor=None,
+) -> list:
+    """
+    Each <mail_addr> of <entries> ([(line, url, mail_addr)]) starts tracking
+    its <url> (see track): products not in the store yet are retrieved
+    concurrently through one pool of <proxies> (a new ProxyPool if None)
+    and the parsers <executor> (if given), then everything is written to
+    the store at once; return the outcome of every entry as
+    [(line, ok, message)]
+    """
+    from engine import RunSummary
+    from proxies import ProxyPool
+
+    store = get_store()
+    outcomes = {}
+    new = {}  # url: product to retrieve
+    known = []  # entries of products already in the store
+    seen = {}  # (url, mail_addr): line
+    for line, url, mail_addr in entries:
+        if (url, mail_addr) in seen:
+            outcomes[line] = (False, f"same as line {seen[url, mail_addr]}")
+            continue
+        seen[url, mail_addr] = line
+        if store.find(url) is not None:
+            known.append((line, url, mail_addr))
+            continue
+        product = new.setdefault(
+            url, {"url": url, "followers": [], "rules": {}, "lines": []}
+        )
+        product["followers"].append(mail_addr)
+        product["lines"].append(line)
+        if rule is not None:
+            product["rules"][mail_addr] = rule
+    retrieved = []
+    if len(new) > 0:
+        warm = proxies is not None
+        if not warm:
+            proxies = ProxyPool(
+                scores_file=PROXY_SCORES_FILE,
+                useragent=get_useragent,
+                metrics=get_metrics(),
+            ).start()
+        summary = RunSummary()
+        for product, infos in retrieve(
+            list(new.values()),
+            workers,
+            parsers,
+            site_limit,
+            proxies=proxies,
+            summary=summary,
+            executor=executor,
+        ):
+            if product["url"] in summary.failed:
+                for line in product["lines"]:
+                    outcomes[line] = (
+                        False,
+                        f"unable to retrieve infos of '{product['url']}'",
+                    )
+                continue
+            retrieved.append((product, infos))
+        if not warm:
+            proxies.stop()
+            get_fetcher().close_all()
+    # a single store write
+    with store.batch():
+        for line, url, mail_addr in known:
+            try:
+                outcomes[line] = (
+                    True,
+                    track(url, mail_addr, interval, rule=rule),
+                )
+            except ValueError as e:
+                outcomes[line] = (False, str(e))
+        for product, infos in retrieved:
+            store.add_product(
+                {
+                    **product,
+                    "title": infos["title"],
+                    "prices": [{"date": get_date(), "price": infos["price"]}],
+                    "validators": infos.get("validators"),
+                    "checked": time(),
+                    "interval": interval,
+                }
+            )
+            for line, mail_addr in zip(product["lines"], product["followers"]):
+                outcomes[line] = (
+                    True,
+                    f"'{mail_addr}' started tracking '{infos['title']}' "
+                    f"({product['url']})",
+                )
+    return [(line, *outcomes[line]) for line, _, _ in entries]
+
+
+def untrack_many(entries: list) -> list:
+    """
+    Each <mail_addr> of <entries> ([(line, url, mail_addr)]) stops tracking
+    its <url> (see untrack), in a single store write; return the outcome of
+    every entry as [(line, ok, message)]
+    """
+    outcomes = []
+    with get_store().batch():
+        for line, url, mail_addr in entries:
+            try:
+                outcomes.append((line, True, untrack(url, mail_addr)))
+            except ValueError as e:
+                outcomes.append((line, False, str(e)))
+    return outcomes
+
+
+def outcome_report(outcomes: list) -> str:
+    """
+    Per line report of the [(line, ok, message)] <outcomes> of a bulk insert
+    or remove
+    """
+    failed = sum(1 for _, ok, _ in outcomes if not ok)
+    return "\n".join(
+        [
+            f"line {line}: {message if ok else 'FAILED: ' + message}"
+            for line, ok, message in outcomes
+        ]
+        + [f"{len(outcomes) - failed} lines done, {failed} failed"]
+    )
+
+
+def forward(command: dict) -> None:
+    """
+    Hand <command> over to the running daemon, which owns the product store
+    """
+    from daemon import NoReply, send_command
+
+    try:
+        reply = send_command(SOCKET_FILE, command)
+    except NoReply as e:
+        # still queued: run by the daemon once the update in progress ends
+        error_msg = f"{e}, the command is left to the daemon (see the log)"
+        logging.error(error_msg)
+        sys_exit(f"ERROR: {error_msg}")
+    except OSError as e:
+        logging.error(f"unable to reach the daemon ({e})")
+        sys_exit(f"ERROR: unable to reach the daemon ({e})")
+    if not reply["ok"]:
+        logging.error(reply["message"])
+        sys_exit(f"ERROR: {reply['message']}")
+    print(reply["message"])
+
+
+def insert_product(
+    url: str,
+    mail_addr: str,
+    interval: float = None,
+    rule: str = None,
+    daemon: bool = False,
+) -> None:
+    # check for valid url, mail address and rule before continuing
+    check_url(url)
+    check_mail_addr(mail_addr)
+    if rule is not None:
+        rule = check_rule(rule)
+    if get_sites().site_name(url) not in get_sites().sites:
+        logging.error(f"'{url}' is not a supported site")
+        sys_exit(f"ERROR: '{url}' is not a supported site")
+    url = get_sites().canonical(url)
+    if daemon:
+        forward(
+            {
+                "command": "insert",
+                "url": url,
+                "mail": mail_addr,
+                "interval": interval,
+                "rule": rule,
+            }
+        )
+        sys_exit("Done")
+    try:
+        info_msg = track(url, mail_addr, interval, rule=rule)
+    except ValueError as e:
+        logging.warning(e)
+        sys_exit(f"WARNING: {e}")
+    logging.info(info_msg)
+    sys_exit(f"{info_msg}\nDone")
+
+
+def listing_entry(product: dict) -> dict:
+    """
+    Listing fields of <product> (as handed out by the store, with its last
+    two prices)
+    """
+    prices = product["prices"]
+    entry = {
+        "id": product["id"],
+        "url": product["url"],
+        "title": product["title"],
+        "price": prices[-1]["price"] if len(prices) > 0 else None,
+        "date": prices[-1]["date"] if len(prices) > 0 else None,
+        "previous": prices[-2]["price"] if len(prices) > 1 else None,
+        "delta": None,
+        "followers": product["followers"],
+        "rules": product["rules"],
+    }
+    if entry["price"] is not None and entry["previous"] is not None:
+        entry["delta"] = round(entry["price"] - entry["previous"], 2)
+    return entry
+
+
+def product_tree(entry: dict, cols: int, color: bool) -> str:
+    """
+    Tree of the listing <entry>, fitting <cols> terminal columns, colored
+    if <color>
+    """
+    from utils.colorizer import Colorize
+    from utils.date import format_date
+    from utils.text import wrap
+
+    title = entry["title"] or ""
+    if len(title) > cols - 3:
+        title = title[: max(cols - 6, 1)] + "..."
+    price = "no price yet"
+    if entry["price"] is not None:
+        price = f"{entry['price']}€"
+    if entry["delta"]:
+        delta = f"{entry['delta']:+}€"
+        if color:
+            drop = entry["delta"] < 0
+            delta = Colorize.fg(delta, "green" if drop else "red")
+        price += f" ({delta})"
+    if color:
+        title = Colorize.style(title, "cbold")
+    date = format_date(entry["date"]) if entry["date"] else "never updated"
+    return (
+        f"├─ {title}\n"
+        f"│  ├── {wrap(entry['url'], prefix_length=7, cols=cols)}\n"
+        f"│  ├── {price}\n"
+        f"│  ├── {date}\n"
+        f"│  └── {', '.join(entry['followers'])}"
     )
-    sys_exit(
-        f"'{mail_addr}' started tracking '{infos['title']}' "
-        f"({url})\n"
-        "Done"
+
+
+def list_products(
+    mail_addr: str = None,
+    site: str = None,
+    title: str = None,
+    sort: str = None,
+    limit: int = None,
+    offset: int = 0,
+    as_json: bool = False,
+) -> None:
+    """
+    Print the tracked products followed by <mail_addr>, of <site> and whose
+    title contains <title>, if given, sorted by <sort> ('delta' or
+    'updated', see Store.listing), <offset> and <limit> paging the list:
+    products are streamed from the store as they're printed, as trees or
+    as NDJSON (a json object per line) if <as_json>
+    """
+    from json import dumps as json_dumps
+    from shutil import get_terminal_size
+
+    if mail_addr is not None:
+        check_mail_addr(mail_addr)
+    site_of = None
+    if site is not None:
+        if site not in get_site_names():
+            logging.error(f"'{site}' is not a supported site")
+            sys_exit(f"ERROR: '{site}' is not a supported site")
+        site_of = get_site_names().site_name
+    if (limit is not None and limit < 0) or offset < 0:
+        sys_exit("ERROR: --limit and --offset can't be negative")
+    products = get_store().listing(
+        mail=mail_addr,
+        title=title,
+        site=site,
+        site_of=site_of,
+        sort=sort,
+        limit=limit,
+        offset=offset,
     )
+    # looked up once for the whole listing
+    cols = get_terminal_size().columns
+    color = stdout.isatty()
+    try:
+        for product in products:
+            entry = listing_entry(product)
+            if as_json:
+                print(json_dumps(entry, ensure_ascii=False))
+            else:
+                print(product_tree(entry, cols, color))
+    except BrokenPipeError:
+        # output piped to a command that exited early (e.g. head): silence
+        # the flush at exit
+        from os import O_WRONLY, devnull, dup2
+        from os import open as open_fd
 
+        dup2(open_fd(devnull, O_WRONLY), stdout.fileno())
 
-def list_products() -> None:
-    product_list = get_list()
-    for product in product_list:
+
+def show_stats() -> None:
+    """
+    Report price figures of every product, computed in one batched pass
+    over the whole price history (see analytics.price_stats)
+    """
+    from analytics import PERCENTILE, WINDOW, price_stats
+
+    def euros(price: Optional[float]) -> str:
+        # prices imported as null by --migrate (failed retrievals)
+        return "n/a" if price is None else f"{price:.2f}€"
+
+    store = get_store()
+    stats = price_stats(store)
+    for product in store.products():
+        if product["id"] not in stats:
+            continue
+        figures = stats[product["id"]]
+        change = ""
+        if figures.change is not None:
+            change = f" ({figures.change:+.1f}%)"
         print(
-            f"├─ {product['title'][:50]}...\n"
-            f"│  ├── {product['prices'][-1]['price']}€\n"
-            f"│  ├── {product['prices'][-1]['date']}\n"
-            f"│  └── {', '.join(product['followers'])}"
+            f"├─ {(product['title'] or '')[:50]}...\n"
+            f"│  ├── price: {euros(figures.price)}{change}\n"
+            f"│  ├── all-time low: {euros(figures.low)}\n"
+            f"│  └── {WINDOW} days: low {euros(figures.window_low)}, "
+            f"mean {euros(figures.window_mean)}, {PERCENTILE}th percentile "
+            f"{euros(figures.window_percentile)}"
         )
 
 
-def remove_product(substr: str, mail_addr: str) -> None:
+def remove_product(
+    substr: str, mail_addr: str, daemon: bool = False
+) -> None:
     # check for valid mail address before continuing
     check_mail_addr(mail_addr)
-    product_list = get_list()
-    for product in product_list:
-        if substr.lower() in product["title"].lower():
-            if mail_addr not in product["followers"]:
-                not_tracking_msg = (
-                    f"'{mail_addr}' is not tracking '{product['url']}'"
-                )
-                logging.error(not_tracking_msg)
-                sys_exit("ERROR: " + not_tracking_msg)
-            confirm_msg = (
-                f"Remove '{mail_addr}' from "
-                f"'{product['title']}' followers list? [y/N]: "
-            )
-            if input(confirm_msg).lower() == "y":
-                if len(product["followers"]) > 1:
-                    product["followers"].remove(mail_addr)
-                    info_msg = (
-                        f"'{mail_addr}' stopped tracking "
-                        f"'{product['title']}' "
-                        f"({product['url']})"
-                    )
-                    logging.info(info_msg)
-                    print(info_msg)
-                else:
-                    product_list.remove(product)
-                    info_msg = (
-                        f"'{product['title']}' ({product['url']}) removed"
-                    )
-                    logging.info(info_msg)
-                    print(info_msg)
-                write_list(products=product_list)
-            break
-        else:
+    store = get_store()
+    product_list = store.search(substr, mail=mail_addr)
+    if len(product_list) == 0:
+        if len(store.search(substr)) == 0:
             warning_msg = f"no tracked product matching query '{substr}'"
             logging.warning(warning_msg)
             sys_exit("WARNING: " + warning_msg)
+        not_tracking_msg = (
+            f"'{mail_addr}' is not tracking any product matching '{substr}'"
+        )
+        logging.error(not_tracking_msg)
+        sys_exit("ERROR: " + not_tracking_msg)
+    product = product_list[0]
+    confirm_msg = (
+        f"Remove '{mail_addr}' from "
+        f"'{product['title']}' followers list? [y/N]: "
+    )
+    if input(confirm_msg).lower() == "y":
+        if daemon:
+            forward(
+                {"command": "remove", "url": product["url"], "mail": mail_addr}
+            )
+            return
+        info_msg = untrack(product["url"], mail_addr)
+        logging.info(info_msg)
+        print(info_msg)
+
+
+def read_entries(path: str) -> list:
+    """
+    Read the '<url> <mail>' lines of <path> ('-' for stdin), skipping blank
+    lines and comments (#), checking them all before anything is done:
+    return [(line, url, mail)], exit listing the invalid lines if any
+    """
+    if path == "-":
+        lines = stdin.read().splitlines()
+    elif isfile(path):
+        with open(path, "r") as entries_file:
+            lines = entries_file.read().splitlines()
+    else:
+        logging.error(f"'{path}' not found")
+        sys_exit(f"ERROR: '{path}' not found")
+    entries = []
+    invalid = []
+    for line, text in enumerate(lines, start=1):
+        fields = text.split()
+        if len(fields) == 0 or fields[0].startswith("#"):
+            continue
+        if len(fields) != 2:
+            invalid.append(f"line {line}: expected '<url> <mail>'")
+        elif not valid_url(fields[0]):
+            invalid.append(f"line {line}: '{fields[0]}' is not a valid URL")
+        elif not valid_mail_addr(fields[1]):
+            invalid.append(
+                f"line {line}: '{fields[1]}' is not a valid mail address"
+            )
+        elif get_sites().site_name(fields[0]) not in get_sites().sites:
+            invalid.append(
+                f"line {line}: '{fields[0]}' is not a supported site"
+            )
+        else:
+            entries.append(
+                (line, get_sites().canonical(fields[0]), fields[1])
+            )
+    if len(invalid) > 0:
+        for error_msg in invalid:
+            logging.error(error_msg)
+        sys_exit("ERROR: nothing done, invalid lines\n" + "\n".join(invalid))
+    if len(entries) == 0:
+        logging.warning(f"no entries in '{path}'")
+        sys_exit(f"WARNING: no entries in '{path}'")
+    return entries
+
+
+def bulk_update(
+    command: str,
+    path: str,
+    interval: float = None,
+    rule: str = None,
+    daemon: bool = False,
+    workers: int = DEFAULT_WORKERS,
+    parsers: int = DEFAULT_PARSERS,
+    site_limit: int = DEFAULT_SITE_LIMIT,
+) -> None:
+    """
+    Run the bulk <command> ('insert-many' or 'remove-many') on the entries
+    of <path> (see read_entries), printing the outcome of every line
+    """
+    if rule is not None:
+        rule = check_rule(rule)
+    entries = read_entries(path)
+    if daemon:
+        forward(
+            {
+                "command": command,
+                "entries": entries,
+                "interval": interval,
+                "rule": rule,
+            }
+        )
+        sys_exit("Done")
+    if command == "insert-many":
+        outcomes = track_many(
+            entries, interval, rule, workers, parsers, site_limit
+        )
+    else:
+        outcomes = untrack_many(entries)
+    for line, ok, message in outcomes:
+        if ok:
+            logging.info(message)
+        else:
+            logging.warning(f"line {line} of '{path}': {message}")
+    print(outcome_report(outcomes))
+    if not all(ok for _, ok, _ in outcomes):
+        sys_exit("Done, with failures")
+    print("Done")
+
+
+def unchanged_infos(product: dict) -> dict:
+    """
+    Infos of a product whose page didn't change since the last update
+    """
+    return {"title": product["title"], "price": product["prices"][-1]["price"]}
+
+
+def apply_infos(
+    product: dict,
+    infos: dict,
+    today: str,
+    notification_queue: dict,
+    thresholds=None,
+) -> bool:
+    """
+    Merge freshly retrieved <infos> into <product> and queue a notification
+    for its followers if the price dropped (according to each follower's
+    rule, if <thresholds> are given, see analytics.Thresholds); return False
+    if the product could not be updated
+    """
+    # checking if the product title
+    # corresponds to the one we are looking for
+    if infos["title"] != product["title"]:
+        logging.warning(
+            f"{product['url']} does not correspond to given product"
+            "title... skipping"
+        )
+        print(
+            f"{product['url']} does not correspond to given product"
+            "title... skipping"
+        )
+        return False
+    if "validators" in infos:
+        product["validators"] = infos["validators"]
+    today_price = infos["price"]
+    product["prices"].append({"date": today, "price": today_price})
+    prev_price = None
+    if len(product["prices"]) > 1:
+        prev_price = product["prices"][-2]["price"]
+    if today_price is None or prev_price is None:
+        # nothing to compare (e.g. null prices imported by --migrate)
+        return True
+    price_delta = round(today_price - prev_price, 2)
+    # if product has lower price than last check (or reached the followers'
+    # thresholds), add followers to notification_queue
+    if thresholds is None:
+        followers = product["followers"] if price_delta < 0 else []
+    else:
+        followers = [
+            follower
+            for follower in product["followers"]
+            if thresholds.notify(product, follower, today_price, prev_price)
+        ]
+    if len(followers) > 0:
+        percent = ""
+        if prev_price != 0:
+            percent = f" ({price_delta / prev_price * 100:+.1f}%)"
+        notification_body = (
+            f"├─ {product['title']}\n"
+            f"│   ├── url: {product['url']}\n"
+            f"│   ├── previous price: {prev_price}€ "
+            f"({product['prices'][-2]['date']})\n"
+            f"│   ├── current price: {today_price}€ ({today})\n"
+            f"│   └── delta: {price_delta}€{percent}\n"
+        )
+        # for each follower of the product, append the notification_body
+        # if it already exists in the notification_queue,
+        # create an instance otherwhise
+        for follower in followers:
+            if follower in notification_queue:
+                notification_queue[follower] += notification_body
+            else:
+                notification_queue[follower] = notification_body
+    return True
+
+
+def fetch_prices(
+    product_list: list,
+    today: str,
+    workers: int,
+    parsers: int,
+    site_limit: int,
+    proxies=None,
+    executor=None,
+    budget: "Budget" = None,
+    stop: Callable[[], bool] = None,
+) -> None:
+    """
+    Retrieve today's price of every product in <product_list>, writing each
+    product (with the notifications about it) to the store as soon as it's
+    done, so that an interrupted update loses nothing; <proxies> and the
+    parsers <executor> are created for this update if not given (otherwise
+    they are left running, as the HTTP sessions).
+    Given a fetch <budget>, products are fetched by priority (see
+    priority.prioritize) until the budget is spent, the others are left
+    for the next update, as they are once stop() tells to stop (e.g. the
+    daemon being stopped)
+    """
+    from analytics import Thresholds, price_volatility
+    from engine import RunSummary
+    from priority import prioritize
+    from proxies import ProxyPool
 
+    store = get_store()
+    priorities = {}
+    if budget is not None:
+        ranked = prioritize(
+            product_list, price_volatility(store, before=today), now=time()
+        )
+        product_list = [product for product, _ in ranked]
+        priorities = {product["id"]: priority for product, priority in ranked}
+    # followers' thresholds are checked against the price history of every
+    # product in the batch, computed at once
+    thresholds = Thresholds(store, product_list, before=today)
+    warm = proxies is not None
+    if not warm:
+        proxies = ProxyPool(
+            scores_file=PROXY_SCORES_FILE,
+            useragent=get_useragent,
+            metrics=get_metrics(),
+        ).start()
+    start = monotonic()
+    updated = 0
+    summary = RunSummary()
+    spent = None
+    if budget is not None:
+        spent = budget.start(requests=lambda: get_fetcher().requests)
+
+    def halted() -> bool:
+        if stop is not None and stop():
+            return True
+        return spent is not None and spent()
 
-def update_prices() -> None:
-    # list of product whose price is not up to date and needs to be updated
+    def deferral() -> str:
+        if stop is not None and stop():
+            return "stopping"
+        return f"budget of {budget} spent"
+
+    for product, infos in retrieve(
+        product_list,
+        workers,
+        parsers,
+        site_limit,
+        proxies=proxies,
+        summary=summary,
+        executor=executor,
+        spent=None if budget is None and stop is None else halted,
+    ):
+        if product["url"] in summary.failed:
+            continue  # already logged, price left as is until next update
+        if product["url"] in summary.deferred:
+            priority = priorities.get(product["id"])
+            logging.info(
+                f"deferred {product['url']}, {deferral()}"
+                + ("" if priority is None else f" ({priority})")
+            )
+            continue
+        notifications = {}
+        if apply_infos(product, infos, today, notifications, thresholds):
+            # small incremental write, one product at a time
+            with get_metrics().span("add_price"):
+                store.add_price(
+                    product["id"],
+                    today,
+                    infos["price"],
+                    infos.get("validators"),
+                    notifications,
+                )
+            updated += 1
+    elapsed = monotonic() - start
+    fetcher = get_fetcher()
+    if not warm:
+        proxies.stop()
+        fetcher.close_all()
+    logging.info(get_useragents().stats())
+    logging.info(fetcher.stats())
+    print(fetcher.stats())
+    if get_cache() is not None:
+        logging.info(get_cache().stats())
+    stats_msg = (
+        f"{updated}/{len(product_list)} products updated in {elapsed:.1f}s "
+        f"({len(product_list) / elapsed:.2f} products/s, {workers} fetchers, "
+        f"{parsers} parsers)"
+    )
+    logging.info(stats_msg)
+    print(stats_msg)
+    if len(summary.deferred) > 0:
+        deferred_msg = (
+            f"{len(summary.deferred)} products deferred to the next update, "
+            f"{deferral()} (see log)"
+        )
+        logging.warning(deferred_msg)
+        print(deferred_msg)
+    logging.info(summary.report())
+    print(summary.report())
+    rollup_prices(today)
+    export_metrics()
+
+
+def update_prices(
+    workers: int = DEFAULT_WORKERS,
+    parsers: int = DEFAULT_PARSERS,
+    site_limit: int = DEFAULT_SITE_LIMIT,
+    budget: "Budget" = None,
+) -> None:
+    # list of product whose price is not up to date and needs to be updated:
+    # products already updated today (e.g. by an interrupted run) are not
+    # fetched again
+    canonicalize_products()
     product_list = []
     today = get_date()
-    for product in get_list():
+    store = get_store()
+    for product in store.products():
         # if the last price update is today,
         # ignore updating price for that product
         if product["prices"][-1]["date"] == today:
-            print(f"{product['title'][:50]} price up to date")
+            print(f"{(product['title'] or '')[:50]} price up to date")
             continue
         else:
             product_list.append(product)
-    if len(product_list) == 0:
+    # notifications left by an interrupted run
+    pending = len(store.pending_notifications())
+    if pending > 0:
+        info_msg = f"resuming: {pending} notifications left to send"
+        logging.info(info_msg)
+        print(info_msg)
+    elif len(product_list) == 0:
         sys_exit("Done")
-    proxies = get_proxy_list()
-    print(f"{len(proxies)} proxies found")
-    # exit on empty product_list
-    if len(product_list) == 0:
-        logging.warning("update request with empty product list")
-        sys_exit("WARNING: no products tracking list")
-    notification_queue = {}
+    if len(product_list) > 0:
+        fetch_prices(
+            product_list, today, workers, parsers, site_limit, budget=budget
+        )
+    notification_queue = store.pending_notifications()
     # notification_queue object structure:
     # {
     #   'mail_addr1': 'mail_body1',
     #   'mail_addr2': 'mail_body2',
     # }
-    for product in product_list:
-        # get_brute function may take a while since it retries util every price
-        # it's retrieved
-        infos = get_brute(proxies=proxies, url=product["url"])
-        # checking if the product title
-        # corresponds to the one we are looking for
-        if infos["title"] != product["title"]:
-            logging.warning(
-                f"{product['url']} does not correspond to given product"
-                "title... skipping"
-            )
-            print(
-                f"{product['url']} does not correspond to given product"
-                "title... skipping"
-            )
-            continue
-        today_price = infos["price"]
-        product["prices"].append({"date": today, "price": today_price})
-        prev_price = product["prices"][-2]["price"]
-        price_delta = round(today_price - prev_price, 2)
-        # if product has lower price than last check,
-        # add followers to notification_queue
-        if price_delta < 0:
-            notification_body = (
-                f"├─ {product['title']}\n"
-                f"│   ├── url: {product['url']}\n"
-                f"│   ├── previous price: {prev_price}€ "
-                f"({product['prices'][-2]['date']})\n"
-                f"│   ├── current price: {today_price}€ ({today})\n"
-                f"│   └── delta: {price_delta}€\n"
-            )
-            # for each follower of the product, append the notification_body
-            # if it already exists in the notification_queue,
-            # create an instance otherwhise
-            for follower in product["followers"]:
-                if follower in notification_queue:
-                    notification_queue[follower] += notification_body
-                else:
-                    notification_queue[follower] = notification_body
-    # write updated product_list to PRODUCT_LIST_FILE
-    write_list(products=product_list)
     if len(notification_queue) == 0:
         logging.info("No lower prices detected")
         sys_exit("No lower prices detected\nDone")
     print("Sending e-mail notifications...")
-    # mail
-    for mail_addr in notification_queue:
-        send_notification(
-            mail_addr=mail_addr,
-            mail_body=notification_queue[mail_addr],
+    send_notifications(notification_queue)
+    print("Done")
+
+
+def replay_prices(since: str = None, parsers: int = DEFAULT_PARSERS) -> None:
+    """
+    Parse again the pages of the tracked products kept in the page cache
+    (only the ones fetched since <since>, 'YYYY-MM-DD', if given) in
+    <parsers> processes and write
+    the prices found to the store, replacing the ones of the same dates:
+    prices can be backfilled after fixing a site's selectors without any
+    network access (no notification is sent)
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+
+    if since is not None:
+        try:
+            date.fromisoformat(since)
+        except ValueError:
+            logging.error(f"'{since}' is not a valid date")
+            sys_exit(f"ERROR: '{since}' is not a valid date (YYYY-MM-DD)")
+    cache = get_cache()
+    if cache is None:
+        logging.error("page cache disabled, nothing to replay")
+        sys_exit("ERROR: page cache disabled, nothing to replay")
+    store = get_store()
+    products = {product["url"]: product for product in store.products()}
+    start = monotonic()
+    replayed = written = 0
+    pages = cache.pages(list(products), since or "0000-00-00")
+    with ProcessPoolExecutor(
+        max_workers=max(1, parsers), mp_context=get_context("spawn")
+    ) as executor:
+        while len(batch := list(islice(pages, REPLAY_BATCH))) > 0:
+            prices = []
+            for (url, day, _), infos in zip(
+                batch,
+                executor.map(
+                    parse_cached,
+                    [url for url, _, _ in batch],
+                    [page for _, _, page in batch],
+                    chunksize=max(1, len(batch) // (4 * max(1, parsers))),
+                ),
+            ):
+                product = products[url]
+                if "error" in infos:
+                    logging.warning(
+                        f"cached page of {url} ({day}) not parsed "
+                        f"({infos['error']})"
+                    )
+                elif infos["title"] != product["title"]:
+                    logging.warning(
+                        f"cached page of {url} ({day}) does not correspond "
+                        "to given product title"
+                    )
+                else:
+                    prices.append((product["id"], day, infos["price"]))
+            # one write per batch
+            store.add_prices(prices)
+            replayed += len(batch)
+            written += len(prices)
+    elapsed = monotonic() - start
+    info_msg = (
+        f"{replayed} cached pages replayed in {elapsed:.1f}s "
+        f"({replayed / max(elapsed, 1e-3):.0f} pages/s, {parsers} parsers): "
+        f"{written} prices written, {replayed - written} pages not parsed"
+    )
+    logging.info(info_msg)
+    print(info_msg)
+    rollup_prices(get_date())
+
+
+def run_daemon(
+    workers: int = DEFAULT_WORKERS,
+    parsers: int = DEFAULT_PARSERS,
+    site_limit: int = DEFAULT_SITE_LIMIT,
+) -> None:
+    """
+    Keep updating every product on its own interval until stopped (SIGTERM
+    or ctrl-c), taking -i and -r from the CLI through SOCKET_FILE: proxy
+    pool, parser processes, HTTP sessions and product index stay warm
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+    from signal import SIGTERM, signal
+
+    from daemon import DEFAULT_INTERVAL, Daemon
+    from proxies import ProxyPool
+
+    # the configuration is optional, as for -u
+    config_opts = get_config() if isfile(CONFIG_FILE) else {}
+    canonicalize_products()
+    store = get_store()
+    proxies = ProxyPool(
+        scores_file=PROXY_SCORES_FILE,
+        useragent=get_useragent,
+        metrics=get_metrics(),
+    ).start()
+    executor = ProcessPoolExecutor(
+        max_workers=max(1, parsers), mp_context=get_context("spawn")
+    )
+
+    def update(product_list: list) -> None:
+        # stopping (SIGTERM) defers the rest of the batch to the next run
+        fetch_prices(
+            product_list,
+            get_date(),
+            workers,
+            parsers,
+            site_limit,
+            proxies=proxies,
+            executor=executor,
+            stop=lambda: daemon.stopped,
         )
+        for product in product_list:
+            # only the last price is needed to detect the next drop
+            product["prices"] = product["prices"][-1:]
+        notification_queue = store.pending_notifications()
+        if len(notification_queue) > 0 and not daemon.stopped:
+            send_notifications(notification_queue)
+
+    daemon = Daemon(
+        socket_file=SOCKET_FILE,
+        load=store.products,
+        update=update,
+        handlers={
+            "insert": lambda command: track(
+                command["url"],
+                command["mail"],
+                command.get("interval"),
+                proxies=proxies,
+                rule=command.get("rule"),
+            ),
+            "remove": lambda command: untrack(
+                command["url"], command["mail"]
+            ),
+            "insert-many": lambda command: outcome_report(
+                track_many(
+                    command["entries"],
+                    command.get("interval"),
+                    command.get("rule"),
+                    workers,
+                    parsers,
+                    site_limit,
+                    proxies=proxies,
+                    executor=executor,
+                )
+            ),
+            "remove-many": lambda command: outcome_report(
+                untrack_many(command["entries"])
+            ),
+        },
+        interval=config_opts.get("daemon", {}).get(
+            "interval", DEFAULT_INTERVAL
+        ),
+    )
+    signal(SIGTERM, lambda signum, frame: daemon.stop())
+    print(f"Daemon running, listening on {SOCKET_FILE}")
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        executor.shutdown()
+        proxies.stop()
+        get_fetcher().close_all()
+        logging.info("daemon stopped")
     print("Done")
 
 
+def daemon_listening() -> bool:
+    from daemon import listening
+
+    return listening(SOCKET_FILE)
+
+
 # MAIN
 def main() -> None:
     # if log file doesn't exist, create it
@@ -512,6 +1608,61 @@ def main() -> None:
         action="store_true",
         help="list all the tracked products",
     )
+    argparser.add_argument(
+        "--mine",
+        type=str,
+        metavar="<mail>",
+        help="list the products tracked by <mail>",
+    )
+    argparser.add_argument(
+        "--site",
+        type=str,
+        metavar="<site>",
+        help="with -l or --mine, list only the products of <site>",
+    )
+    argparser.add_argument(
+        "--title",
+        type=str,
+        metavar="<title_substr>",
+        help="with -l or --mine, list only the products matching the title",
+    )
+    argparser.add_argument(
+        "--sort",
+        choices=("delta", "updated"),
+        help=(
+            "with -l or --mine, sort by last price change (biggest drops "
+            "first) or by last update (most recent first)"
+        ),
+    )
+    argparser.add_argument(
+        "--limit",
+        type=int,
+        metavar="<n>",
+        help="with -l or --mine, list at most <n> products",
+    )
+    argparser.add_argument(
+        "--offset",
+        type=int,
+        default=0,
+        metavar="<n>",
+        help="with -l or --mine, skip the first <n> products",
+    )
+    argparser.add_argument(
+        "--json",
+        action="store_true",
+        help=(
+            "with -l or --mine, print a json object per product (NDJSON) "
+            "instead of the tree"
+        ),
+    )
+    argparser.add_argument(
+        "--stats",
+        action="store_true",
+        help=(
+            "report price figures (all-time low, rolling 30 days low, mean "
+            "and percentile, last change) of all the tracked products"
+        ),
+    )
     argparser.add_argument(
         "-r",
         "--remove",
@@ -523,25 +1674,230 @@ def main() -> None:
             "(<title_substr> indicates a substring of the product title)"
         ),
     )
+    argparser.add_argument(
+        "--insert-from",
+        type=str,
+        metavar="<file>",
+        help=(
+            "as -i, for every '<url> <mail>' line of <file> ('-' for stdin), "
+            "retrieving new products concurrently"
+        ),
+    )
+    argparser.add_argument(
+        "--remove-from",
+        type=str,
+        metavar="<file>",
+        help=(
+            "<mail> stops tracking <url> for every '<url> <mail>' line of "
+            "<file> ('-' for stdin)"
+        ),
+    )
+    argparser.add_argument(
+        "--migrate",
+        type=str,
+        nargs="?",
+        const=PRODUCT_LIST_FILE,
+        metavar="<file>",
+        help=(
+            "import products from a product_list.json file into the product "
+            "store (default: product_list.json in the data directory)"
+        ),
+    )
+    argparser.add_argument(
+        "--replay",
+        type=str,
+        nargs="?",
+        const="",
+        metavar="<date>",
+        help=(
+            "parse again the pages kept in the page cache (only the ones "
+            "fetched since <date>, YYYY-MM-DD, if given) and write the "
+            "prices found, without any network access"
+        ),
+    )
     argparser.add_argument(
         "-u",
         "--update",
         action="store_true",
         help="update prices for every product",
     )
+    argparser.add_argument(
+        "--daemon",
+        action="store_true",
+        help=(
+            "keep running, updating every product on its own interval "
+            "(insertions and removals are handed over to the running daemon)"
+        ),
+    )
+    argparser.add_argument(
+        "--notify",
+        type=str,
+        metavar="<rule>",
+        help=(
+            "with -i or --insert-from, notify <mail> on: 'drop' (any price "
+            "drop, default), 'drop:<percent>' (drop of at least "
+            "<percent>%%), 'low' (all-time low) or 'low:<days>' (lowest "
+            "price in <days> days)"
+        ),
+    )
+    argparser.add_argument(
+        "--interval",
+        type=float,
+        metavar="<hours>",
+        help=(
+            "with -i or --insert-from, hours between two updates of the "
+            "product in daemon mode (default: 'interval' in the [daemon] "
+            "configuration section, or 24)"
+        ),
+    )
+    argparser.add_argument(
+        "--budget",
+        type=str,
+        metavar="<budget>",
+        help=(
+            "with -u, fetch the products most worth it first (most "
+            "followers, most volatile prices, least recently checked) and "
+            "stop at <n> requests or after <n>s|m|h, e.g. 500, 30m or "
+            "500,30m, leaving the others for the next update"
+        ),
+    )
+    argparser.add_argument(
+        "--wait",
+        action="store_true",
+        help=(
+            "wait for other runs modifying the product store to finish "
+            "instead of exiting"
+        ),
+    )
+    argparser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        metavar="<n>",
+        help=(
+            "number of products fetched at once while updating "
+            f"(default: {DEFAULT_WORKERS})"
+        ),
+    )
+    argparser.add_argument(
+        "-p",
+        "--parsers",
+        type=int,
+        default=DEFAULT_PARSERS,
+        metavar="<n>",
+        help=(
+            "number of processes parsing fetched pages while updating "
+            "(default: number of CPUs)"
+        ),
+    )
+    argparser.add_argument(
+        "--no-compression",
+        action="store_true",
+        help="don't ask servers for compressed pages",
+    )
+    argparser.add_argument(
+        "--site-limit",
+        type=int,
+        default=DEFAULT_SITE_LIMIT,
+        metavar="<n>",
+        help=(
+            "max concurrent fetches per site, unless overridden by the "
+            "site's 'concurrency' in sites.json "
+            f"(default: {DEFAULT_SITE_LIMIT})"
+        ),
+    )
+    argparser.add_argument(
+        "--profile",
+        action="store_true",
+        help=(
+            "profile the run with cProfile, writing the stats next to the "
+            "log file (traker.prof)"
+        ),
+    )
 
     if len(argv) == 1:  # If no argument is given print help and exit
         argparser.print_help()
         argparser.exit(status=0)
     args = argparser.parse_args()
-    if args.remove is not None:
-        remove_product(args.remove[0], args.remove[1])
-    if args.insert is not None:
-        insert_product(url=args.insert[0], mail_addr=args.insert[1])
-    if args.update:
-        update_prices()
-    if args.list:
-        list_products()
+    if args.profile:
+        profile_run(PROFILE_FILE)
+    inserting = args.insert is not None or args.insert_from is not None
+    if inserting or args.update or args.daemon:
+        get_fetcher().compress = not args.no_compression
+    interval = None if args.interval is None else args.interval * 3600
+    budget = None if args.budget is None else check_budget(args.budget)
+    # while a daemon is running, it takes insertions and removals over
+    editing = [args.insert, args.remove, args.insert_from, args.remove_from]
+    daemon = any(arg is not None for arg in editing) and daemon_listening()
+    modifying = args.update or args.daemon or args.migrate is not None
+    modifying = modifying or args.replay is not None
+    if not daemon:
+        modifying = modifying or any(arg is not None for arg in editing)
+    with ExitStack() as stack:
+        # runs modifying the product store never overlap
+        if modifying:
+            check_data_dir()
+            try:
+                stack.enter_context(locked(LOCK_FILE, wait=args.wait))
+            except BlockingIOError:
+                logging.error("another run is modifying the product store")
+                sys_exit(
+                    "ERROR: another run is modifying the product store "
+                    "(use --wait to queue up)"
+                )
+        if args.migrate is not None:
+            migrate_list(args.migrate)
+        if args.remove is not None:
+            remove_product(args.remove[0], args.remove[1], daemon=daemon)
+        if args.remove_from is not None:
+            bulk_update("remove-many", args.remove_from, daemon=daemon)
+        if args.insert_from is not None:
+            bulk_update(
+                "insert-many",
+                args.insert_from,
+                interval=interval,
+                rule=args.notify,
+                daemon=daemon,
+                workers=args.workers,
+                parsers=args.parsers,
+                site_limit=args.site_limit,
+            )
+        if args.insert is not None:
+            insert_product(
+                url=args.insert[0],
+                mail_addr=args.insert[1],
+                interval=interval,
+                rule=args.notify,
+                daemon=daemon,
+            )
+        if args.replay is not None:
+            replay_prices(since=args.replay or None, parsers=args.parsers)
+        if args.update:
+            update_prices(
+                workers=args.workers,
+                parsers=args.parsers,
+                site_limit=args.site_limit,
+                budget=budget,
+            )
+        if args.daemon:
+            run_daemon(
+                workers=args.workers,
+                parsers=args.parsers,
+                site_limit=args.site_limit,
+            )
+    if args.list or args.mine is not None:
+        list_products(
+            mail_addr=args.mine,
+            site=args.site,
+            title=args.title,
+            sort=args.sort,
+            limit=args.limit,
+            offset=args.offset,
+            as_json=args.json,
+        )
+    if args.stats:
+        show_stats()
 
 
 if __name__ == "__main__":
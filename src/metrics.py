@@ -0,0 +1,106 @@
+# coding=utf-8
+
+from contextlib import contextmanager
+from json import dumps as json_dumps
+from threading import Lock
+from time import monotonic, time
+from typing import Iterator
+
+PREFIX = "traker"
+
+
+class Metrics:
+    """
+    Timing spans and counters of the hot paths of a run (or of the whole
+    life of the daemon): every span keeps the count, total and longest
+    duration of the timed calls. Exported as a json run report or in the
+    Prometheus text format (for the node_exporter textfile collector).
+    Safe to use from several threads.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.started = time()
+        self.spans = {}  # name: [count, seconds, max seconds]
+        self.counters = {}
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        """
+        Time the with block as a call of the <name> span (raising included)
+        """
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, monotonic() - start)
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self.lock:
+            span = self.spans.setdefault(name, [0, 0, 0])
+            span[0] += 1
+            span[1] += seconds
+            span[2] = max(span[2], seconds)
+
+    def count(self, name: str, value: float = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name: str, value: float) -> None:
+        """
+        Set counter <name> to <value>, for totals kept elsewhere (e.g. the
+        bytes counted by the Fetcher)
+        """
+        with self.lock:
+            self.counters[name] = value
+
+    def report(self) -> dict:
+        with self.lock:
+            return {
+                "started": self.started,
+                "updated": time(),
+                "spans": {
+                    name: {
+                        "count": count,
+                        "seconds": round(seconds, 6),
+                        "max": round(longest, 6),
+                    }
+                    for name, (count, seconds, longest) in self.spans.items()
+                },
+                "counters": dict(self.counters),
+            }
+
+    def json(self) -> str:
+        return json_dumps(self.report(), indent=2)
+
+    def prometheus(self) -> str:
+        report = self.report()
+        lines = [
+            f"# HELP {PREFIX}_span_seconds Time spent in the hot paths.",
+            f"# TYPE {PREFIX}_span_seconds summary",
+        ]
+        for name, span in sorted(report["spans"].items()):
+            lines.append(
+                f'{PREFIX}_span_seconds_sum{{span="{name}"}} {span["seconds"]}'
+            )
+            lines.append(
+                f'{PREFIX}_span_seconds_count{{span="{name}"}} {span["count"]}'
+            )
+        lines += [
+            f"# HELP {PREFIX}_span_max_seconds Longest call of the hot paths.",
+            f"# TYPE {PREFIX}_span_max_seconds gauge",
+        ]
+        for name, span in sorted(report["spans"].items()):
+            lines.append(
+                f'{PREFIX}_span_max_seconds{{span="{name}"}} {span["max"]}'
+            )
+        for name, value in sorted(report["counters"].items()):
+            lines += [
+                f"# TYPE {PREFIX}_{name}_total counter",
+                f"{PREFIX}_{name}_total {value}",
+            ]
+        lines += [
+            f"# TYPE {PREFIX}_last_update_seconds gauge",
+            f"{PREFIX}_last_update_seconds {report['updated']:.0f}",
+        ]
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,239 @@
+# coding=utf-8
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+from queue import Queue
+from smtplib import (
+    SMTP,
+    SMTP_SSL,
+    SMTPAuthenticationError,
+    SMTPDataError,
+    SMTPRecipientsRefused,
+)
+from ssl import create_default_context
+from threading import Lock
+from time import sleep
+from typing import Callable
+
+from metrics import Metrics
+
+
+SUBJECT = "Price Traker: lower price detected"
+TIMEOUT = 30
+MAX_RETRIES = 3
+RETRY_DELAY = 1  # seconds, doubled at every retry
+
+
+class Unavailable(Exception):
+    """
+    The SMTP server can't be connected or logged in to: no mail can be sent
+    """
+
+
+class Dispatcher:
+    """
+    Send the notification queue over as few authenticated SMTP connections
+    as possible: recipients are split among <connections> workers, each one
+    logging in once and sending every message of its share over the same
+    connection. On temporary failures the connection is reopened and the
+    message retried up to <retries> times; recipients refused by the server
+    (5xx replies to RCPT or DATA) are not retried. When the server can't be
+    connected or logged in to (e.g. wrong password) the worker stops: the
+    rest of its share is failed, but not refused. Sent, retried and failed
+    messages are counted, delivered and refused recipients recorded; send
+    times (retries included) are recorded in <metrics>.
+    <mail_opts> is the 'mail' section of the configuration file.
+    """
+
+    def __init__(
+        self,
+        mail_opts: dict,
+        connections: int = 1,
+        retries: int = MAX_RETRIES,
+        retry_delay: float = RETRY_DELAY,
+        metrics: Metrics = None,
+    ):
+        self.opts = mail_opts
+        self.connections = max(1, connections)
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.lock = Lock()
+        self.sent = 0
+        self.retried = 0
+        self.logins = 0
+        self.delivered = []
+        self.failed = []
+        self.refused = []  # failed for good, not worth retrying later
+
+    def connect(self) -> SMTP:
+        if self.opts.get("ssl", True):
+            server = SMTP_SSL(
+                self.opts["smtp_server"],
+                self.opts["port"],
+                context=create_default_context(),
+                timeout=TIMEOUT,
+            )
+        else:
+            server = SMTP(
+                self.opts["smtp_server"], self.opts["port"], timeout=TIMEOUT
+            )
+        server.login(self.opts["notifier_addr"], self.opts["notifier_psw"])
+        with self.lock:
+            self.logins += 1
+        return server
+
+    def message(self, mail_addr: str, mail_body: str) -> EmailMessage:
+        mail = EmailMessage()
+        mail["Subject"] = SUBJECT
+        mail["To"] = mail_addr
+        mail["From"] = self.opts["notifier_addr"]
+        mail.set_content(mail_body)
+        return mail
+
+    def send(self, server: SMTP, mail: EmailMessage) -> tuple:
+        """
+        Send <mail> over <server> (connecting if None), reconnecting and
+        retrying on temporary failures; return (server, error), where error
+        is None if the mail was sent; raise Unavailable if the server can't
+        be connected or logged in to
+        """
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                with self.lock:
+                    self.retried += 1
+                self.metrics.count("mail_retries")
+                sleep(self.retry_delay * 2 ** (attempt - 1))
+            if server is None:
+                try:
+                    server = self.connect()
+                except SMTPAuthenticationError as e:
+                    raise Unavailable(e)  # no use logging in again
+                except Exception as e:
+                    error = Unavailable(e)
+                    continue
+            try:
+                server.send_message(mail)
+                return server, None
+            except Exception as e:
+                error = e
+                if permanent(e):
+                    return server, e  # don't retry
+            # temporary failure: reopen the connection before retrying
+            close(server)
+            server = None
+        if isinstance(error, Unavailable):
+            raise error
+        return server, error
+
+    def deliver(self, batch: list, settled: Callable[[str], None]) -> None:
+        """
+        Send every (mail_addr, mail_body) of <batch> over one connection,
+        calling settled(mail_addr) as soon as a recipient is delivered or
+        refused, settled(None) when done
+        """
+        try:
+            self.deliver_batch(batch, settled)
+        finally:
+            settled(None)
+
+    def deliver_batch(
+        self, batch: list, settled: Callable[[str], None]
+    ) -> None:
+        server = None
+        for index, (mail_addr, mail_body) in enumerate(batch):
+            print(f"Sending mail notification to {mail_addr}")
+            try:
+                with self.metrics.span("send_notification"):
+                    server, error = self.send(
+                        server, self.message(mail_addr, mail_body)
+                    )
+            except Unavailable as e:
+                left = [mail_addr for mail_addr, _ in batch[index:]]
+                self.metrics.count("mails_failed", len(left))
+                logging.error(
+                    f"unable to reach the SMTP server ({e}), "
+                    f"{len(left)} mail notifications left for the next update"
+                )
+                print(f"unable to reach the SMTP server ({e})")
+                with self.lock:
+                    self.failed.extend(left)
+                return
+            if error is not None:
+                self.metrics.count("mails_failed")
+                logging.error(
+                    "unable to send mail notification "
+                    f"to '{mail_addr}' ({error})"
+                )
+                print(f"unable to send mail notification to '{mail_addr}'")
+                with self.lock:
+                    self.failed.append(mail_addr)
+                    if permanent(error):
+                        self.refused.append(mail_addr)
+                if permanent(error):
+                    settled(mail_addr)
+                continue
+            logging.info(f"mail notification sent to {mail_addr}")
+            self.metrics.count("mails_sent")
+            with self.lock:
+                self.sent += 1
+                self.delivered.append(mail_addr)
+            settled(mail_addr)
+        if server is not None:
+            close(server)
+
+    def dispatch(
+        self, notification_queue: dict, done: Callable[[str], None] = None
+    ) -> None:
+        """
+        Send every message of <notification_queue> ({mail_addr: mail_body}),
+        calling done(mail_addr) in the calling thread as soon as a recipient
+        is delivered or refused (e.g. to remove it from a persistent queue,
+        so that an interrupted dispatch doesn't send it again)
+        """
+        recipients = list(notification_queue.items())
+        batches = [
+            recipients[index :: self.connections]
+            for index in range(min(self.connections, len(recipients)))
+        ]
+        settled = Queue()
+        with ThreadPoolExecutor(max_workers=self.connections) as executor:
+            futures = [
+                executor.submit(self.deliver, batch, settled.put)
+                for batch in batches
+            ]
+            running = len(futures)
+            while running > 0:
+                mail_addr = settled.get()
+                if mail_addr is None:
+                    running -= 1
+                elif done is not None:
+                    done(mail_addr)
+        for future in futures:
+            future.result()  # raise the workers' errors, if any
+
+    def stats(self) -> str:
+        return (
+            f"mail: {self.sent} sent, {len(self.failed)} failed, "
+            f"{self.retried} retries, {self.logins} logins"
+        )
+
+
+def permanent(error: Exception) -> bool:
+    """
+    Tell whether <error> is a permanent failure of the recipient (refused,
+    or a 5xx reply to the message data), not worth retrying; connection,
+    login and sender errors are not the recipient's
+    """
+    if isinstance(error, SMTPRecipientsRefused):
+        return True
+    return isinstance(error, SMTPDataError) and error.smtp_code >= 500
+
+
+def close(server: SMTP) -> None:
+    try:
+        server.quit()
+    except Exception:
+        server.close()
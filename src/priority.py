@@ -0,0 +1,136 @@
+# coding=utf-8
+
+from datetime import datetime
+from math import inf
+from re import fullmatch
+from time import monotonic
+from typing import Callable, NamedTuple, Optional
+
+
+DAY = 24 * 3600
+# volatility assumed for products with a steady (or too short) price
+# history, so that they still climb the ranking as they grow stale
+MIN_VOLATILITY = 0.01
+UNITS = {"s": 1, "m": 60, "h": 3600}
+BUDGET_FORMAT = "<n> requests, <n>s|m|h of wall time or both, e.g. 500,30m"
+
+
+class Priority(NamedTuple):
+    followers: int
+    volatility: float  # see analytics.price_volatility
+    # days since the last check, or since the last price for the products
+    # stored before checks were recorded (inf if neither)
+    age: float
+    since: str = "checked"  # what <age> counts from
+
+    @property
+    def value(self) -> float:
+        """
+        Expected worth of fetching the product now: the price change
+        expected since the last check (volatility times days), weighted by
+        the followers who would be notified
+        """
+        if self.age == inf:
+            return inf
+        return self.followers * max(self.volatility, MIN_VOLATILITY) * self.age
+
+    def __str__(self) -> str:
+        checked = (
+            "never checked"
+            if self.age == inf
+            else f"{self.since} {self.age:.1f} days ago"
+        )
+        return (
+            f"priority {self.value:.3g}: {self.followers} followers, "
+            f"price volatility {self.volatility:.1%}, {checked}"
+        )
+
+
+def prioritize(products: list, volatility: dict, now: float) -> list:
+    """
+    Return the (product, Priority) pairs of <products>, highest value
+    first, given the <volatility> of their prices ({product_id: volatility},
+    see analytics.price_volatility) and the time <now>
+    """
+    ranked = []
+    for product in products:
+        checked = product.get("checked")
+        since = "checked"
+        if checked is None and len(product["prices"]) > 0:
+            # last price dates are local days: counted from their midnight
+            last = product["prices"][-1]["date"]
+            checked = datetime.fromisoformat(last).timestamp()
+            since = "last price"
+        priority = Priority(
+            followers=len(product["followers"]),
+            volatility=volatility.get(product["id"], 0),
+            age=inf if checked is None else max(now - checked, 0) / DAY,
+            since=since,
+        )
+        ranked.append((product, priority))
+    ranked.sort(key=lambda pair: pair[1].value, reverse=True)
+    return ranked
+
+
+class Budget(NamedTuple):
+    """
+    Per-run fetch budget: at most <requests> page requests and/or
+    <seconds> of wall time (None: unlimited)
+    """
+
+    requests: Optional[int] = None
+    seconds: Optional[float] = None
+
+    @classmethod
+    def parse(cls, text: str) -> "Budget":
+        """
+        Parse a budget given as BUDGET_FORMAT; raise ValueError if invalid
+        """
+        requests = seconds = None
+        for part in text.replace(" ", "").lower().split(","):
+            number = fullmatch(r"(\d+(?:\.\d+)?)([smh]?)", part)
+            if (
+                number is None
+                or float(number.group(1)) <= 0
+                # request counts are whole numbers, only times have fractions
+                or number.group(2) == "" and "." in number.group(1)
+            ):
+                raise ValueError(
+                    f"'{text}' is not a valid budget: use {BUDGET_FORMAT}"
+                )
+            value, unit = number.groups()
+            if unit == "":
+                requests = int(value)
+            else:
+                seconds = float(value) * UNITS[unit]
+        return cls(requests=requests, seconds=seconds)
+
+    def __str__(self) -> str:
+        parts = []
+        if self.requests is not None:
+            parts.append(f"{self.requests} requests")
+        if self.seconds is not None:
+            unit = next(
+                unit
+                for unit in ("h", "m", "s")
+                if self.seconds >= UNITS[unit] or unit == "s"
+            )
+            parts.append(f"{self.seconds / UNITS[unit]:g}{unit}")
+        return " and ".join(parts)
+
+    def start(self, requests: Callable[[], int]) -> Callable[[], bool]:
+        """
+        Start spending the budget now: return a function telling whether
+        it's spent, given the count of <requests> made so far
+        """
+        first = requests()
+        deadline = None if self.seconds is None else monotonic() + self.seconds
+
+        def spent() -> bool:
+            if deadline is not None and monotonic() >= deadline:
+                return True
+            if self.requests is not None:
+                return requests() - first >= self.requests
+            return False
+
+        return spent
@@ -0,0 +1,297 @@
+# coding=utf-8
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps as json_dumps
+from json import loads as json_loads
+from os.path import isfile
+from random import choice
+from threading import Condition, Event, Thread
+from time import monotonic, time
+from typing import Callable, Optional
+
+from requests import get
+
+from metrics import Metrics
+from utils.files import write_atomic
+
+
+PROXY_LIST_API_URL = (
+    "https://proxylist.geonode.com/api/proxy-list?"
+    "limit={limit}&page={page}&sort_by=lastChecked&sort_type="
+    "desc&anonymityLevel=elite&anonymityLevel=anonymous"
+)
+PROXY_CHECK_URL = "https://httpbin.org/ip"
+PAGE_LIMIT = 50
+TIMEOUT = 5
+MAX_FAILURES = 3  # consecutive failures before a proxy gets retired
+MIN_HEALTHY = 10  # refill the pool when fewer proxies are available
+ROTATION = 5  # hand out a random proxy among the best <ROTATION> ones
+VALIDATION_WORKERS = 16
+STALE_AFTER = 6 * 3600  # persisted scores older than this are discarded
+RETIRED_FOR = 3600  # seconds before a retired proxy can be validated again
+REFILL_INTERVAL = 30
+
+
+def get_proxy_page(useragent: Callable[[], str], page: int = 1) -> tuple:
+    """
+    Return (proxies, total) for the <page>-th page of the proxy list API,
+    where proxies is a list of '<ip>:<port>' strings
+    """
+    response = get(
+        PROXY_LIST_API_URL.format(limit=PAGE_LIMIT, page=page),
+        headers={"User-Agent": useragent()},
+        timeout=TIMEOUT * 6,
+    ).json()
+    proxies = [f"{proxy['ip']}:{proxy['port']}" for proxy in response["data"]]
+    return proxies, int(response["total"])
+
+
+def check_proxy(proxy: str) -> Optional[float]:
+    """
+    Request httpbin.org/ip through <proxy>, which returns a json containing
+    the ip: if ip matches return the round trip latency, None otherwise
+    """
+    start = monotonic()
+    try:
+        response = get(
+            url=PROXY_CHECK_URL,
+            proxies={
+                "http": f"http://{proxy}",
+                "https": f"http://{proxy}",
+            },
+            timeout=TIMEOUT,
+        ).json()
+        if response["origin"] == proxy.split(":")[0]:
+            return monotonic() - start
+    except Exception:
+        pass
+    return None
+
+
+class ProxyPool:
+    """
+    Shared pool of validated proxies, scored by success rate and latency.
+    Proxies are validated once (in parallel) when they enter the pool, then
+    fetchers report back the outcome of every request through report():
+    proxies are retired only after MAX_FAILURES consecutive failures.
+    A background thread refills the pool from the proxy list API, paging
+    further every time (back to the first page once the list is exhausted,
+    retired proxies being given another chance after RETIRED_FOR seconds),
+    and scores are persisted to <scores_file> so that the next run starts
+    with already known good proxies.
+    Proxy list requests, validations, failures and retirements are recorded
+    in <metrics>.
+    """
+
+    def __init__(
+        self,
+        scores_file: str,
+        useragent: Callable[[], str],
+        min_healthy: int = MIN_HEALTHY,
+        max_failures: int = MAX_FAILURES,
+        metrics: Metrics = None,
+    ):
+        self.scores_file = scores_file
+        self.useragent = useragent
+        self.min_healthy = min_healthy
+        self.max_failures = max_failures
+        self.metrics = metrics if metrics is not None else Metrics()
+        # scores object structure:
+        # {
+        #   '<ip>:<port>': {
+        #     'ok': 3, 'fail': 1, 'streak': 0, 'latency': 0.8, 'seen': <ts>
+        #   },
+        # }
+        self.scores = {}
+        self.retired = {}  # proxy: time retired
+        self.next_page = 1
+        self.total = None
+        self.condition = Condition()
+        self.wakeup = Event()
+        self.stopped = Event()
+        self.refiller = None
+
+    # scoring
+    def score(self, proxy: str) -> float:
+        stats = self.scores[proxy]
+        # laplace smoothed success rate, penalized by average latency
+        success_rate = (stats["ok"] + 1) / (stats["ok"] + stats["fail"] + 2)
+        return success_rate / (1 + stats["latency"])
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+    # persistence
+    def load(self) -> None:
+        if not isfile(self.scores_file):
+            return
+        try:
+            with open(self.scores_file, "r") as scores_file:
+                scores = json_loads(scores_file.read())
+        except Exception as e:
+            logging.warning(f"unable to load proxy scores ({e})")
+            return
+        now = time()
+        with self.condition:
+            for proxy, stats in scores.items():
+                if now - stats["seen"] < STALE_AFTER:
+                    self.scores[proxy] = stats
+        logging.info(f"loaded {len(self.scores)} scored proxies")
+
+    def save(self) -> None:
+        with self.condition:
+            scores = json_dumps(self.scores, indent=2)
+        write_atomic(self.scores_file, scores)
+
+    # filling
+    def add(self, proxies: list) -> int:
+        """
+        Validate <proxies> in parallel and add the working ones to the pool,
+        returning how many were added
+        """
+        with self.condition:
+            expired = time() - RETIRED_FOR
+            self.retired = {
+                proxy: retired
+                for proxy, retired in self.retired.items()
+                if retired > expired
+            }
+            proxies = [
+                proxy
+                for proxy in set(proxies)
+                if proxy not in self.scores and proxy not in self.retired
+            ]
+        if len(proxies) == 0:
+            return 0
+
+        def check(proxy: str) -> Optional[float]:
+            with self.metrics.span("check_proxy"):
+                return check_proxy(proxy)
+
+        with ThreadPoolExecutor(max_workers=VALIDATION_WORKERS) as executor:
+            latencies = list(executor.map(check, proxies))
+        added = 0
+        with self.condition:
+            for proxy, latency in zip(proxies, latencies):
+                if latency is None:
+                    self.retired[proxy] = time()
+                    self.metrics.count("proxies_rejected")
+                    continue
+                self.scores[proxy] = {
+                    "ok": 1,
+                    "fail": 0,
+                    "streak": 0,
+                    "latency": latency,
+                    "seen": time(),
+                }
+                added += 1
+            self.condition.notify_all()
+        logging.info(f"{added}/{len(proxies)} proxies passed validation")
+        return added
+
+    def refill(self) -> bool:
+        """
+        Fetch the next page of the proxy list and validate it; return False
+        once the proxy list API has no more pages, the next refill starting
+        over from the first page
+        """
+        if self.total is not None and self.next_page > -(
+            -self.total // PAGE_LIMIT
+        ):
+            self.next_page = 1
+            return False
+        try:
+            with self.metrics.span("get_proxy_page"):
+                proxies, self.total = get_proxy_page(
+                    useragent=self.useragent, page=self.next_page
+                )
+        except Exception as e:
+            logging.error(f"unable to get proxy list ({e})")
+            return False
+        self.next_page += 1
+        self.add(proxies)
+        if len(proxies) == 0:
+            self.next_page = 1
+            return False
+        return True
+
+    def fill(self) -> None:
+        """
+        Synchronously fill the pool until at least <min_healthy> proxies are
+        available or the proxy list is exhausted
+        """
+        while len(self) < self.min_healthy and self.refill():
+            pass
+        print(f"{len(self)} available proxies")
+
+    def start(self) -> "ProxyPool":
+        """
+        Load persisted scores, fill the pool and start the background
+        refilling thread
+        """
+        self.load()
+        self.fill()
+        self.refiller = Thread(target=self.refill_loop, daemon=True)
+        self.refiller.start()
+        return self
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.wakeup.set()
+        self.save()
+
+    def refill_loop(self) -> None:
+        while not self.stopped.is_set():
+            self.wakeup.wait(timeout=REFILL_INTERVAL)
+            self.wakeup.clear()
+            if self.stopped.is_set():
+                break
+            if len(self) < self.min_healthy and not self.refill():
+                with self.condition:
+                    # wake up fetchers waiting for an exhausted pool
+                    self.condition.notify_all()
+
+    # handing out
+    def acquire(self, timeout: float = TIMEOUT * 6) -> Optional[str]:
+        """
+        Return one of the best scored proxies, waiting up to <timeout>
+        seconds for the background refill if the pool is empty; return None
+        if no proxy is available
+        """
+        deadline = monotonic() + timeout
+        with self.condition:
+            while len(self.scores) == 0:
+                self.wakeup.set()
+                remaining = deadline - monotonic()
+                if remaining <= 0 or not self.condition.wait(remaining):
+                    return None
+            best = sorted(self.scores, key=self.score, reverse=True)
+            return choice(best[:ROTATION])
+
+    def report(self, proxy: str, ok: bool, latency: float = None) -> None:
+        """
+        Record the outcome of a request made through <proxy>
+        """
+        with self.condition:
+            stats = self.scores.get(proxy)
+            if stats is None:
+                return
+            stats["seen"] = time()
+            if ok:
+                stats["ok"] += 1
+                stats["streak"] = 0
+                if latency is not None:
+                    # exponential moving average of the latency
+                    stats["latency"] = 0.7 * stats["latency"] + 0.3 * latency
+                return
+            stats["fail"] += 1
+            stats["streak"] += 1
+            self.metrics.count("proxy_failures")
+            if stats["streak"] >= self.max_failures:
+                del self.scores[proxy]
+                self.retired[proxy] = time()
+                self.metrics.count("proxies_retired")
+                logging.info(f"proxy {proxy} retired")
+        if len(self) < self.min_healthy:
+            self.wakeup.set()
@@ -0,0 +1,206 @@
+# coding=utf-8
+
+from re import compile
+from typing import Callable, Optional
+from urllib.parse import urlsplit, urlunsplit
+
+from domains import SiteNames
+from extract import Extractor
+
+
+# a number possibly containing thousands/decimal separators, e.g.
+# '1.299,00', '1,299.00', '1 299,00' (including non-breaking spaces), "1'299"
+NUMBER_REGEX = compile(r"\d(?:[\d.,'\s]*\d)?")
+SPACES = dict.fromkeys(map(ord, "' \t\n\u00a0\u202f"))
+
+
+class MissingPrice(ValueError):
+    """
+    The product page was served but has no price (e.g. the product is out
+    of stock): fetching it again through another proxy won't help
+    """
+
+
+def make_price_parser(
+    decimal: Optional[str] = None,
+) -> Callable[[str], float]:
+    """
+    Return a function parsing a price string regardless of the currency
+    symbol and its position ('1.299,00 €', '€1,299.00', 'EUR 1 299,00').
+    <decimal> is the decimal separator used by the site: if not given it is
+    guessed from the last separator, which is a decimal separator only if
+    followed by one or two digits (so '1.299' is read as 1299)
+    """
+
+    def parse_price(text: str) -> float:
+        number = NUMBER_REGEX.search(text)
+        if number is None:
+            raise ValueError(f"no price found in '{text.strip()}'")
+        number = number.group().translate(SPACES)
+        separator = decimal
+        if separator is None:
+            last = max(number.rfind("."), number.rfind(","))
+            if last != -1 and len(number) - last - 1 in (1, 2):
+                separator = number[last]
+        if separator is None:
+            return float(number.replace(".", "").replace(",", ""))
+        integer, _, fraction = number.rpartition(separator)
+        if integer == "":  # no decimal separator found
+            integer, fraction = fraction, "0"
+        integer = integer.replace(".", "").replace(",", "")
+        return float(f"{integer}.{fraction}")
+
+    return parse_price
+
+
+class Site:
+    """
+    A supported site as listed in sites.json:
+    {
+      "<name>": {
+        "title": "<id or class of the title element>",
+        "price": "<id or class of the price element>",
+        "decimal": "<decimal separator>",  (optional, guessed if missing)
+        "domains": ["<domain label>", ...],  (optional, defaults to <name>)
+        "concurrency": <max concurrent fetches>,  (optional)
+        "canonical": {  (optional)
+          "match": "<regex searched in the url path>",
+          "url": "<canonical url: {scheme}, {host} and {0}, {1}... groups>"
+        },
+        "query": ["<query parameter identifying the product>", ...]
+          (optional, every other parameter is dropped)
+        "blocked": ["<text only found in the site's block pages>", ...]
+          (optional, e.g. the captcha form action)
+        "subdomains": ["<subdomain label>", ...]
+          (optional, interchangeable labels the host may start with, e.g.
+          'www': canonical urls use the first one)
+      }
+    }
+    """
+
+    def __init__(self, name: str, opts: dict):
+        self.name = name
+        self.domains = opts.get("domains", [name])
+        self.concurrency = opts.get("concurrency")
+        self.extractor = Extractor(
+            {"title": opts["title"], "price": opts["price"]}
+        )
+        self.parse_price = make_price_parser(opts.get("decimal"))
+        canonical = opts.get("canonical", {})
+        self.canonical_match = None
+        if "match" in canonical:
+            self.canonical_match = compile(canonical["match"])
+            self.canonical_url = canonical["url"]
+        self.query = set(opts.get("query", []))
+        self.block_markers = opts.get("blocked", [])
+        self.subdomains = opts.get("subdomains", [])
+
+    def canonical(self, url: str) -> str:
+        """
+        Return the canonical form of the product <url>, the same for every
+        link to the same product: the 'canonical' rule if it matches,
+        otherwise <url> with lowercase scheme and host, without fragment and
+        without the query parameters not listed in 'query' (e.g. tracking
+        parameters). Either way the host starts with the first of the
+        'subdomains' in place of any of them
+        """
+        parts = urlsplit(url.strip())
+        scheme = parts.scheme.lower()
+        host = self.canonical_host((parts.hostname or "").lower())
+        if parts.port is not None:
+            host += f":{parts.port}"
+        if self.canonical_match is not None:
+            match = self.canonical_match.search(parts.path)
+            if match is not None:
+                return self.canonical_url.format(
+                    *match.groups(), scheme=scheme, host=host
+                )
+        query = "&".join(
+            param
+            for param in parts.query.split("&")
+            if param.partition("=")[0] in self.query
+        )
+        return urlunsplit((scheme, host, parts.path, query, ""))
+
+    def canonical_host(self, host: str) -> str:
+        """
+        Return <host> with its leading 'subdomains' labels replaced by the
+        first one (e.g. 'amazon.it' and 'smile.amazon.it' -> 'www.amazon.it')
+        """
+        if len(self.subdomains) == 0:
+            return host
+        labels = host.split(".")
+        # at least the domain and its top level domain are kept
+        while len(labels) > 2 and labels[0] in self.subdomains:
+            labels.pop(0)
+        return ".".join([self.subdomains[0]] + labels)
+
+    def block_marker(self, page: str) -> Optional[str]:
+        """
+        Return the first block marker ('blocked') found in <page>, None if
+        it isn't a block or captcha page; plain substring searches, much
+        cheaper than parsing the page
+        """
+        for marker in self.block_markers:
+            if marker in page:
+                return marker
+        return None
+
+    def extract(self, page: str) -> dict:
+        """
+        Return the product infos found in <page>, raise MissingPrice if the
+        page has a title but no price, ValueError if neither can be found
+        (i.e. it isn't a product page of the site)
+        """
+        fields = self.extractor.extract(page)
+        if fields["title"] is not None and fields["price"] is None:
+            raise MissingPrice("price not found in page")
+        if fields["title"] is None:
+            missing = [field for field in fields if fields[field] is None]
+            raise ValueError(f"{', '.join(missing)} not found in page")
+        return {
+            "title": fields["title"].strip(" \n"),
+            "price": self.parse_price(fields["price"]),
+        }
+
+
+class SiteRegistry(SiteNames):
+    """
+    Map url domains to the precompiled Site extractors listed in sites.json
+    """
+
+    def __init__(self, sites: dict):
+        super().__init__(sites)
+        self.sites = {name: Site(name, opts) for name, opts in sites.items()}
+
+    def __iter__(self):
+        return iter(self.sites.values())
+
+    def canonical(self, url: str) -> str:
+        """
+        Return the canonical form of <url> (see Site.canonical), <url> as is
+        if the site is not supported
+        """
+        name = self.site_name(url)
+        if name not in self.sites:
+            return url
+        return self.sites[name].canonical(url)
+
+    def block_marker(self, url: str, page: str) -> Optional[str]:
+        """
+        Return the block marker found in the <page> of <url> (see
+        Site.block_marker), None if the site is not supported
+        """
+        name = self.site_name(url)
+        if name not in self.sites:
+            return None
+        return self.sites[name].block_marker(page)
+
+    def get(self, url: str) -> Site:
+        """
+        Return the Site serving <url>, raise if it is not supported
+        """
+        name = self.site_name(url)
+        if name not in self.sites:
+            raise ValueError(f"unsupported site '{name}'")
+        return self.sites[name]
@@ -0,0 +1,643 @@
+# coding=utf-8
+
+import sqlite3
+from contextlib import contextmanager, nullcontext
+from json import loads as json_loads
+from time import time
+from typing import Callable, Iterator, Optional
+
+
+BUSY_TIMEOUT = 30
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL UNIQUE,
+    title TEXT,
+    etag TEXT,
+    last_modified TEXT,
+    checked REAL,
+    interval REAL
+);
+CREATE TABLE IF NOT EXISTS followers (
+    product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+    mail TEXT NOT NULL,
+    rule TEXT,
+    PRIMARY KEY (product_id, mail)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS followers_mail ON followers(mail);
+CREATE TABLE IF NOT EXISTS prices (
+    product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+    date TEXT NOT NULL,
+    price REAL,
+    PRIMARY KEY (product_id, date)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollups (
+    product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+    week TEXT NOT NULL,
+    low REAL,
+    high REAL,
+    last REAL,
+    PRIMARY KEY (product_id, week)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS notifications (
+    mail TEXT NOT NULL,
+    body TEXT NOT NULL
+);
+"""
+# columns added after the first release of the store: (table, name, type)
+MIGRATIONS = [
+    ("products", "checked", "REAL"),
+    ("products", "interval", "REAL"),
+    ("followers", "rule", "TEXT"),
+]
+COLUMNS = "id, url, title, etag, last_modified, checked, interval"
+# trigram index over product titles, kept up to date by triggers (needs
+# SQLite built with FTS5, otherwise title search falls back to a scan)
+TITLES = """
+CREATE VIRTUAL TABLE IF NOT EXISTS titles USING fts5(
+    title, content='products', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS titles_insert AFTER INSERT ON products BEGIN
+    INSERT INTO titles (rowid, title) VALUES (new.id, new.title);
+END;
+CREATE TRIGGER IF NOT EXISTS titles_delete AFTER DELETE ON products BEGIN
+    INSERT INTO titles (titles, rowid, title)
+    VALUES ('delete', old.id, old.title);
+END;
+CREATE TRIGGER IF NOT EXISTS titles_update AFTER UPDATE OF title ON products
+BEGIN
+    INSERT INTO titles (titles, rowid, title)
+    VALUES ('delete', old.id, old.title);
+    INSERT INTO titles (rowid, title) VALUES (new.id, new.title);
+END;
+"""
+MIN_TRIGRAM = 3  # shorter title substrings can't use the trigram index
+LISTING_CHUNK = 256  # products loaded at once while streaming a listing
+# listing sorts as (sort key, order), the key computed through index
+# lookups of each product's prices: last price change (biggest drops
+# first) and last update (most recent first), products without one last
+LAST_PRICE = (
+    "(SELECT price FROM prices WHERE product_id = products.id "
+    "ORDER BY date DESC LIMIT 1{offset})"
+)
+SORTS = {
+    None: ("NULL", "id"),
+    "delta": (
+        LAST_PRICE.format(offset="")
+        + " - "
+        + LAST_PRICE.format(offset=" OFFSET 1"),
+        "sort_key IS NULL, sort_key, id",
+    ),
+    "updated": (
+        "(SELECT max(date) FROM prices WHERE product_id = products.id)",
+        "sort_key IS NULL, sort_key DESC, checked DESC, id",
+    ),
+}
+# daily prices and weekly rollups (dated to their monday) as one history
+HISTORY = (
+    "SELECT product_id, date, price, price AS low, price AS high "
+    "FROM prices {where} UNION ALL "
+    "SELECT product_id, week, last, low, high FROM rollups {where}"
+)
+
+
+class Store:
+    """
+    SQLite product store: products, followers and price history live in
+    separate indexed tables, so that inserts, removes and daily price
+    appends are small incremental writes. Price drop notifications are
+    queued here too until they are sent, so that update runs can be resumed.
+    Prices older than a given age can be rolled up to weekly low, high and
+    last prices (see rollup).
+    Lookups by url, by follower and by title substring are indexed (the
+    latter through a trigram index), so they don't slow down as the store
+    grows.
+    Products are handed out as dicts shaped like the old product_list.json
+    entries, plus their 'id', where 'prices' only holds the most recent
+    <history> prices:
+    {
+      'id': 1,
+      'url': 'https://...',
+      'title': '...',
+      'followers': ['mail_addr1', ...],
+      'rules': {'mail_addr1': 'drop:5'},  # followers' notification rules
+      'prices': [{'date': 'YYYY-MM-DD', 'price': 9.99}, ...],
+      'validators': {'etag': ..., 'last_modified': ...},
+      'checked': 1650000000.0,  # time of the last price update, if any
+      'interval': 86400.0,  # seconds between updates, None for default
+    }
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # concurrent runs wait up to BUSY_TIMEOUT for each other's writes
+        self.db = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.executescript(SCHEMA)
+        self.migrate()
+        self.indexed_titles = self.index_titles()
+        self.batching = False
+
+    def close(self) -> None:
+        self.db.close()
+
+    @contextmanager
+    def batch(self):
+        """
+        Commit the writes made within as a single transaction (rolled back
+        altogether on errors), or within the enclosing batch if any
+        """
+        if self.batching:
+            yield self
+            return
+        with self.db:
+            self.batching = True
+            try:
+                yield self
+            finally:
+                self.batching = False
+
+    def write(self):
+        # every write commits on its own, unless made within batch()
+        return nullcontext() if self.batching else self.db
+
+    def migrate(self) -> None:
+        """
+        Add the columns missing from stores created by older versions
+        """
+        with self.db:
+            for table, column, kind in MIGRATIONS:
+                columns = [
+                    row[1]
+                    for row in self.db.execute(f"PRAGMA table_info({table})")
+                ]
+                if column not in columns:
+                    self.db.execute(
+                        f"ALTER TABLE {table} ADD COLUMN {column} {kind}"
+                    )
+
+    def index_titles(self) -> bool:
+        """
+        Create the titles trigram index if missing, indexing the products
+        already in the store; return False if FTS5 is not available
+        """
+        exists = self.db.execute(
+            "SELECT count(*) FROM sqlite_master WHERE name = 'titles'"
+        ).fetchone()[0]
+        try:
+            self.db.executescript(TITLES)
+        except sqlite3.OperationalError:
+            return False
+        if not exists:
+            with self.db:
+                self.db.execute(
+                    "INSERT INTO titles (titles) VALUES ('rebuild')"
+                )
+        return True
+
+    # reading
+    def load(self, rows: list, history: int, every: bool = False) -> list:
+        """
+        Turn products <rows> into product dicts, fetching their followers and
+        their last <history> prices (<every> tells that <rows> are all the
+        products in the store, so that no filtering is needed)
+        """
+        products = {}
+        for row in rows:
+            product_id, url, title, etag, last_modified = row[:5]
+            products[product_id] = {
+                "id": product_id,
+                "url": url,
+                "title": title,
+                "followers": [],
+                "rules": {},
+                "prices": [],
+                "validators": {"etag": etag, "last_modified": last_modified},
+                "checked": row[5],
+                "interval": row[6],
+            }
+        if len(products) == 0:
+            return []
+        where = ""
+        if not every:
+            where = f"WHERE product_id IN ({','.join(map(str, products))})"
+        for product_id, mail, rule in self.db.execute(
+            f"SELECT product_id, mail, rule FROM followers {where}"
+        ):
+            products[product_id]["followers"].append(mail)
+            if rule is not None:
+                products[product_id]["rules"][mail] = rule
+        where = where.replace("product_id", "id")
+        # date of the <history>th last price of each product, then an index
+        # range per product (a window over the whole history is ~10x slower)
+        for product_id, date, price in self.db.execute(
+            "WITH since AS ("
+            "  SELECT id, coalesce(("
+            "    SELECT date FROM prices WHERE product_id = id UNION ALL"
+            "    SELECT week FROM rollups WHERE product_id = id"
+            "    ORDER BY date DESC LIMIT 1 OFFSET ? - 1"
+            f"  ), '') AS date FROM products {where}"
+            ") "
+            "SELECT product_id, prices.date, price FROM since JOIN prices"
+            "  ON product_id = id AND prices.date >= since.date UNION ALL "
+            "SELECT product_id, week, last FROM since JOIN rollups"
+            "  ON product_id = id AND week >= since.date "
+            "ORDER BY product_id, 2",
+            (history,),
+        ):
+            products[product_id]["prices"].append(
+                {"date": date, "price": price}
+            )
+        return list(products.values())
+
+    def products(self, history: int = 1) -> list:
+        rows = self.db.execute(
+            f"SELECT {COLUMNS} FROM products ORDER BY id"
+        ).fetchall()
+        return self.load(rows, history, every=True)
+
+    def find(self, url: str, history: int = 1) -> Optional[dict]:
+        rows = self.db.execute(
+            f"SELECT {COLUMNS} FROM products WHERE url = ?",
+            (url,),
+        ).fetchall()
+        products = self.load(rows, history)
+        return products[0] if len(products) > 0 else None
+
+    def title_filter(self, substr: str) -> tuple:
+        """
+        Return the (condition, parameter) selecting the products whose title
+        contains <substr> (case insensitive)
+        """
+        if self.indexed_titles and len(substr) >= MIN_TRIGRAM:
+            # quoted as a single phrase: trigrams match any substring
+            return (
+                "id IN (SELECT rowid FROM titles WHERE titles MATCH ?)",
+                '"' + substr.replace('"', '""') + '"',
+            )
+        return "instr(lower(title), lower(?)) > 0", substr
+
+    def search(
+        self, substr: str, mail: str = None, history: int = 1
+    ) -> list:
+        """
+        Return the products whose title contains <substr> (case insensitive),
+        only those followed by <mail> if given
+        """
+        condition, param = self.title_filter(substr)
+        params = [param]
+        if mail is not None:
+            condition += (
+                " AND id IN (SELECT product_id FROM followers WHERE mail = ?)"
+            )
+            params.append(mail)
+        rows = self.db.execute(
+            f"SELECT {COLUMNS} FROM products WHERE {condition} ORDER BY id",
+            params,
+        ).fetchall()
+        return self.load(rows, history)
+
+    def followed(self, mail: str, history: int = 1) -> list:
+        """
+        Return the products followed by <mail>
+        """
+        rows = self.db.execute(
+            f"SELECT {COLUMNS} FROM products WHERE id IN ("
+            "  SELECT product_id FROM followers WHERE mail = ?"
+            ") ORDER BY id",
+            (mail,),
+        ).fetchall()
+        return self.load(rows, history)
+
+    def listing(
+        self,
+        mail: str = None,
+        title: str = None,
+        site: str = None,
+        site_of: Callable[[str], str] = None,
+        sort: str = None,
+        limit: int = None,
+        offset: int = 0,
+        history: int = 2,
+    ) -> Iterator[dict]:
+        """
+        Iterate lazily over the products followed by <mail>, whose title
+        contains <title> and whose url is of <site> (site_of(url) == site),
+        if given, sorted by <sort> (see SORTS, insertion order if None),
+        skipping the first <offset> and stopping after <limit>: products are
+        loaded LISTING_CHUNK at a time, as they're consumed
+        """
+        conditions = []
+        params = []
+        if mail is not None:
+            conditions.append(
+                "id IN (SELECT product_id FROM followers WHERE mail = ?)"
+            )
+            params.append(mail)
+        if title is not None:
+            condition, param = self.title_filter(title)
+            conditions.append(condition)
+            params.append(param)
+        if site is not None:
+            self.db.create_function("site_of", 1, site_of, deterministic=True)
+            conditions.append("site_of(url) = ?")
+            params.append(site)
+        where = ""
+        if len(conditions) > 0:
+            where = "WHERE " + " AND ".join(conditions)
+        key, order = SORTS[sort]
+        cursor = self.db.execute(
+            f"SELECT {COLUMNS}, {key} AS sort_key FROM products {where} "
+            f"ORDER BY {order} LIMIT ? OFFSET ?",
+            params + [-1 if limit is None else limit, offset],
+        )
+        while True:
+            rows = cursor.fetchmany(LISTING_CHUNK)
+            if len(rows) == 0:
+                return
+            yield from self.load(rows, history)
+
+    def __len__(self) -> int:
+        return self.db.execute("SELECT count(*) FROM products").fetchone()[0]
+
+    # writing
+    def add_product(self, product: dict) -> int:
+        """
+        Insert <product> (shaped as a product_list.json entry) with its
+        followers and prices, returning its id
+        """
+        validators = product.get("validators") or {}
+        with self.write():
+            product_id = self.db.execute(
+                "INSERT INTO products "
+                "(url, title, etag, last_modified, checked, interval) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    product["url"],
+                    product["title"],
+                    validators.get("etag"),
+                    validators.get("last_modified"),
+                    product.get("checked"),
+                    product.get("interval"),
+                ),
+            ).lastrowid
+            self.db.executemany(
+                "INSERT OR IGNORE INTO followers (product_id, mail, rule) "
+                "VALUES (?, ?, ?)",
+                [
+                    (product_id, mail, product.get("rules", {}).get(mail))
+                    for mail in product["followers"]
+                ],
+            )
+            self.db.executemany(
+                "INSERT OR REPLACE INTO prices (product_id, date, price) "
+                "VALUES (?, ?, ?)",
+                [
+                    (product_id, price["date"], price["price"])
+                    for price in product["prices"]
+                ],
+            )
+        return product_id
+
+    def add_follower(
+        self, product_id: int, mail: str, rule: str = None
+    ) -> None:
+        """
+        Add <mail> to the product followers, with its notification <rule>
+        (see analytics.RULES) replacing the previous one if given
+        """
+        with self.write():
+            self.db.execute(
+                "INSERT INTO followers (product_id, mail, rule) "
+                "VALUES (?, ?, ?) ON CONFLICT (product_id, mail) DO UPDATE "
+                "SET rule = coalesce(excluded.rule, rule)",
+                (product_id, mail, rule),
+            )
+
+    def remove_follower(self, product_id: int, mail: str) -> None:
+        with self.write():
+            self.db.execute(
+                "DELETE FROM followers WHERE product_id = ? AND mail = ?",
+                (product_id, mail),
+            )
+
+    def set_interval(self, product_id: int, interval: float) -> None:
+        with self.write():
+            self.db.execute(
+                "UPDATE products SET interval = ? WHERE id = ?",
+                (interval, product_id),
+            )
+
+    def remove_product(self, product_id: int) -> None:
+        with self.write():
+            self.db.execute("DELETE FROM products WHERE id = ?", (product_id,))
+
+    def merge(self, product_id: int, others: list) -> None:
+        """
+        Merge the products <others> (ids) into <product_id>: their
+        followers, daily prices and weekly rollups are moved over (the ones
+        of <product_id> win on conflicts), then they are removed
+        """
+        ids = ",".join(map(str, others))
+        with self.write():
+            self.db.execute(
+                "INSERT OR IGNORE INTO followers (product_id, mail, rule) "
+                "SELECT ?, mail, rule FROM followers "
+                f"WHERE product_id IN ({ids})",
+                (product_id,),
+            )
+            self.db.execute(
+                "INSERT OR IGNORE INTO prices (product_id, date, price) "
+                "SELECT ?, date, price FROM prices "
+                f"WHERE product_id IN ({ids})",
+                (product_id,),
+            )
+            self.db.execute(
+                "INSERT INTO rollups (product_id, week, low, high, last) "
+                "SELECT ?, week, low, high, last FROM rollups "
+                f"WHERE product_id IN ({ids}) "
+                "ON CONFLICT (product_id, week) DO UPDATE SET "
+                "low = min(low, excluded.low), "
+                "high = max(high, excluded.high)",
+                (product_id,),
+            )
+            self.db.execute(
+                "UPDATE products SET checked = ("
+                "  SELECT max(checked) FROM products"
+                f"  WHERE id = ? OR id IN ({ids})"
+                ") WHERE id = ?",
+                (product_id, product_id),
+            )
+            self.db.execute(f"DELETE FROM products WHERE id IN ({ids})")
+
+    def canonicalize(self, canonical: Callable[[str], str]) -> tuple:
+        """
+        Rewrite the url of every product to canonical(url), merging the
+        products found to share their canonical url (see merge) into the
+        one already at that url, or the oldest one; return (renamed,
+        merged) product counts
+        """
+        products = {}  # canonical url: [(id, url)]
+        for product_id, url in self.db.execute(
+            "SELECT id, url FROM products ORDER BY id"
+        ):
+            products.setdefault(canonical(url), []).append((product_id, url))
+        renamed = merged = 0
+        with self.batch():
+            for url, same in products.items():
+                if len(same) == 1 and same[0][1] == url:
+                    continue
+                kept = next(
+                    (product_id for product_id, old in same if old == url),
+                    same[0][0],
+                )
+                others = [product_id for product_id, _ in same]
+                others.remove(kept)
+                if len(others) > 0:
+                    self.merge(kept, others)
+                    merged += len(others)
+                renamed += self.db.execute(
+                    "UPDATE products SET url = ? WHERE id = ? AND url != ?",
+                    (url, kept, url),
+                ).rowcount
+        return renamed, merged
+
+    def add_price(
+        self,
+        product_id: int,
+        date: str,
+        price: float,
+        validators: dict = None,
+        notifications: dict = None,
+    ) -> None:
+        """
+        Append today's <price> to the product history (replacing the one of
+        the same <date>, if any) and mark the product as checked now,
+        updating the page validators if given;
+        <notifications> ({mail_addr: mail_body}) about the new price are
+        queued in the same transaction, so that an interrupted update never
+        loses them
+        """
+        with self.write():
+            self.db.executemany(
+                "INSERT INTO notifications (mail, body) VALUES (?, ?)",
+                (notifications or {}).items(),
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO prices (product_id, date, price) "
+                "VALUES (?, ?, ?)",
+                (product_id, date, price),
+            )
+            self.db.execute(
+                "UPDATE products SET checked = ? WHERE id = ?",
+                (time(), product_id),
+            )
+            if validators is not None:
+                self.db.execute(
+                    "UPDATE products SET etag = ?, last_modified = ? "
+                    "WHERE id = ?",
+                    (
+                        validators.get("etag"),
+                        validators.get("last_modified"),
+                        product_id,
+                    ),
+                )
+
+    def add_prices(self, prices: list) -> None:
+        """
+        Add the (product_id, date, price) <prices>, replacing the ones of the
+        same dates, without marking the products as checked (e.g. prices
+        backfilled from the page cache)
+        """
+        with self.write():
+            self.db.executemany(
+                "INSERT OR REPLACE INTO prices (product_id, date, price) "
+                "VALUES (?, ?, ?)",
+                prices,
+            )
+
+    def rollup(self, before: str) -> int:
+        """
+        Replace the daily prices of the weeks (starting on monday) before
+        <before> ('YYYY-MM-DD') with each week's lowest, highest and last
+        price; return the number of daily prices rolled up
+        """
+        # only whole weeks are rolled up
+        week = "date(date, '-6 days', 'weekday 1')"
+        with self.write():
+            (before,) = self.db.execute(
+                "SELECT date(?, '-6 days', 'weekday 1')", (before,)
+            ).fetchone()
+            self.db.execute(
+                "INSERT INTO rollups (product_id, week, low, high, last) "
+                "SELECT product_id, week, min(price), max(price), last FROM ("
+                f"  SELECT product_id, {week} AS week, price,"
+                "   last_value(price) OVER ("
+                f"    PARTITION BY product_id, {week} ORDER BY date"
+                "     ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING"
+                "   ) AS last"
+                "  FROM prices WHERE date < ?"
+                ") WHERE true GROUP BY product_id, week "
+                "ON CONFLICT (product_id, week) DO UPDATE SET "
+                "low = min(low, excluded.low), "
+                "high = max(high, excluded.high), "
+                "last = excluded.last",
+                (before,),
+            )
+            return self.db.execute(
+                "DELETE FROM prices WHERE date < ?", (before,)
+            ).rowcount
+
+    def pending_notifications(self) -> dict:
+        """
+        Return the queued notifications not sent yet, as {mail_addr:
+        mail_body}
+        """
+        notification_queue = {}
+        for mail, body in self.db.execute(
+            "SELECT mail, body FROM notifications ORDER BY rowid"
+        ):
+            notification_queue[mail] = notification_queue.get(mail, "") + body
+        return notification_queue
+
+    def clear_notifications(self, mails: list) -> None:
+        with self.write():
+            self.db.executemany(
+                "DELETE FROM notifications WHERE mail = ?",
+                [(mail,) for mail in mails],
+            )
+
+    def import_json(self, path: str) -> tuple:
+        """
+        Import the products of a product_list.json file, merging followers
+        and prices of products already in the store; return (imported,
+        merged) product counts
+        """
+        with open(path, "r") as products_file:
+            product_list = json_loads(products_file.read())
+        imported = merged = 0
+        for product in product_list:
+            stored = self.find(product["url"])
+            if stored is None:
+                self.add_product(product)
+                imported += 1
+                continue
+            with self.write():
+                for mail in product["followers"]:
+                    self.db.execute(
+                        "INSERT OR IGNORE INTO followers (product_id, mail) "
+                        "VALUES (?, ?)",
+                        (stored["id"], mail),
+                    )
+                self.db.executemany(
+                    "INSERT OR IGNORE INTO prices (product_id, date, price) "
+                    "VALUES (?, ?, ?)",
+                    [
+                        (stored["id"], price["date"], price["price"])
+                        for price in product["prices"]
+                    ],
+                )
+            merged += 1
+        return imported, merged
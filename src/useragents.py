@@ -0,0 +1,105 @@
+# coding=utf-8
+
+import logging
+from datetime import date
+from os import listdir, rename
+from os.path import join
+from random import choice
+from threading import Lock, Thread
+
+from fake_useragent import UserAgent
+
+
+USERAGENT_FALLBACK = (
+    "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/535.11"
+    "(KHTML, like Gecko) Chrome/17.0.963.56 Safari/535.11"
+)
+POOL_SIZE = 100
+
+
+class UserAgentProvider:
+    """
+    Random useragent strings using fake_useragent library for anonimity and
+    to prevent blocked requests. UserAgent's cache is read once per process
+    and a pool of useragents is kept in memory, so that handing one out is
+    a simple random choice. The cache is updated monthly: look for
+    <data_dir>/useragents_<month>.json: if exists and <month> correspond to
+    current month then use that cache, otherwhise rename file to current
+    month and update UserAgent cache in a background thread, while the
+    current pool keeps being served.
+    """
+
+    def __init__(self, data_dir: str, pool_size: int = POOL_SIZE):
+        self.data_dir = data_dir
+        self.pool_size = pool_size
+        self.pool = []
+        self.ua = None
+        self.lock = Lock()
+        self.hits = 0
+        self.loads = 0
+        self.refreshes = 0
+        self.refresher = None
+
+    def cache_file(self) -> tuple:
+        """
+        Return (useragents_file, need_cache_update) for the current month,
+        renaming last month's cache file if found
+        """
+        need_cache_update = True
+        useragents_file = join(
+            self.data_dir, "useragents_" + str(date.today().month) + ".json"
+        )
+        for file in listdir(self.data_dir):
+            if "useragents" in file:
+                month = int(file.split(".json")[0].split("_")[1])
+                if month == date.today().month:
+                    need_cache_update = False
+                else:
+                    rename(join(self.data_dir, file), useragents_file)
+                break
+        return useragents_file, need_cache_update
+
+    def fill(self) -> None:
+        self.pool = list({self.ua.random for _ in range(self.pool_size)})
+
+    def load(self) -> None:
+        useragents_file, need_cache_update = self.cache_file()
+        try:
+            self.ua = UserAgent(
+                fallback=USERAGENT_FALLBACK, path=useragents_file
+            )
+            self.fill()
+        except Exception as e:
+            logging.error(f"unable to load UserAgent cache ({e})")
+            self.pool = [USERAGENT_FALLBACK]
+            return
+        self.loads += 1
+        # update user agent cache every month
+        if need_cache_update:
+            self.refresher = Thread(target=self.refresh, daemon=True)
+            self.refresher.start()
+
+    def refresh(self) -> None:
+        try:
+            self.ua.update()
+            self.fill()
+        except Exception as e:
+            logging.error(f"unable to update UserAgent cache ({e})")
+            return
+        with self.lock:
+            self.refreshes += 1
+        logging.warning("updated UserAgent cache")
+
+    def random(self) -> str:
+        with self.lock:
+            if len(self.pool) == 0:
+                self.load()
+            self.hits += 1
+            pool = self.pool
+        return choice(pool)
+
+    def stats(self) -> str:
+        return (
+            f"useragents: {self.hits} served from {len(self.pool)} cached, "
+            f"{self.loads} cache loads, {self.refreshes} cache refreshes"
+        )
@@ -0,0 +1,32 @@
+from contextlib import contextmanager
+from fcntl import LOCK_EX, LOCK_NB, LOCK_UN, flock
+from os import fdopen, fsync, replace, unlink
+from os.path import basename, dirname
+from tempfile import mkstemp
+
+
+def write_atomic(path: str, data: str) -> None:
+    # write to a temporary file in the same directory, then rename it over
+    # <path>: readers (and crashes) never see a partially written file
+    fd, tmp_path = mkstemp(dir=dirname(path), prefix=f".{basename(path)}.")
+    try:
+        with fdopen(fd, "w") as tmp_file:
+            tmp_file.write(data)
+            tmp_file.flush()
+            fsync(tmp_file.fileno())
+        replace(tmp_path, path)
+    except BaseException:
+        unlink(tmp_path)
+        raise
+
+
+@contextmanager
+def locked(path: str, wait: bool = False):
+    # exclusive lock on <path> held for the whole with block: if the lock is
+    # taken wait for it to be released or raise BlockingIOError right away
+    with open(path, "a+") as lock_file:
+        flock(lock_file, LOCK_EX if wait else LOCK_EX | LOCK_NB)
+        try:
+            yield
+        finally:
+            flock(lock_file, LOCK_UN)
@@ -1,8 +1,11 @@
-from os import get_terminal_size
+from shutil import get_terminal_size
 
-def wrap(input: str, prefix_length: int = 0) -> str:
-    cols, _ = get_terminal_size()
-    cols -= prefix_length # 4 cols are already used by lines
+def wrap(input: str, prefix_length: int = 0, cols: int = None) -> str:
+    # <cols> is the terminal width: look it up once and pass it when wrapping
+    # many lines (looked up here otherwise, 80 when not on a terminal)
+    if cols is None:
+        cols, _ = get_terminal_size()
+    cols = max(cols - prefix_length, 1) # cols already used by the prefix
     new_string = []
     divisions = int(len(input) / cols)
     if divisions == 0: return input